@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Ettus Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import rfnocsim
+import sim_colosseum
+import csv
+import multiprocessing
+import numpy as np
+import os
+import resource
+import time
+import tracemalloc
+
+SCALE_KEYS = ['dim', 'num_chans', 'num_comps', 'build_s', 'tick_s', 'mem_mib']
+
+def bench_ticks(sim_core, num_ticks):
+    """
+    Run num_ticks ticks on sim_core and return the average wall time
+    and the average peak of bytes allocated (on top of the live heap)
+    while processing a tick
+    """
+    tick_period = 1.0 / sim_core.get_tick_rate()
+    tracemalloc.start()
+    alloc_bytes = 0
+    start = time.time()
+    for i in range(num_ticks):
+        tracemalloc.reset_peak()
+        (base, peak) = tracemalloc.get_traced_memory()
+        sim_core.run(tick_period)
+        (curr, peak) = tracemalloc.get_traced_memory()
+        alloc_bytes += peak - base
+    elapsed = time.time() - start
+    tracemalloc.stop()
+    return (elapsed / num_ticks, alloc_bytes / num_ticks)
+
+def get_peak_rss():
+    """
+    Peak resident memory of this process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_scale(args, dim):
+    """
+    Build the topology with dim blades across each dimension and run it for
+    args.ticks ticks. Runs in a fresh process so that the peak memory only
+    accounts for this size.
+    """
+    base_rss = get_peak_rss()
+    sim_core = rfnocsim.SimulatorCore(tick_rate=100e6, event_driven=args.event_driven)
+    start = time.time()
+    sim_colosseum.build_topology(sim_core, args.topology, sim_colosseum.get_app_settings(args),
+        verbose=False, dim=dim, usrps_per_fpga=args.usrps_per_fpga)
+    build_time = time.time() - start
+    tick_period = 1.0 / sim_core.get_tick_rate()
+    sim_core.run(tick_period)
+    start = time.time()
+    sim_core.run(args.ticks * tick_period)
+    tick_time = (time.time() - start) / args.ticks
+    return {'dim': dim,
+            'num_chans': 2 * len(sim_core.list_components(rfnocsim.comptype.hardware, 'USRP.*')),
+            'num_comps': len(sim_core.list_components()),
+            'build_s': build_time, 'tick_s': tick_time,
+            'mem_mib': (get_peak_rss() - base_rss) / (1024.0 * 1024.0)}
+
+def report_scaling(args):
+    """
+    Benchmark the topology at every size in args.scale and report how the build
+    time, the time per tick and the memory grow with the number of components
+    """
+    results = []
+    for dim in [int(x) for x in args.scale.split(',')]:
+        # One process per size (maxtasksperchild) to measure its peak memory
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            result = pool.apply(bench_scale, (args, dim))
+        finally:
+            pool.terminate()
+            pool.join()
+        print('[INFO] dim=%d: %d chans, %d components, build %.3fs, %.3fs per tick, %.1f MiB' % (
+            result['dim'], result['num_chans'], result['num_comps'],
+            result['build_s'], result['tick_s'], result['mem_mib']))
+        results.append(result)
+    if len(results) > 1:
+        # Slope on a log-log scale: 1.0 is linear in the number of components
+        comps = np.log([r['num_comps'] for r in results])
+        exps = [np.polyfit(comps, np.log([max(r[k], 1e-9) for r in results]), 1)[0]
+            for k in ['build_s', 'tick_s', 'mem_mib']]
+        print('[INFO] Scaling exponent vs components: build %.2f, tick %.2f, memory %.2f (1.0 is linear)' % tuple(exps))
+    if args.output_dir:
+        with open(os.path.join(args.output_dir, 'scaling.csv'), 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=SCALE_KEYS)
+            writer.writeheader()
+            writer.writerows(results)
+
+def main():
+    parser = sim_colosseum.get_parser('Benchmark the rfnocsim core using the Colosseum network')
+    parser.add_argument('--ticks', type=int, default=4, help='Number of ticks to benchmark')
+    parser.add_argument('--scale', type=str, default=None, help='Report how the simulator scales over these dimensions (CSV) of the built-in topology')
+    args = parser.parse_args()
+    if args.scale:
+        report_scaling(args)
+        return
+
+    sim_core = rfnocsim.SimulatorCore(tick_rate=100e6, event_driven=args.event_driven)
+    start = time.time()
+    sim_colosseum.build_topology(sim_core, args.topology, sim_colosseum.get_app_settings(args),
+        dim=args.dim, usrps_per_fpga=args.usrps_per_fpga)
+    print('[INFO] Topology built in %.3fs (%d components)' % (
+        time.time() - start, len(sim_core.list_components())))
+
+    # Warm up once so that one-time allocations don't skew the numbers
+    sim_core.run(1.0 / sim_core.get_tick_rate())
+    (tick_time, tick_bytes) = bench_ticks(sim_core, args.ticks)
+    print('[INFO] Wall time per tick      : %.3fs' % (tick_time))
+    print('[INFO] Peak allocation per tick: %.2f MiB' % (tick_bytes / (1024.0 * 1024.0)))
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,7 @@
 
 import rfnocsim
 import math
+import numpy as np
 import ni_hw_models as hw
 
 class ColGlobals():
@@ -46,15 +47,26 @@ class PartialContribComputer(rfnocsim.Function):
         items_per_stream: How many channels per stream can this function deinterleave?
         ticks_per_exec: How many ticks for the function to generate a full output set
     """
+    DSP_BLOCKS_PER_MAC = 3      # DSP blocks for a scaled complex MAC
+    MAX_DSP_RATE = 400e6        # Max clock rate for a DSP48E block
+    MAX_UNROLL_DEPTH = 2        # How many taps (or FFT bins) to compute in parallel?
+    COEFF_SETS = 1              # We need two copies of coefficients one live
+                                # and one buffered for dynamic reload. If both
+                                # live in BRAM, this should be 2. If the live
+                                # set lives in registers, this should be 1
+
+    # Resource and latency estimates shared by all instances with the same parameters
+    estimate_cache = dict()
+
     def __init__(self, sim_core, name, size, dst_chans, items_per_stream, app_settings):
         ticks_per_exec = 1      # This function will run once every tick. No multi-cycle paths here.
         rfnocsim.Function.__init__(self, sim_core, name, size, int(len(dst_chans)/items_per_stream), ticks_per_exec)
         self.items_per_stream = items_per_stream  # Each stream contains data from n radio chans
         self.dst_chans = dst_chans              # Where should the individual products go?
+        self.item_cache = dict()                # Output stream IDs for each set of input stream IDs
         # This block has to buffer enough data to ensure
         # sample alignment. How deep should those buffers be?
-        sync_buff_depth = (((ColGlobals.MAX_SAMP_HOPS - ColGlobals.MIN_SAMP_HOPS) *
-            hw.Bee7Fpga.IO_LN_LATENCY * float(app_settings['samp_rate'])) / ColGlobals.ELASTIC_BUFF_FULLNESS)
+        sync_buff_depth = self.get_sync_buff_depth(app_settings['samp_rate'])
 
         # Adder latency: log2(radix) adder stages + 2 pipeline flops
         latency = math.ceil(math.log(size/len(dst_chans), 2)) + 2
@@ -64,47 +76,79 @@ class PartialContribComputer(rfnocsim.Function):
         latency += ColGlobals.BPP * (self.get_tick_rate() / hw.Bee7Fpga.IO_LN_BW)
         self.estimate_resources(size*items_per_stream, len(dst_chans), app_settings, sync_buff_depth*size, latency)
 
-    def estimate_resources(self, N, M, app_settings, sync_buff_total_samps, pre_filt_latency):
-        rscrs = rfnocsim.HwRsrcs()
+    @staticmethod
+    def get_sync_buff_depth(samp_rate):
+        return (((ColGlobals.MAX_SAMP_HOPS - ColGlobals.MIN_SAMP_HOPS) *
+            hw.Bee7Fpga.IO_LN_LATENCY * samp_rate) / ColGlobals.ELASTIC_BUFF_FULLNESS)
 
-        DSP_BLOCKS_PER_MAC = 3      # DSP blocks for a scaled complex MAC
-        MAX_DSP_RATE = 400e6        # Max clock rate for a DSP48E block
-        MAX_UNROLL_DEPTH = 2        # How many taps (or FFT bins) to compute in parallel?
-        COEFF_SETS = 1              # We need two copies of coefficients one live
-                                    # and one buffered for dynamic reload. If both
-                                    # live in BRAM, this should be 2. If the live
-                                    # set lives in registers, this should be 1
-
-        samp_rate = float(app_settings['samp_rate'])
-        dsp_cyc_per_samp = MAX_DSP_RATE / samp_rate
-
-        if app_settings['domain'] == 'time':
-            fir_taps = app_settings['fir_taps']
-            if (fir_taps <= dsp_cyc_per_samp):
-                unroll_factor = 1
-                dsp_rate = samp_rate * fir_taps
-            else:
-                unroll_factor = math.ceil((1.0 * fir_taps) / dsp_cyc_per_samp)
-                dsp_rate = MAX_DSP_RATE
-                if (unroll_factor > MAX_UNROLL_DEPTH):
-                    raise self.SimCompError('Too many FIR coefficients! Reached loop unroll limit.')
+    @classmethod
+    def compute_resources(cls, N, M, domain, samp_rate, fir_taps, fir_dly_line, fft_size,
+                          sync_buff_total_samps, tick_rate, max_unroll = MAX_UNROLL_DEPTH):
+        """
+        Resource and latency model. All arguments can be NumPy arrays (that
+        broadcast together) to evaluate many design points at once.
+        Returns a dict of arrays: DSP, BRAM_18kb, the function latency in
+        ticks (without the pre-filter latency) and whether the point is
+        feasible (the FIR loop unroll limit is not exceeded).
+        """
+        samp_rate = np.asarray(samp_rate, dtype=float)
+        fir_taps = np.asarray(fir_taps, dtype=float)
+        is_time = (np.asarray(domain) == 'time')
+
+        # Time domain: FIR filter per NxM pair
+        dsp_cyc_per_samp = cls.MAX_DSP_RATE / samp_rate
+        fits = (fir_taps <= dsp_cyc_per_samp)
+        unroll_factor = np.where(fits, 1.0, np.ceil(fir_taps / dsp_cyc_per_samp))
+        dsp_rate = np.where(fits, samp_rate * fir_taps, cls.MAX_DSP_RATE)
+        time_dsp = cls.DSP_BLOCKS_PER_MAC * unroll_factor * N * M
+        time_bram = (np.ceil(ColGlobals.BPI * np.asarray(fir_dly_line, dtype=float) / hw.Bee7Fpga.BRAM_BYTES) * N * M + # FIR delay line memory
+            np.ceil(ColGlobals.BPI * cls.COEFF_SETS * fir_taps * unroll_factor * N * M / hw.Bee7Fpga.BRAM_BYTES))  # Coefficient storage
+        with np.errstate(divide='ignore', invalid='ignore'):
+            time_latency = fir_taps / ((dsp_rate / tick_rate) * unroll_factor)
+
+        # Frequency domain: Dot product per FFT bin
+        fft_size = np.asarray(fft_size, dtype=float)
+        freq_dsp = cls.DSP_BLOCKS_PER_MAC * N * M * np.asarray(max_unroll, dtype=float)   # MACs
+        freq_bram = np.ceil(ColGlobals.BPI * N * M * fft_size * cls.COEFF_SETS / hw.Bee7Fpga.BRAM_BYTES) # Coeff storage
+        freq_latency = fft_size / (cls.MAX_DSP_RATE / tick_rate)
+
+        sync_bram = np.ceil(ColGlobals.BPI * np.asarray(sync_buff_total_samps, dtype=float) / hw.Bee7Fpga.BRAM_BYTES)
+        return {
+            'DSP': np.where(is_time, time_dsp, freq_dsp),
+            'BRAM_18kb': np.where(is_time, time_bram, freq_bram) + sync_bram,
+            'latency': np.where(is_time, time_latency, freq_latency),
+            'feasible': ~is_time | (unroll_factor <= max_unroll)}
 
-            rscrs.add('DSP', DSP_BLOCKS_PER_MAC * unroll_factor * N * M)
-            rscrs.add('BRAM_18kb', math.ceil(ColGlobals.BPI * app_settings['fir_dly_line'] / hw.Bee7Fpga.BRAM_BYTES) * N * M) # FIR delay line memory
-            rscrs.add('BRAM_18kb', math.ceil(ColGlobals.BPI * COEFF_SETS * fir_taps * unroll_factor * N * M / hw.Bee7Fpga.BRAM_BYTES))   # Coefficient storage
+    @classmethod
+    def estimate_design_points(cls, settings, tick_rate, size, num_dst_chans, items_per_stream):
+        """
+        Evaluate compute_resources for the design points in settings (a dict
+        of broadcastable arrays, see explore_design_space)
+        """
+        return cls.compute_resources(size*items_per_stream, num_dst_chans, settings['domain'],
+            settings['samp_rate'], settings['fir_taps'], settings['fir_dly_line'], settings['fft_size'],
+            cls.get_sync_buff_depth(np.asarray(settings['samp_rate'], dtype=float))*size, tick_rate, settings['max_unroll'])
 
-            samp_per_tick = dsp_rate / self.get_tick_rate()
-            self.update_latency(func=pre_filt_latency + (fir_taps / (samp_per_tick * unroll_factor)))
+    def estimate_resources(self, N, M, app_settings, sync_buff_total_samps, pre_filt_latency):
+        domain = app_settings['domain']
+        if domain == 'time':
+            settings = (app_settings['fir_taps'], app_settings['fir_dly_line'], 0)
         else:
-            fft_size = app_settings['fft_size']
-            rscrs.add('DSP', DSP_BLOCKS_PER_MAC * N * M * MAX_UNROLL_DEPTH) # MACs
-            rscrs.add('BRAM_18kb', math.ceil(ColGlobals.BPI * N * M * fft_size * COEFF_SETS / hw.Bee7Fpga.BRAM_BYTES)) # Coeff storage
-
-            samp_per_tick = MAX_DSP_RATE / self.get_tick_rate()
-            self.update_latency(func=pre_filt_latency + (fft_size / samp_per_tick))
-
-        rscrs.add('BRAM_18kb', math.ceil(ColGlobals.BPI * sync_buff_total_samps / hw.Bee7Fpga.BRAM_BYTES))
+            settings = (0, 0, app_settings['fft_size'])
+        key = (N, M, domain, float(app_settings['samp_rate'])) + settings + (sync_buff_total_samps, self.get_tick_rate())
+        estimate = self.estimate_cache.get(key)
+        if estimate is None:
+            estimate = dict((k, v.item()) for (k, v) in
+                self.compute_resources(N, M, domain, app_settings['samp_rate'], *settings,
+                    sync_buff_total_samps=sync_buff_total_samps, tick_rate=self.get_tick_rate()).items())
+            self.estimate_cache[key] = estimate
+        if not estimate['feasible']:
+            raise self.SimCompError('Too many FIR coefficients! Reached loop unroll limit.')
+        rscrs = rfnocsim.HwRsrcs()
+        rscrs.add('DSP', estimate['DSP'])
+        rscrs.add('BRAM_18kb', estimate['BRAM_18kb'])
         self.update_rsrcs(rscrs)
+        self.update_latency(func=pre_filt_latency + estimate['latency'])
 
     def do_func(self, in_data):
         """
@@ -112,29 +156,34 @@ class PartialContribComputer(rfnocsim.Function):
         matrix and spit the partial products out. The dot product is computed for each
         FFT bin serially.
         """
-        out_data = list()
+        # The same inputs always produce the same outputs
+        in_items = tuple(item for di in in_data for item in di.items)
+        out_items = self.item_cache.get(in_items)
+        if out_items is None:
+            out_items = self.item_cache[in_items] = self.get_out_items(in_data)
+        return [self.create_outdata_stream(in_data[0].bpi, items, in_data[0].count) for items in out_items]
+
+    def get_out_items(self, in_data):
         src_chans = []
         # Iterate over each input
         for di in in_data:
             if len(di.items) != self.items_per_stream:
                 raise RuntimeError('Incorrect items per stream. Expecting ' + str(self.items_per_stream))
             # Deinterleave data
-            for do in range(len(di.items)):
-                (sid, coords) = rfnocsim.DataStream.submatrix_parse(di.items[do])
-                if sid != 'rx':
-                    raise RuntimeError('Incorrect items. Expecting radio data (rx) but got ' + sid)
-                src_chans.extend(coords[0])
-        bpi = in_data[0].bpi
-        count = in_data[0].count
+            for item in di.items:
+                if item.matrix != 'rx':
+                    raise RuntimeError('Incorrect items. Expecting radio data (rx) but got ' + item.matrix)
+                src_chans.extend(item.coords[0])
         # Iterate through deinterleaved channels
+        out_items = []
         for i in range(0, len(self.dst_chans), self.items_per_stream):
             items = []
             for j in range(self.items_per_stream):
                 # Compute partial products:
                 # pp = partial product of "src_chans" on "self.dst_chans[i+j]"
-                items.append(rfnocsim.DataStream.submatrix_gen('pp', [src_chans, self.dst_chans[i+j]]))
-            out_data.append(self.create_outdata_stream(bpi, items, count))
-        return out_data
+                items.append(rfnocsim.StreamId('pp', [src_chans, self.dst_chans[i+j]]))
+            out_items.append(items)
+        return out_items
 
 class PartialContribCombiner(rfnocsim.Function):
     """
@@ -149,57 +198,89 @@ class PartialContribCombiner(rfnocsim.Function):
         reducer_filter: A tuple that represents what pp channels to alias to what
         items_per_stream: How many channels per stream can this function deinterleave?
     """
+    # Resource and latency estimates shared by all instances with the same parameters
+    estimate_cache = dict()
 
     def __init__(self, sim_core, name, radix, app_settings, reducer_filter = (None, None), items_per_stream = 2):
         rfnocsim.Function.__init__(self, sim_core, name, radix, 1)
         self.radix = radix
         self.reducer_filter = reducer_filter
         self.items_per_stream = items_per_stream
+        self.item_cache = dict()                # Output stream IDs for each set of input stream IDs
+
+        key = (radix, float(app_settings['samp_rate']), self.get_tick_rate())
+        estimate = self.estimate_cache.get(key)
+        if estimate is None:
+            estimate = dict((k, v.item()) for (k, v) in
+                self.compute_resources(radix, app_settings['samp_rate'], self.get_tick_rate()).items())
+            self.estimate_cache[key] = estimate
+        self.update_latency(func=estimate['latency'])
+        rscrs = rfnocsim.HwRsrcs()
+        rscrs.add('BRAM_18kb', estimate['BRAM_18kb'])
+        self.update_rsrcs(rscrs)
+
+    @staticmethod
+    def get_sync_buff_depth(samp_rate):
+        return (((ColGlobals.MAX_PP_HOPS - ColGlobals.MIN_PP_HOPS) *
+            hw.Bee7Fpga.IO_LN_LATENCY * samp_rate) / ColGlobals.ELASTIC_BUFF_FULLNESS)
 
+    @classmethod
+    def compute_resources(cls, radix, samp_rate, tick_rate):
+        """
+        Resource and latency model. The arguments can be NumPy arrays.
+        """
+        samp_rate = np.asarray(samp_rate, dtype=float)
+        radix = np.asarray(radix)
         # This block has to buffer enough data to ensure
         # sample alignment. How deep should those buffers be?
-        sync_buff_depth = (((ColGlobals.MAX_PP_HOPS - ColGlobals.MIN_PP_HOPS) *
-            hw.Bee7Fpga.IO_LN_LATENCY * float(app_settings['samp_rate'])) / ColGlobals.ELASTIC_BUFF_FULLNESS)
+        sync_buff_depth = cls.get_sync_buff_depth(samp_rate)
         # Figure out latency based on sync buffer and delay line
-        latency = math.ceil(math.log(radix, 2)) + 2     # log2(radix) adder stages + 2 pipeline flops
+        latency = np.ceil(np.log2(radix)) + 2     # log2(radix) adder stages + 2 pipeline flops
         # Synchronization latency based on buffer size
-        latency += (sync_buff_depth * ColGlobals.ELASTIC_BUFF_FULLNESS) * (self.get_tick_rate() / float(app_settings['samp_rate']))
+        latency = latency + (sync_buff_depth * ColGlobals.ELASTIC_BUFF_FULLNESS) * (tick_rate / samp_rate)
         # Packet alignment latency
-        latency += ColGlobals.BPP * (self.get_tick_rate() / hw.Bee7Fpga.IO_LN_BW)
-
-        self.update_latency(func=latency)
-        self.estimate_resources(radix, sync_buff_depth)
-
-    def estimate_resources(self, radix, sync_buff_depth):
-        rscrs = rfnocsim.HwRsrcs()
+        latency = latency + ColGlobals.BPP * (tick_rate / hw.Bee7Fpga.IO_LN_BW)
         # Assume that pipelined adders are inferred in logic (not DSP)
         # Assume that buffering uses BRAM
-        rscrs.add('BRAM_18kb', math.ceil(ColGlobals.BPI * sync_buff_depth * radix / hw.Bee7Fpga.BRAM_BYTES))
-        self.update_rsrcs(rscrs)
+        return {
+            'DSP': np.zeros(np.broadcast(radix, samp_rate).shape),
+            'BRAM_18kb': np.ceil(ColGlobals.BPI * sync_buff_depth * radix / hw.Bee7Fpga.BRAM_BYTES),
+            'latency': latency}
+
+    @classmethod
+    def estimate_design_points(cls, settings, tick_rate, radix):
+        return cls.compute_resources(radix, settings['samp_rate'], tick_rate)
 
     def do_func(self, in_data):
         """
         Gather partial dot products from inputs, add them together and spit them out
         Perform sanity check to ensure that we are adding the correct things
         """
+        # The same inputs always produce the same outputs
+        in_items = tuple(item for di in in_data for item in di.items)
+        out_items = self.item_cache.get(in_items)
+        if out_items is None:
+            out_items = self.item_cache[in_items] = self.get_out_items(in_data)
+        return self.create_outdata_stream(in_data[0].bpi, out_items, in_data[0].count)
+
+    def get_out_items(self, in_data):
         out_chans = dict()
         # Iterate over each input
         for di in in_data:
             if len(di.items) != self.items_per_stream:
                 raise self.SimCompError('Incorrect items per stream. Expecting ' + str(self.items_per_stream))
             # Deinterleave data
-            for do in range(len(di.items)):
-                (sid, coords) = rfnocsim.DataStream.submatrix_parse(di.items[do])
-                if sid == 'null':
+            for item in di.items:
+                if item.matrix == 'null':
                     continue
-                elif sid != 'pp':
-                    raise self.SimCompError('Incorrect items. Expecting partial produts (pp) but got ' + sid)
-                if len(coords[1]) != 1:
+                elif item.matrix != 'pp':
+                    raise self.SimCompError('Incorrect items. Expecting partial produts (pp) but got ' + item.matrix)
+                if len(item.coords[1]) != 1:
                     raise self.SimCompError('Incorrect partial product. Target must be a single channel')
-                if coords[1][0] in out_chans:
-                    out_chans[coords[1][0]].extend(coords[0])
+                if item.coords[1][0] in out_chans:
+                    out_chans[item.coords[1][0]].extend(item.coords[0])
                 else:
-                    out_chans[coords[1][0]] = coords[0]
+                    out_chans[item.coords[1][0]] = list(item.coords[0])
         # Check if keys (targets) for partial products == items_per_stream
         if len(list(out_chans.keys())) != self.items_per_stream:
             raise self.SimCompError('Inconsistent partial products. Too many targets.')
@@ -211,22 +292,58 @@ class PartialContribCombiner(rfnocsim.Function):
         out_items = []
         for ch in list(out_chans.keys()):
             if sorted(self.reducer_filter[0]) == sorted(contrib_chans):
-                out_items.append(rfnocsim.DataStream.submatrix_gen(self.reducer_filter[1], [ch]))
+                out_items.append(rfnocsim.StreamId(self.reducer_filter[1], [ch]))
             else:
-                out_items.append(rfnocsim.DataStream.submatrix_gen('pp', [list(out_chans.values())[0], ch]))
-        return self.create_outdata_stream(in_data[0].bpi, out_items, in_data[0].count)
+                out_items.append(rfnocsim.StreamId('pp', [contrib_chans, ch]))
+        return out_items
 
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 # NOTE: The Torus Topology has not been maintained. Use at your own risk
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 class Topology_2D_4x4_Torus:
+    """
+    2D Torus with DIM blades across each dimension (4x4 by default, see
+    scaled). Blades across the diagonal are connected to USRPs and hosts.
+    Samples are broadcast along rows and partial products are accumulated
+    along columns, so the FPGA image does not depend on DIM.
+    """
+    DIM = 4                 # Number of blades across each dimension
+    USRPS_PER_BLADE = 32    # USRPs connected to each blade on the diagonal
+    HOST_PORTS = 16         # Switch ports on each management host
+
+    @classmethod
+    def scaled(cls, dim):
+        """
+        Returns a DIMxDIM version of this topology
+        """
+        if dim < 1:
+            raise RuntimeError('Torus dimension must be at least 1. Got ' + str(dim))
+        return type(cls.__name__, (cls,), {'DIM': dim})
+
+    @classmethod
+    def get_num_nodes(cls):
+        """
+        Returns how much hardware this topology needs as
+        (num_usrps, num_blades, num_hosts, host_ports)
+        """
+        return (cls.DIM * cls.USRPS_PER_BLADE, cls.DIM * cls.DIM, cls.DIM, cls.HOST_PORTS)
+
+    @classmethod
+    def get_fpga_functions(cls):
+        """
+        Returns the functions in each FPGA image as (class, parameters)
+        """
+        GRP_LEN = 16 // 2
+        return ([(PartialContribComputer, {'size': 4*GRP_LEN, 'num_dst_chans': 16, 'items_per_stream': 2})] +
+            [(PartialContribCombiner, {'radix': 2})] * GRP_LEN)
+
     @classmethod
     def config_bitstream(cls, bee7fpga, app_settings, in_chans, out_chans, total_num_chans, is_radio_node):
         if len(in_chans) != 64:
             raise bee7fpga.SimCompError('in_chans must be 64 channels wide. Got ' + str(len(in_chans)))
         if len(out_chans) != 16:
             raise bee7fpga.SimCompError('out_chans must be 16 channels wide. Got ' + str(len(out_chans)))
-        GRP_LEN = 16 / 2   # 2 radio channesl per USRP
+        GRP_LEN = 16 // 2  # 2 radio channesl per USRP
 
         # Broadcast raw data streams to all internal and external FPGAs
         for i in range(GRP_LEN):
@@ -254,10 +371,11 @@ class Topology_2D_4x4_Torus:
             bee7fpga.sim_core.connect(func, i, bee7fpga.pp_bus[i], 0)
         bee7fpga.add_function(func)
         # Add a function combine all partial products (one per IO lane)
+        all_chans = list(range(total_num_chans))
         for i in range(GRP_LEN):
             func = PartialContribCombiner(
                 sim_core=bee7fpga.sim_core, name=bee7fpga.name + '/pp_combiner_%d/' % (i),
-                radix=2, app_settings=app_settings, reducer_filter=(list(range(total_num_chans)), 'tx'))
+                radix=2, app_settings=app_settings, reducer_filter=(all_chans, 'tx'))
             # Partial products generated internally have to be added to a partial
             # sum coming from outside
             bee7fpga.sim_core.connect(bee7fpga.serdes_i[bee7fpga.EXT_IO_LANES[bee7fpga.FP_BASE+i]], 0, func, 0)
@@ -272,10 +390,12 @@ class Topology_2D_4x4_Torus:
 
     @classmethod
     def connect(cls, sim_core, usrps, bee7blades, hosts, app_settings):
-        USRPS_PER_BLADE = 32
+        DIM = cls.DIM
+        USRPS_PER_BLADE = cls.USRPS_PER_BLADE
+        CHANS_PER_BLADE = USRPS_PER_BLADE * 2
 
         # Create NULL source of "zero" partial products
-        null_items = ['null[(0);(0)]', 'null[(0);(0)]']
+        null_items = [rfnocsim.StreamId('null', [0, 0]), rfnocsim.StreamId('null', [0, 0])]
         null_src = rfnocsim.Producer(sim_core, 'NULL_SRC', 4, null_items)
         if app_settings['domain'] == 'frequency':
             null_src.set_rate(app_settings['samp_rate']*(1.0 +
@@ -284,34 +404,34 @@ class Topology_2D_4x4_Torus:
             null_src.set_rate(app_settings['samp_rate'])
 
         # Reshape BEE7s
-        # The blades are arranged in 2D Torus network with 4 blades across
-        # each dimension (4x4 = 16)
+        # The blades are arranged in 2D Torus network with DIM blades across
+        # each dimension (4x4 = 16 by default)
         bee7grid = []
-        for r in range(4):
+        for r in range(DIM):
             bee7row = []
-            for c in range(4):
-                blade = bee7blades[4*r + c]
-                pp_chans = list(range(64*c,64*(c+1)))
+            for c in range(DIM):
+                blade = bee7blades[DIM*r + c]
+                pp_chans = list(range(CHANS_PER_BLADE*c,CHANS_PER_BLADE*(c+1)))
                 for i in range(4):
-                    Topology_2D_4x4_Torus.config_bitstream(
-                        blade.fpgas[i], app_settings, pp_chans, pp_chans[i*16:(i+1)*16], 256, (r==c))
+                    cls.config_bitstream(
+                        blade.fpgas[i], app_settings, pp_chans, pp_chans[i*16:(i+1)*16], CHANS_PER_BLADE*DIM, (r==c))
                 bee7row.append(blade)
             bee7grid.append(bee7row)
 
         # USRP-Bee7 Connections
         # Blades across the diagonal are connected to USRPs
-        for b in range(4):
+        for b in range(DIM):
             for u in range(USRPS_PER_BLADE):
                 sim_core.connect_bidir(
                     usrps[USRPS_PER_BLADE*b + u], 0, bee7grid[b][b],
-                    len(hw.Bee7Fpga.EXT_IO_LANES)*(u/8) + hw.Bee7Fpga.BP_BASE+(u%8), 'SAMP')
+                    len(hw.Bee7Fpga.EXT_IO_LANES)*(u//8) + hw.Bee7Fpga.BP_BASE+(u%8), 'SAMP')
             sim_core.connect_bidir(
                 hosts[b], 0, bee7grid[b][b], hw.Bee7Fpga.FP_BASE+8, 'CONFIG', ['blue','blue'])
 
         # Bee7-Bee7 Connections
         null_srcs = []
-        for r in range(4):      # Traverse across row
-            for c in range(4):  # Traverse across col
+        for r in range(DIM):      # Traverse across row
+            for c in range(DIM):  # Traverse across col
                 for f in range(4):
                     samp_in_base = len(hw.Bee7Fpga.EXT_IO_LANES)*f + hw.Bee7Fpga.BP_BASE
                     samp_out_base = len(hw.Bee7Fpga.EXT_IO_LANES)*f + hw.Bee7Fpga.BP_BASE+8
@@ -319,18 +439,64 @@ class Topology_2D_4x4_Torus:
                     pp_out_base = len(hw.Bee7Fpga.EXT_IO_LANES)*f + hw.Bee7Fpga.FP_BASE+8
                     if r != c:
                         sim_core.connect_multi_bidir(
-                            bee7grid[r][(c+3)%4], list(range(samp_out_base,samp_out_base+8)),
+                            bee7grid[r][(c+DIM-1)%DIM], list(range(samp_out_base,samp_out_base+8)),
                             bee7grid[r][c], list(range(samp_in_base,samp_in_base+8)),
                             'SAMP_O2I', ['black','blue'])
                         sim_core.connect_multi_bidir(
                             bee7grid[r][c], list(range(pp_out_base,pp_out_base+8)),
-                            bee7grid[(r+1)%4][c], list(range(pp_in_base,pp_in_base+8)),
+                            bee7grid[(r+1)%DIM][c], list(range(pp_in_base,pp_in_base+8)),
                             'PP_O2I', ['black','blue'])
                     else:
                         for i in range(8):
-                            sim_core.connect(null_src, 0, bee7grid[(r+1)%4][c], pp_in_base + i)
+                            sim_core.connect(null_src, 0, bee7grid[(r+1)%DIM][c], pp_in_base + i)
 
 class Topology_3D_4x4_FLB:
+    """
+    3D Flattened Butterfly. X and Z are the BEE7 rows and columns and are
+    DIM_WIDTH wide (4x4 by default, see scaled). Y is the FPGA within a BEE7.
+    Each FPGA forwards samples along X and Y and partial products along Z.
+    """
+    DIM_WIDTH = 4       # Dimension size for the X and Z dimensions
+    MAX_USRPS = 4       # Max USRPs that can possibly be connected to each FPGA
+                        # (also the number of IO lanes in each link)
+    NUM_USRPS = 2       # Number of USRPs actually connected to each FPGA
+    CHANS_PER_USRP = 2  # How many radio channels does each USRP have
+
+    @classmethod
+    def scaled(cls, dim_width, num_usrps=None):
+        """
+        Returns a version of this topology with dim_width blades across the
+        X and Z dimensions and num_usrps USRPs per FPGA. The links get as many
+        IO lanes as the RTM and FMC lanes allow (up to a quad).
+        """
+        num_usrps = cls.NUM_USRPS if num_usrps is None else num_usrps
+        max_usrps = min(4, hw.Bee7Fpga.BP_LANES // max(dim_width, 1))
+        if dim_width < 2 or num_usrps < 1 or num_usrps > max_usrps:
+            raise RuntimeError('A %dx%d flattened butterfly can connect between 1 and %d USRPs per FPGA. Got %d' %
+                (dim_width, dim_width, max_usrps, num_usrps))
+        return type(cls.__name__, (cls,), {'DIM_WIDTH': dim_width, 'MAX_USRPS': max_usrps, 'NUM_USRPS': num_usrps})
+
+    @classmethod
+    def get_num_nodes(cls):
+        """
+        Returns how much hardware this topology needs as
+        (num_usrps, num_blades, num_hosts, host_ports)
+        """
+        num_fpgas = cls.DIM_WIDTH * hw.Bee7Blade.NUM_FPGAS * cls.DIM_WIDTH
+        return (num_fpgas * cls.NUM_USRPS, cls.DIM_WIDTH * cls.DIM_WIDTH,
+            cls.DIM_WIDTH, cls.DIM_WIDTH * hw.Bee7Blade.NUM_FPGAS)
+
+    @classmethod
+    def get_fpga_functions(cls):
+        """
+        Returns the functions in each FPGA image as (class, parameters)
+        """
+        return ([(PartialContribComputer, {
+                'size': hw.Bee7Blade.NUM_FPGAS*cls.DIM_WIDTH*cls.NUM_USRPS,
+                'num_dst_chans': cls.DIM_WIDTH*cls.NUM_USRPS*cls.CHANS_PER_USRP,
+                'items_per_stream': cls.CHANS_PER_USRP})] +
+            [(PartialContribCombiner, {'radix': cls.DIM_WIDTH})] * cls.NUM_USRPS)
+
     @classmethod
     def get_radio_num(cls, router_addr, radio_idx, concentration):
         """
@@ -341,12 +507,12 @@ class Topology_3D_4x4_FLB:
         - radio_idx: The local index of the radio for the current router_addr
         - concentration: Number of USRPs connected to each router
         """
-        DIM_SIZE = 4
+        DIM_SIZE = {'X':cls.DIM_WIDTH, 'Y':hw.Bee7Blade.NUM_FPGAS, 'Z':cls.DIM_WIDTH}
         multiplier = concentration
         radio_num = 0
         for dim in ['Z','Y','X']:
             radio_num += router_addr[dim] * multiplier
-            multiplier *= DIM_SIZE
+            multiplier *= DIM_SIZE[dim]
         return radio_num + radio_idx
 
     @classmethod
@@ -370,9 +536,13 @@ class Topology_3D_4x4_FLB:
         terminal_map = dict()
         # If "node_addr" is the address of the current FPGA in the (X,Y,Z) space,
         # then build a list of other addresses (neighbors) in each dimension
-        DIM_SIZE = 4
+        DIM_SIZE = {'X':cls.DIM_WIDTH, 'Y':hw.Bee7Blade.NUM_FPGAS, 'Z':cls.DIM_WIDTH}
+        LINK_LANES = cls.MAX_USRPS
+        if cls.DIM_WIDTH * LINK_LANES > min(hw.Bee7Fpga.BP_LANES, hw.Bee7Fpga.FP_LANES, len(hw.Bee7Fpga.EW_IO_LANES)):
+            raise RuntimeError('%d lanes per link do not fit in a %dx%d flattened butterfly' %
+                (LINK_LANES, cls.DIM_WIDTH, cls.DIM_WIDTH))
         for dim in ['X','Y','Z']:
-            all_addrs = list(range(DIM_SIZE))
+            all_addrs = list(range(DIM_SIZE[dim]))
             all_addrs.remove(node_addr[dim])
             router_map[dim] = dict()
             for dst in all_addrs:
@@ -386,20 +556,20 @@ class Topology_3D_4x4_FLB:
         # the USRPs, Ethernet switch ports, etc
         # All others are used for inter BEE connections over QSFP+
         terminal_map['X'] = io_base + hw.Bee7Fpga.BP_BASE
-        xdst = terminal_map['X'] + DIM_SIZE
+        xdst = terminal_map['X'] + LINK_LANES
         for dst in router_map['X']:
             router_map['X'][dst] = xdst
-            xdst += DIM_SIZE
+            xdst += LINK_LANES
 
         # ---- Z-axis ----
         # All BEE7s in the Z dimension are connected via FMC IO cards (front panel)
         # To be symmetric with the X-axis the first quad on the FMC bus is also
         # reserved (regardless of all quads being symmetric)
         terminal_map['Z'] = io_base + hw.Bee7Fpga.FP_BASE
-        zdst = terminal_map['Z'] + DIM_SIZE
+        zdst = terminal_map['Z'] + LINK_LANES
         for dst in router_map['Z']:
             router_map['Z'][dst] = zdst
-            zdst += DIM_SIZE
+            zdst += LINK_LANES
 
         # ---- Y-axis ----
         # Within a BEE7, FPGAs re connected in the Y-dimension:
@@ -416,6 +586,35 @@ class Topology_3D_4x4_FLB:
 
         return (router_map, terminal_map)
 
+    @classmethod
+    def get_coeff_lane(cls, terminal_map):
+        """
+        Returns the IO lane that receives coefficients from the host. It is
+        the first X terminal lane after the USRPs or the first Z terminal lane
+        if the USRPs use all of them.
+        """
+        if cls.NUM_USRPS < cls.MAX_USRPS:
+            return terminal_map['X'] + cls.NUM_USRPS
+        else:
+            return terminal_map['Z']
+
+    @classmethod
+    def get_portmap_lut(cls):
+        """
+        Returns the result of get_portmap() for every FPGA address as a map
+        indexed by the (X,Y,Z) tuple. The table is only computed once and the
+        maps in it must not be modified.
+        """
+        lut = cls.__dict__.get('_portmap_lut')
+        if lut is None:
+            lut = dict()
+            for x in range(cls.DIM_WIDTH):
+                for y in range(hw.Bee7Blade.NUM_FPGAS):
+                    for z in range(cls.DIM_WIDTH):
+                        lut[(x, y, z)] = cls.get_portmap({'X':x, 'Y':y, 'Z':z})
+            cls._portmap_lut = lut
+        return lut
+
     @classmethod
     def config_bitstream(cls, bee7fpga, app_settings, fpga_addr):
         """
@@ -432,15 +631,16 @@ class Topology_3D_4x4_FLB:
             raise bee7fpga.SimCompError('fpga_addr must be 3-dimensional. Got ' + str(len(fpga_addr)))
 
         # Map that stores lane indices for all neighbors of this node
-        (router_map, terminal_map) = cls.get_portmap(fpga_addr)
+        (router_map, terminal_map) = cls.get_portmap_lut()[(fpga_addr['X'], fpga_addr['Y'], fpga_addr['Z'])]
         # USRPs are connected in the X dimension (RTM) because it has SFP+ ports
         base_usrp_lane = terminal_map['X']
 
-        DIM_WIDTH = 4       # Dimension size for the 3-D network
-        MAX_USRPS = 4       # Max USRPs that can possibly be connected to each FPGA
-        NUM_USRPS = 2       # Number of USRPs actually connected to each FPGA
-        CHANS_PER_USRP = 2  # How many radio channels does each USRP have
-        ALL_CHANS = list(range(pow(DIM_WIDTH, 3) * NUM_USRPS * CHANS_PER_USRP))
+        DIM_WIDTH = cls.DIM_WIDTH
+        MAX_USRPS = cls.MAX_USRPS
+        NUM_USRPS = cls.NUM_USRPS
+        CHANS_PER_USRP = cls.CHANS_PER_USRP
+        NUM_FPGAS = hw.Bee7Blade.NUM_FPGAS
+        ALL_CHANS = list(range(DIM_WIDTH * NUM_FPGAS * DIM_WIDTH * NUM_USRPS * CHANS_PER_USRP))
 
         # Each FPGA will forward the sample stream from each USRP to all of its
         # X-axis neighbors
@@ -462,7 +662,7 @@ class Topology_3D_4x4_FLB:
 
         # Forward the X-axis aggregated sample streams to all Y-axis neighbors
         for ri in router_map['Y']:
-            for li in range(DIM_WIDTH*DIM_WIDTH):  # li = GT Lane index
+            for li in range(DIM_WIDTH*MAX_USRPS):  # li = GT Lane index
                 bee7fpga.sim_core.connect(bee7fpga.int_samp_bus[li], 0, bee7fpga.serdes_o[router_map['Y'][ri] + li], 0)
 
         # What partial products will this FPGA compute?
@@ -476,21 +676,21 @@ class Topology_3D_4x4_FLB:
 
         # Instantiate partial product computer
         bee7fpga.func_pp_comp = PartialContribComputer(
-            sim_core=bee7fpga.sim_core, name=bee7fpga.name+'/pp_computer/', size=DIM_WIDTH*DIM_WIDTH*NUM_USRPS,
+            sim_core=bee7fpga.sim_core, name=bee7fpga.name+'/pp_computer/', size=NUM_FPGAS*DIM_WIDTH*NUM_USRPS,
             dst_chans=pp_chans,
             items_per_stream=CHANS_PER_USRP, app_settings=app_settings)
         bee7fpga.add_function(bee7fpga.func_pp_comp)
 
         # Partial product computer takes inputs from all Y-axis links
-        for sg in range(DIM_WIDTH):     # sg = Group of sexdectects
+        for sg in range(NUM_FPGAS):     # sg = Group of sexdectects
             for qi in range(DIM_WIDTH):  # qi = GT Quad index
                 for li in range(NUM_USRPS):
                     func_inln = (sg * DIM_WIDTH * NUM_USRPS) + (qi * NUM_USRPS) + li
                     if sg == fpga_addr['Y']:
-                        bee7fpga.sim_core.connect(bee7fpga.int_samp_bus[(qi * DIM_WIDTH) + li], 0,
+                        bee7fpga.sim_core.connect(bee7fpga.int_samp_bus[(qi * MAX_USRPS) + li], 0,
                             bee7fpga.func_pp_comp, func_inln)
                     else:
-                        bee7fpga.sim_core.connect(bee7fpga.serdes_i[router_map['Y'][sg] + (qi * DIM_WIDTH) + li], 0,
+                        bee7fpga.sim_core.connect(bee7fpga.serdes_i[router_map['Y'][sg] + (qi * MAX_USRPS) + li], 0,
                             bee7fpga.func_pp_comp, func_inln)
 
         # Internal bus to hold aggregated partial products
@@ -527,67 +727,120 @@ class Topology_3D_4x4_FLB:
 
         # Coefficient consumer
         bee7fpga.coeff_sink = rfnocsim.Consumer(bee7fpga.sim_core, bee7fpga.name + '/coeff_sink', 10e9/8, 0.0)
-        bee7fpga.sim_core.connect(bee7fpga.serdes_i[terminal_map['X'] + NUM_USRPS], 0, bee7fpga.coeff_sink, 0)
+        bee7fpga.sim_core.connect(bee7fpga.serdes_i[cls.get_coeff_lane(terminal_map)], 0, bee7fpga.coeff_sink, 0)
 
     @classmethod
     def connect(cls, sim_core, usrps, bee7blades, hosts, app_settings):
-        NUM_USRPS = 2
+        DIM_WIDTH = cls.DIM_WIDTH
+        NUM_FPGAS = hw.Bee7Blade.NUM_FPGAS
+        MAX_USRPS = cls.MAX_USRPS
+        NUM_USRPS = cls.NUM_USRPS
+        portmap_lut = cls.get_portmap_lut()
 
         # Reshape BEE7s
         # The blades are arranged in 3D Flattened Butterfly configuration
-        # with a dimension width of 4. The X and Z dimension represent row, col
+        # with a dimension width of DIM_WIDTH. The X and Z dimension represent row, col
         # and the Y dimension represents the internal connections
         bee7grid = []
-        for r in range(4):
+        for r in range(DIM_WIDTH):
             bee7row = []
-            for c in range(4):
-                blade = bee7blades[4*r + c]
+            for c in range(DIM_WIDTH):
+                blade = bee7blades[DIM_WIDTH*r + c]
                 for f in range(blade.NUM_FPGAS):
                     cls.config_bitstream(blade.fpgas[f], app_settings, {'X':r, 'Y':f, 'Z':c})
                 bee7row.append(blade)
             bee7grid.append(bee7row)
 
+        # All connections of each kind are collected as (src, srcport, dst, dstport)
+        # arrays and made with one bulk call
         # USRP-Bee7 Connections
         # Blades across the diagonal are connected to USRPs
-        for x in range(4):
-            for y in range(4):
-                for z in range(4):
+        samp_conns = ([], [], [], [])
+        for x in range(DIM_WIDTH):
+            for y in range(NUM_FPGAS):
+                for z in range(DIM_WIDTH):
+                    (router_map, terminal_map) = portmap_lut[(x, y, z)]
                     for u in range(NUM_USRPS):
                         usrp_num = cls.get_radio_num({'X':x,'Y':y,'Z':z}, u, NUM_USRPS)
-                        (router_map, terminal_map) = cls.get_portmap({'X':x,'Y':y,'Z':z})
-                        sim_core.connect_bidir(
-                            usrps[usrp_num], 0,
-                            bee7grid[x][z], hw.Bee7Blade.io_lane(y, terminal_map['X'] + u), 'SAMP')
+                        cls.__append_conn(samp_conns, usrps[usrp_num], 0,
+                            bee7grid[x][z], hw.Bee7Blade.io_lane(y, terminal_map['X'] + u))
+        sim_core.connect_bulk_bidir(*samp_conns, render_labels='SAMP')
 
         # Bee7-Bee7 Connections
-        null_srcs = []
-        for row in range(4):
-            for col in range(4):
-                for fpga in range(4):
-                    (src_map, t) = cls.get_portmap({'X':row,'Y':fpga,'Z':col})
-                    for dst in range(4):
+        x_conns = ([], [], [], [])
+        z_conns = ([], [], [], [])
+        for row in range(DIM_WIDTH):
+            for col in range(DIM_WIDTH):
+                for fpga in range(NUM_FPGAS):
+                    (src_map, t) = portmap_lut[(row, fpga, col)]
+                    for dst in range(DIM_WIDTH):
                         if row != dst:
-                            (dst_map, t) = cls.get_portmap({'X':dst,'Y':fpga,'Z':col})
-                            sim_core.connect_multi(
-                                bee7grid[row][col],
-                                list(range(hw.Bee7Blade.io_lane(fpga, src_map['X'][dst]), hw.Bee7Blade.io_lane(fpga, src_map['X'][dst]+4))),
-                                bee7grid[dst][col],
-                                list(range(hw.Bee7Blade.io_lane(fpga, dst_map['X'][row]), hw.Bee7Blade.io_lane(fpga, dst_map['X'][row]+4))),
-                                'SAMP')
+                            (dst_map, t) = portmap_lut[(dst, fpga, col)]
+                            for li in range(MAX_USRPS):
+                                cls.__append_conn(x_conns,
+                                    bee7grid[row][col], hw.Bee7Blade.io_lane(fpga, src_map['X'][dst] + li),
+                                    bee7grid[dst][col], hw.Bee7Blade.io_lane(fpga, dst_map['X'][row] + li))
                         if col != dst:
-                            (dst_map, t) = cls.get_portmap({'X':row,'Y':fpga,'Z':dst})
-                            sim_core.connect_multi(
-                                bee7grid[row][col],
-                                list(range(hw.Bee7Blade.io_lane(fpga, src_map['Z'][dst]), hw.Bee7Blade.io_lane(fpga, src_map['Z'][dst]+4))),
-                                bee7grid[row][dst],
-                                list(range(hw.Bee7Blade.io_lane(fpga, dst_map['Z'][col]), hw.Bee7Blade.io_lane(fpga, dst_map['Z'][col]+4))),
-                                'PP', 'blue')
+                            (dst_map, t) = portmap_lut[(row, fpga, dst)]
+                            for li in range(MAX_USRPS):
+                                cls.__append_conn(z_conns,
+                                    bee7grid[row][col], hw.Bee7Blade.io_lane(fpga, src_map['Z'][dst] + li),
+                                    bee7grid[row][dst], hw.Bee7Blade.io_lane(fpga, dst_map['Z'][col] + li))
+        sim_core.connect_bulk(*x_conns, render_label='SAMP')
+        sim_core.connect_bulk(*z_conns, render_label='PP', render_color='blue')
 
         # Host connection
-        for row in range(4):
-            for col in range(4):
-                for fpga in range(4):
-                    (router_map, terminal_map) = cls.get_portmap({'X':row,'Y':row,'Z':col})
-                    sim_core.connect_bidir(
-                        hosts[row], col*4 + fpga,
-                        bee7grid[row][col], hw.Bee7Blade.io_lane(fpga, terminal_map['X'] + NUM_USRPS), 'COEFF', 'red')
+        coeff_conns = ([], [], [], [])
+        for row in range(DIM_WIDTH):
+            for col in range(DIM_WIDTH):
+                for fpga in range(NUM_FPGAS):
+                    (router_map, terminal_map) = portmap_lut[(row, fpga, col)]
+                    cls.__append_conn(coeff_conns, hosts[row], col*NUM_FPGAS + fpga,
+                        bee7grid[row][col], hw.Bee7Blade.io_lane(fpga, cls.get_coeff_lane(terminal_map)))
+        sim_core.connect_bulk_bidir(*coeff_conns, render_labels='COEFF', render_colors='red')
+
+    @staticmethod
+    def __append_conn(conns, src, srcport, dst, dstport):
+        conns[0].append(src)
+        conns[1].append(srcport)
+        conns[2].append(dst)
+        conns[3].append(dstport)
+
+def explore_design_space(topology, settings, tick_rate=100e6):
+    """
+    Design space exploration: Evaluates the DSP and BRAM usage of a
+    Bee7Fpga in topology for many application settings in one vectorized
+    pass, without building a simulation. Every FPGA runs the same image so
+    the totals apply to each one.
+    - settings: Dict with domain, samp_rate, fir_taps, fir_dly_line,
+      fft_size and max_unroll (the PartialContribComputer loop unroll
+      limit). Values can be arrays that broadcast together, e.g. from
+      np.meshgrid, and unused ones can be left out.
+    Returns a dict with the broadcast settings and arrays with the DSP and
+    BRAM_18kb totals, their utilization, whether the point is feasible (the
+    unroll limit holds) and whether it fits in the FPGA.
+    """
+    defaults = {'domain': 'time', 'fir_taps': 0, 'fir_dly_line': 0, 'fft_size': 0,
+                'max_unroll': PartialContribComputer.MAX_UNROLL_DEPTH}
+    keys = ['domain', 'samp_rate', 'fir_taps', 'fir_dly_line', 'fft_size', 'max_unroll']
+    points = dict(zip(keys, np.broadcast_arrays(
+        *[np.asarray(settings[k] if k in settings else defaults[k]) for k in keys])))
+
+    base = hw.Bee7Fpga.get_base_resources()
+    max_resources = hw.Bee7Fpga.get_max_resources()
+    shape = points['samp_rate'].shape
+    results = dict(points)
+    results['feasible'] = np.ones(shape, dtype=bool)
+    for what in ['DSP', 'BRAM_18kb']:
+        results[what] = np.full(shape, base.get(what))
+    for (func_cls, params) in topology.get_fpga_functions():
+        estimate = func_cls.estimate_design_points(points, tick_rate, **params)
+        for what in ['DSP', 'BRAM_18kb']:
+            results[what] = results[what] + estimate[what]
+        if 'feasible' in estimate:
+            results['feasible'] &= estimate['feasible']
+    results['fits'] = results['feasible'].copy()
+    for what in ['DSP', 'BRAM_18kb']:
+        results[what + '_util'] = results[what] / max_resources.get(what)
+        results['fits'] &= (results[what + '_util'] <= 1.0)
+    return results
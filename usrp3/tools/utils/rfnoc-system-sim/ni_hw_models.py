@@ -35,8 +35,8 @@ class UsrpX310(rfnocsim.SimComp):
         rfnocsim.SimComp.__init__(self, sim_core, name='USRP_%03d' % (index), ctype=rfnocsim.comptype.hardware)
         # USRP i carries data for radio 2i and 2i+1 interleaved into one stream
         self.index = index
-        items = [rfnocsim.DataStream.submatrix_gen('rx', [2*index]),
-                 rfnocsim.DataStream.submatrix_gen('rx', [2*index+1])]
+        items = [rfnocsim.StreamId('rx', [2*index]),
+                 rfnocsim.StreamId('rx', [2*index+1])]
         # Samples are 4 bytes I and Q
         latency = (self.RADIO_LATENCY + self.IO_LATENCY/2) * self.get_tick_rate()
         if app_settings['domain'] == 'frequency':
@@ -66,6 +66,9 @@ class UsrpX310(rfnocsim.SimComp):
     def connect(self, i, dest):
         self.sources[i].connect(0, dest)
 
+    def outputs(self, i):
+        return self.sources[i].outputs(0)
+
     def get_utilization(self, what):
         return 0.0
 
@@ -76,10 +79,9 @@ class UsrpX310(rfnocsim.SimComp):
         recvd = self.sinks[chan].get_items()
         idxs = []
         for i in recvd:
-            (str_id, idx) = rfnocsim.DataStream.submatrix_parse(i)
-            if str_id != 'tx':
+            if i.matrix != 'tx':
                 raise RuntimeError(self.name + ' received incorrect TX data on channel ' + str(chan))
-            idxs.append(idx[0][0])
+            idxs.append(i.coords[0][0])
         if sorted(idxs) != [self.index*2, self.index*2 + 1]:
             raise RuntimeError(self.name + ' received incorrect TX data. Got: ' + str(sorted(idxs)))
 
@@ -119,11 +121,8 @@ class Bee7Fpga(rfnocsim.SimComp):
     def __init__(self, sim_core, name):
         self.sim_core = sim_core
         rfnocsim.SimComp.__init__(self, sim_core, name, rfnocsim.comptype.hardware)
-        # Max resources from Virtex7 datasheet
-        self.max_resources = rfnocsim.HwRsrcs()
-        self.max_resources.add('DSP', 3600)
-        self.max_resources.add('BRAM_18kb', 2940)
-        self.resources = rfnocsim.HwRsrcs()
+        self.max_resources = self.get_max_resources()
+        self.resources = self.get_base_resources()
         # Each FPGA has 80 SERDES lanes
         self.max_io = 80
         self.serdes_i = dict()
@@ -133,23 +132,47 @@ class Bee7Fpga(rfnocsim.SimComp):
         io_buff_size = (self.IO_LN_BW * self.IO_LN_LATENCY) / self.ELASTIC_BUFF_FULLNESS
         # Worst case lane latency
         lane_latency = self.IO_LN_LATENCY * self.get_tick_rate()
+        lane_names = self.get_io_lane_names()
         for i in range(self.max_io):
-            self.serdes_i[i] = rfnocsim.Channel(sim_core, self.__ioln_name(i)+'/I', self.IO_LN_BW, lane_latency / 2)
-            self.serdes_o[i] = rfnocsim.Channel(sim_core, self.__ioln_name(i)+'/O', self.IO_LN_BW, lane_latency / 2)
-            self.resources.add('BRAM_18kb', 1 + math.ceil(io_buff_size / self.BRAM_BYTES))  #input buffering per lane
-            self.resources.add('BRAM_18kb', 1)                                          #output buffering per lane
-        # Other resources
-        self.resources.add('BRAM_18kb', 72)     # BPS infrastructure + microblaze
-        self.resources.add('BRAM_18kb', 128)    # 2 MIGs
+            ln_name = self.name + lane_names[i]
+            self.serdes_i[i] = rfnocsim.Channel(sim_core, ln_name+'/I', self.IO_LN_BW, lane_latency / 2,
+                fifo_depth=io_buff_size)
+            self.serdes_o[i] = rfnocsim.Channel(sim_core, ln_name+'/O', self.IO_LN_BW, lane_latency / 2,
+                fifo_depth=self.BRAM_BYTES)
 
         self.functions = dict()
 
+    @staticmethod
+    def get_max_resources():
+        # Max resources from Virtex7 datasheet
+        max_resources = rfnocsim.HwRsrcs()
+        max_resources.add('DSP', 3600)
+        max_resources.add('BRAM_18kb', 2940)
+        return max_resources
+
+    @classmethod
+    def get_base_resources(cls):
+        """
+        Resources used by the FPGA image before any functions are added
+        """
+        resources = rfnocsim.HwRsrcs()
+        io_buff_size = (cls.IO_LN_BW * cls.IO_LN_LATENCY) / cls.ELASTIC_BUFF_FULLNESS
+        resources.add('BRAM_18kb', 80 * (1 + math.ceil(io_buff_size / cls.BRAM_BYTES)))   #input buffering per lane
+        resources.add('BRAM_18kb', 80)                                                #output buffering per lane
+        # Other resources
+        resources.add('BRAM_18kb', 72)     # BPS infrastructure + microblaze
+        resources.add('BRAM_18kb', 128)    # 2 MIGs
+        return resources
+
     def inputs(self, i, bind=False):
         return self.serdes_i[i].inputs(0, bind)
 
     def connect(self, i, dest):
         self.serdes_o[i].connect(0, dest)
 
+    def outputs(self, i):
+        return self.serdes_o[i].outputs(0)
+
     def get_utilization(self, what):
         if self.max_resources.get(what) != 0:
             return self.resources.get(what) / self.max_resources.get(what)
@@ -169,15 +192,26 @@ class Bee7Fpga(rfnocsim.SimComp):
             raise RuntimeError('Function ' + self.name + ' already defined in ' + self.name)
         self.resources.merge(func.get_rsrcs())
 
-    def __ioln_name(self, i):
-        if i in self.EW_IO_LANES:
-            return '%s/SER_EW_%02d'%(self.name,i-self.EW_IO_LANES[0])
-        elif i in self.NS_IO_LANES:
-            return '%s/SER_NS_%02d'%(self.name,i-self.NS_IO_LANES[0])
-        elif i in self.XX_IO_LANES:
-            return '%s/SER_XX_%02d'%(self.name,i-self.XX_IO_LANES[0])
-        else:
-            return '%s/SER_EXT_%02d'%(self.name,i-self.EXT_IO_LANES[0])
+    @classmethod
+    def get_io_lane_names(cls):
+        """
+        Returns the name suffix of every IO lane (indexed by lane). The
+        table is only computed once.
+        """
+        names = cls.__dict__.get('_io_lane_names')
+        if names is None:
+            names = list()
+            for i in range(80):
+                if i in cls.EW_IO_LANES:
+                    names.append('/SER_EW_%02d'%(i-cls.EW_IO_LANES[0]))
+                elif i in cls.NS_IO_LANES:
+                    names.append('/SER_NS_%02d'%(i-cls.NS_IO_LANES[0]))
+                elif i in cls.XX_IO_LANES:
+                    names.append('/SER_XX_%02d'%(i-cls.XX_IO_LANES[0]))
+                else:
+                    names.append('/SER_EXT_%02d'%(i-cls.EXT_IO_LANES[0]))
+            cls._io_lane_names = names
+        return names
 
 class Bee7Blade(rfnocsim.SimComp):
     """
@@ -222,6 +256,10 @@ class Bee7Blade(rfnocsim.SimComp):
         IO_PER_FPGA = len(Bee7Fpga.EXT_IO_LANES)
         self.fpgas[int(i/IO_PER_FPGA)].connect(Bee7Fpga.EXT_IO_LANES[i%IO_PER_FPGA], dest)
 
+    def outputs(self, i):
+        IO_PER_FPGA = len(Bee7Fpga.EXT_IO_LANES)
+        return self.fpgas[int(i/IO_PER_FPGA)].outputs(Bee7Fpga.EXT_IO_LANES[i%IO_PER_FPGA])
+
     @staticmethod
     def io_lane(fpga, fpga_lane):
         IO_PER_FPGA = len(Bee7Fpga.EXT_IO_LANES)
@@ -254,6 +292,9 @@ class ManagementHostandSwitch(rfnocsim.SimComp):
     def connect(self, i, dest):
         self.sources[i].connect(0, dest)
 
+    def outputs(self, i):
+        return self.sources[i].outputs(0)
+
     def get_utilization(self, what):
         return 0.0
 
@@ -16,14 +16,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import array
+import ast
+import bisect
 import collections
-import copy
+import collections.abc
+import csv
+import heapq
+import itertools
+import multiprocessing
+import operator
+import os
+import pickle
+import queue
 import re
 import math
+import types
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mticker
-from graphviz import Digraph
+# matplotlib and graphviz are only imported when something is rendered
+# so that headless simulations don't pay for (or depend on) them
 
 #------------------------------------------------------------
 # Simulator Core Components
@@ -39,30 +50,334 @@ class comptype():
     hardware = 'Hardware'
     other    = 'Other'
 
+class ByteCounterDb():
+    """
+    Columnar byte counter storage:
+    Holds the byte counters and bandwidths of all components of
+    a given type in NumPy arrays so that the utilization of any set
+    of components can be computed with a single array expression.
+    """
+
+    # Counter slots are allocated in batches of at least this size
+    MIN_BATCH = 1024
+
+    def __init__(self):
+        # The bandwidths are only needed as an array to compute utilizations
+        self.__bw_list = list()
+        self.__bw = None
+        self.__bytes = np.zeros(self.MIN_BATCH)
+
+    def allocate(self, bw):
+        slot = len(self.__bw_list)
+        if slot == len(self.__bytes):
+            self.__bytes = np.concatenate((self.__bytes, np.zeros(slot)))
+        self.__bw_list.append(bw)
+        return slot
+
+    def add(self, slot, nbytes):
+        self.__bytes[slot] += nbytes
+
+    def get_bytes(self, slot):
+        return float(self.__bytes[slot])
+
+    def get_bw(self, slot):
+        return float(self.__bw_list[slot])
+
+    def get_utilization(self, slots, elapsed_s):
+        if elapsed_s <= 0:
+            raise RuntimeError('Utilization is undefined before the simulation has run')
+        if self.__bw is None or len(self.__bw) != len(self.__bw_list):
+            self.__bw = np.array(self.__bw_list, dtype=np.float64)
+        return (self.__bytes[slots] / elapsed_s) / self.__bw[slots]
+
+    def get_byte_counts(self):
+        return self.__bytes[:len(self.__bw_list)].copy()
+
+    def set_byte_counts(self, byte_counts):
+        self.__bytes[:len(self.__bw_list)] = byte_counts
+
+class Telemetry():
+    """
+    Time-series telemetry:
+    Samples the throughput, backpressure and queue occupancy of a set of
+    components every interval_ticks into preallocated ring buffers
+    (one row per sample, one column per component). Only the last depth
+    samples are retained.
+    """
+    METRICS = ['throughput', 'backpressure', 'queue']
+
+    def __init__(self, comps, interval_ticks, depth, tick_rate):
+        self.__comps = list(comps)
+        self.__interval = int(interval_ticks)
+        self.__depth = int(depth)
+        self.__tick_rate = tick_rate
+        if self.__interval < 1 or self.__depth < 1:
+            raise RuntimeError('Telemetry interval and depth must be at least 1')
+        self.__ticks = np.zeros(self.__depth, dtype=np.int64)
+        self.__series = dict((m, np.zeros((self.__depth, len(self.__comps))))
+            for m in self.METRICS)
+        self.__active = np.arange(len(self.__comps))
+        self.__last = self.__read_counters()[0:2]
+        self.__num_samples = 0
+        self.next_ticks = self.__interval
+
+    def get_names(self):
+        return [c.name for c in self.__comps]
+
+    def restrict(self, names):
+        """
+        Only sample the components called names. The others read as zero.
+        """
+        self.__active = np.array([i for (i, c) in enumerate(self.__comps) if c.name in names],
+            dtype=np.intp)
+
+    def __read_counters(self):
+        # One row per value returned by SimComp.get_telemetry()
+        counters = np.zeros((3, len(self.__comps)))
+        counters[:, self.__active] = np.array(
+            [self.__comps[i].get_telemetry() for i in self.__active], dtype=float).reshape(-1, 3).T
+        return counters
+
+    def sample(self, ticks):
+        """
+        Record one sample for all components. Byte and backpressure counters are
+        reported as their rate over the last interval.
+        """
+        counters = self.__read_counters()
+        row = self.__num_samples % self.__depth
+        self.__ticks[row] = ticks
+        interval_s = self.__interval / self.__tick_rate
+        self.__series['throughput'][row] = (counters[0] - self.__last[0]) / interval_s
+        self.__series['backpressure'][row] = (counters[1] - self.__last[1]) / self.__interval
+        self.__series['queue'][row] = counters[2]
+        self.__last = counters[0:2]
+        self.__num_samples += 1
+        self.next_ticks = ticks + self.__interval
+
+    def __order(self):
+        # Ring buffer rows in chronological order
+        if self.__num_samples <= self.__depth:
+            return np.arange(self.__num_samples)
+        return np.roll(np.arange(self.__depth), -(self.__num_samples % self.__depth))
+
+    def get_ticks(self):
+        return self.__ticks[self.__order()]
+
+    def get_series(self, what, name=None):
+        """
+        Returns the samples of metric "what" (see METRICS) in chronological
+        order for all components or for the component called name
+        """
+        series = self.__series[what][self.__order()]
+        if name is not None:
+            return series[:, self.get_names().index(name)]
+        return series
+
+    def get_samples(self):
+        """
+        Returns the raw (picklable) sample buffers of the sampled components
+        """
+        cols = self.__active
+        return ([self.__comps[i].name for i in cols], self.__ticks, self.__num_samples,
+            self.next_ticks, self.__last[:, cols],
+            dict((m, self.__series[m][:, cols]) for m in self.METRICS))
+
+    def merge(self, samples):
+        """
+        Take the raw sample buffers from another instance that sampled at the
+        same times. Used to merge partitioned runs.
+        """
+        (names, ticks, num_samples, next_ticks, last, series) = samples
+        col_db = dict((c.name, i) for (i, c) in enumerate(self.__comps))
+        cols = [col_db[name] for name in names]
+        self.__ticks = ticks
+        self.__num_samples = num_samples
+        self.next_ticks = next_ticks
+        self.__last[:, cols] = last
+        for m in self.METRICS:
+            self.__series[m][:, cols] = series[m]
+
+    def save(self, filename):
+        """
+        Export all samples as columnar arrays to a compressed NumPy (.npz) file.
+        Throughput is in bytes/s, backpressure is the fraction of stalled ticks
+        and queue is the occupancy in bytes.
+        """
+        np.savez_compressed(filename, names=np.array(self.get_names()),
+            ticks=self.get_ticks(), tick_rate=self.__tick_rate,
+            **dict((m, self.get_series(m)) for m in self.METRICS))
+
 class SimulatorCore:
     """
     Core simulation engine:
     This class owns all the simulation components and
     manages time and other housekeeping operations.
+
+    In the default (polling) mode, every tick-aware component is
+    ticked on every tick. In event driven mode, components schedule
+    their next activity on a priority queue and the simulator jumps
+    straight to the next scheduled event, so idle time is free.
+
+    The simulation can also be partitioned along Channel boundaries and
+    run in multiple processes (see run_partitioned).
     """
+    # Shortest partitioned run in lookahead windows
+    MIN_PARTITIONED_WINDOWS = 4
 
-    def __init__(self, tick_rate):
+    def __init__(self, tick_rate, event_driven=False):
         self.__ticks = 0
+        # Changes whenever the cached readiness of all components goes stale
+        self.__epoch = 0
         self.__tick_rate = tick_rate
+        self.__event_driven = event_driven
+        self.__event_queue = list()
+        self.__event_seq = 0
+        # Data streams in flight from another partition
+        self.__deliveries = list()
+        self.__delivery_seq = 0
+        self.__partition_ctx = None
+        self.__telemetry = None
         self.__tick_aware_comps = list()
         self.__all_comps = dict()
         self.__edge_render_db = list()
+        # Every connection as (src id, src port, dst id, dst port) for audit().
+        # New connections are recorded as a flat src, src port, dst endpoint
+        # sequence (to not create one object per connection) and are only
+        # resolved into edges when they are needed (see __get_edges()).
+        self.__edges = list()
+        self.__new_conns = list()
+        self.__location_names = list()
+        self.__location_ids = dict()
+        self.__counter_dbs = dict()
+        self.__regex_cache = dict()
+        # Component index: Sorted names per component type ('' for all types)
+        # and a cache of query results. Both are rebuilt lazily after a register.
+        self.__names_by_type = {'': list()}
+        self.__index_stale = False
+        self.__query_cache = dict()
 
     def register(self, comp, tick_aware):
-        if comp.name not in self.__all_comps:
-            self.__all_comps[comp.name] = comp
-        else:
-            raise RuntimeError('Duplicate component ' + comp.name)
+        # This runs for every component of a topology, so it only does the
+        # bookkeeping that can't be deferred (see __update_index())
+        name = comp.name
+        if name in self.__all_comps:
+            raise RuntimeError('Duplicate component ' + name)
+        self.__all_comps[name] = comp
+        loc_id = self.__location_ids.get(name)
+        if loc_id is None:
+            loc_id = self.__location_ids[name] = len(self.__location_names)
+            self.__location_names.append(name)
+        comp.id = loc_id
+        self.__index_stale = True
         if tick_aware:
             self.__tick_aware_comps.append(comp)
+            self.schedule(comp, self.__ticks + 1)
+
+    def intern_location(self, name):
+        """
+        Returns a unique integer ID for a location (hop) name. Data streams
+        only carry these IDs and names are resolved when they are displayed.
+        """
+        loc_id = self.__location_ids.get(name)
+        if loc_id is None:
+            loc_id = len(self.__location_names)
+            self.__location_ids[name] = loc_id
+            self.__location_names.append(name)
+        return loc_id
+
+    def get_location_name(self, loc_id):
+        return self.__location_names[loc_id]
+
+    def get_location_id(self, name):
+        return self.__location_ids[name]
+
+    def alloc_byte_counter(self, comp, bw):
+        """
+        Allocate a byte counter for a bandwidth limited component.
+        Returns the counter database (one per component type) and the slot
+        that the component must use to update its byte count.
+        """
+        counters = self.__counter_dbs.get(comp.type)
+        if counters is None:
+            counters = self.__counter_dbs[comp.type] = ByteCounterDb()
+        return (counters, counters.allocate(bw))
+
+    def compile_filter(self, name_filt):
+        regex = self.__regex_cache.get(name_filt)
+        if regex is None:
+            regex = re.compile(name_filt)
+            self.__regex_cache[name_filt] = regex
+        return regex
+
+    def get_utilization(self, ctype, name_filt, what):
+        """
+        Returns an array with the utilization of resource "what" for all components
+        of type ctype matching name_filt (in the order returned by list_components).
+        Bandwidth utilization is computed from the columnar byte counters
+        if all the matching components have one.
+        """
+        if what == 'bandwidth':
+            (counters, slots) = self.__get_counter_slots(ctype, name_filt)
+            if counters is not None:
+                return counters.get_utilization(slots, self.__ticks / self.__tick_rate)
+        return np.array([self.lookup(c).get_utilization(what)
+            for c in self.list_components(ctype, name_filt)])
+
+    def __get_counter_slots(self, ctype, name_filt):
+        """
+        Returns the counter database and the slots of all the components
+        returned by list_components(ctype, name_filt), or (None, None) if
+        they don't all have a byte counter in the same database
+        """
+        self.__update_index()
+        key = ('counter_slots', ctype, name_filt)
+        result = self.__query_cache.get(key)
+        if result is None:
+            counters = self.__counter_dbs.get(ctype)
+            byte_counters = [self.lookup(c).get_byte_counter() for c in self.list_components(ctype, name_filt)]
+            if counters is not None and all(bc is not None and bc[0] is counters for bc in byte_counters):
+                result = (counters, np.array([bc[1] for bc in byte_counters], dtype=np.intp))
+            else:
+                result = (None, None)
+            self.__query_cache[key] = result
+        return result
+
+    def schedule(self, comp, ticks):
+        """
+        Schedule a call to comp.tick() at the absolute tick count "ticks".
+        This is a no-op in polling mode because all tick-aware components
+        are ticked on every tick anyway.
+        """
+        if self.__event_driven:
+            # The sequence number keeps events at the same tick in FIFO
+            # order and prevents the heap from comparing components
+            heapq.heappush(self.__event_queue, (ticks, self.__event_seq, comp))
+            self.__event_seq += 1
+
+    def __connect_port(self, src, srcport, dst, dstport):
+        endpoint = dst.inputs(dstport, bind=True)
+        src.connect(srcport, endpoint)
+        self.__new_conns += (src, srcport, endpoint)
+
+    def __get_edges(self):
+        """
+        Returns the edges of all the connections made so far. The edges
+        are between the components that actually drive and receive the data.
+        """
+        if self.__new_conns:
+            conns = self.__new_conns
+            for (src, srcport, endpoint) in zip(conns[0::3], conns[1::3], conns[2::3]):
+                (src_comp, src_port) = src.outputs(srcport)
+                if isinstance(endpoint, Function.Arg):
+                    (dst_comp, dst_port) = (endpoint.get_func(), endpoint.get_num())
+                else:
+                    (dst_comp, dst_port) = (endpoint, 0)
+                self.__edges.append((src_comp.id, src_port, dst_comp.id, dst_port))
+            self.__new_conns = list()
+        return self.__edges
 
     def connect(self, src, srcport, dst, dstport, render_label=None, render_color=None):
-        src.connect(srcport, dst.inputs(dstport, bind=True))
+        self.__connect_port(src, srcport, dst, dstport)
         if render_label:
             self.__edge_render_db.append(
                 (src.name, dst.name, 1.0, render_label, render_color))
@@ -86,7 +401,7 @@ class SimulatorCore:
             raise RuntimeError(
                 'Source and destination ports should be of the same length')
         for i in range(len(srcports)):
-            src.connect(srcports[i], dst.inputs(dstports[i], bind=True))
+            self.__connect_port(src, srcports[i], dst, dstports[i])
         if render_label:
             self.__edge_render_db.append((src.name, dst.name, float(len(srcports)), render_label, render_color))
 
@@ -104,34 +419,531 @@ class SimulatorCore:
         self.connect_multi(ep1, ep1port, ep2, ep2port, render_labels[0], render_colors[0])
         self.connect_multi(ep2, ep2port, ep1, ep1port, render_labels[1], render_colors[1])
 
-    def list_components(self, comptype='', name_filt=''):
-        if not comptype:
-            return sorted([c for c in list(self.__all_comps.keys())
-                if (re.match(name_filt, self.__all_comps[c].name))])
+    def connect_bulk(self, srcs, srcports, dsts, dstports, render_label=None, render_color=None):
+        """
+        Connect srcs[n] port srcports[n] to dsts[n] port dstports[n] for all n.
+        srcs and dsts are sequences of components and the ports are sequences
+        (or NumPy arrays) of ints. Consecutive connections between the same
+        two components are rendered as one edge, like connect_multi().
+        """
+        num_conns = len(srcs)
+        if len(srcports) != num_conns or len(dsts) != num_conns or len(dstports) != num_conns:
+            raise RuntimeError(
+                'Sources, destinations and ports should be of the same length')
+        srcports = [int(p) for p in srcports]
+        dstports = [int(p) for p in dstports]
+        connect_port = self.__connect_port
+        for n in range(num_conns):
+            connect_port(srcs[n], srcports[n], dsts[n], dstports[n])
+        if render_label:
+            run_start = 0
+            for n in range(num_conns):
+                (src, dst) = (srcs[n], dsts[n])
+                if n + 1 == num_conns or srcs[n + 1] is not src or dsts[n + 1] is not dst:
+                    self.__edge_render_db.append(
+                        (src.name, dst.name, float(n + 1 - run_start), render_label, render_color))
+                    run_start = n + 1
+
+    def connect_bulk_bidir(self, ep1s, ep1ports, ep2s, ep2ports, render_labels=None, render_colors=None):
+        if render_labels:
+            if not isinstance(render_labels, (list, tuple)):
+                render_labels = [render_labels, render_labels]
+        else:
+            render_labels = [None, None]
+        if render_colors:
+            if not isinstance(render_colors, (list, tuple)):
+                render_colors = [render_colors, render_colors]
         else:
-            return sorted([c for c in list(self.__all_comps.keys())
-                if (self.__all_comps[c].type == comptype and
-                    re.match(name_filt, self.__all_comps[c].name))])
+            render_colors = [None, None]
+        self.connect_bulk(ep1s, ep1ports, ep2s, ep2ports, render_labels[0], render_colors[0])
+        self.connect_bulk(ep2s, ep2ports, ep1s, ep1ports, render_labels[1], render_colors[1])
+
+    @staticmethod
+    def __literal_prefix(name_filt):
+        """
+        Returns the literal string that all names matching the regex name_filt
+        must start with. Used to narrow down searches in the sorted name index.
+        """
+        if '|' in name_filt:
+            return ''
+        prefix = ''
+        for ch in name_filt:
+            if ch in '.^$*+?{}[]()\\':
+                # A quantifier makes the preceding character optional
+                if ch in '*?{':
+                    prefix = prefix[:-1]
+                break
+            prefix += ch
+        return prefix
+
+    def __update_index(self):
+        """
+        Rebuild the component index (and drop all cached queries) if any
+        components were registered since it was last built
+        """
+        if self.__index_stale:
+            names_by_type = {'': sorted(self.__all_comps)}
+            for name in names_by_type['']:
+                names = names_by_type.get(self.__all_comps[name].type)
+                if names is None:
+                    names = names_by_type[self.__all_comps[name].type] = list()
+                names.append(name)
+            self.__names_by_type = names_by_type
+            self.__query_cache = dict()
+            self.__index_stale = False
+
+    def list_components(self, comptype='', name_filt=''):
+        self.__update_index()
+        key = (comptype, name_filt)
+        comps = self.__query_cache.get(key)
+        if comps is None:
+            names = self.__names_by_type.get(comptype, [])
+            regex = self.compile_filter(name_filt)
+            prefix = self.__literal_prefix(name_filt)
+            comps = list()
+            for i in range(bisect.bisect_left(names, prefix), len(names)):
+                if not names[i].startswith(prefix):
+                    break
+                if regex.match(names[i]):
+                    comps.append(names[i])
+            self.__query_cache[key] = comps
+        return list(comps)
 
     def lookup(self, comp_name):
         return self.__all_comps[comp_name]
 
+    def get_connections(self):
+        """
+        Returns every connection made with connect*() as a
+        (src name, src port, dst name, dst port) tuple
+        """
+        return [(self.__location_names[src], srcport, self.__location_names[dst], dstport)
+            for (src, srcport, dst, dstport) in self.__get_edges()]
+
+    def audit(self):
+        """
+        Checks the connections made with connect*() across the whole graph
+        without running the simulation. Returns a dict with:
+        - undriven_inputs: (component, input) pairs that nothing drives
+        - unused_outputs: (component, output) pairs that drive nothing. The
+          output is None for components that can have any number of outputs.
+        - unconnected: Components with data ports but no connections at all
+        - unreachable_consumers: Consumers that no Producer can get data to.
+          A Function only produces data once all of its inputs are reachable.
+        - cycles: Lists of components that form a loop
+        Components are referred to by name. Runs in linear time.
+        """
+        comps = [self.__all_comps[name] for name in self.list_components()]
+        index = dict((comps[i].id, i) for i in range(len(comps)))
+        ports = [c.get_ports() for c in comps]
+        succ = [list() for c in comps]
+        driven = [set() for c in comps]
+        used = [set() for c in comps]
+        for (src, srcport, dst, dstport) in self.__get_edges():
+            (si, di) = (index[src], index[dst])
+            succ[si].append((di, dstport))
+            used[si].add(srcport)
+            driven[di].add(dstport)
+
+        undriven_inputs = list()
+        unused_outputs = list()
+        unconnected = list()
+        for i in range(len(comps)):
+            (num_in, num_out) = ports[i]
+            for p in range(num_in):
+                if p not in driven[i]:
+                    undriven_inputs.append((comps[i].name, p))
+            if num_out is None:
+                if not used[i]:
+                    unused_outputs.append((comps[i].name, None))
+            else:
+                for p in range(num_out):
+                    if p not in used[i]:
+                        unused_outputs.append((comps[i].name, p))
+            if ports[i] != (0, 0) and not driven[i] and not used[i]:
+                unconnected.append(comps[i].name)
+
+        # Propagate reachability from all producers
+        reached = [c.type == comptype.producer for c in comps]
+        reached_args = dict()
+        stack = [i for i in range(len(comps)) if reached[i]]
+        while stack:
+            for (j, port) in succ[stack.pop()]:
+                if reached[j]:
+                    continue
+                if comps[j].type == comptype.function:
+                    args = reached_args.setdefault(j, set())
+                    args.add(port)
+                    if len(args) < ports[j][0]:
+                        continue
+                reached[j] = True
+                stack.append(j)
+        unreachable_consumers = [comps[i].name for i in range(len(comps))
+            if comps[i].type == comptype.consumer and not reached[i]]
+
+        cycles = [sorted(comps[i].name for i in scc) for scc in self.__find_cycles(succ)]
+        return {
+            'undriven_inputs': undriven_inputs,
+            'unused_outputs': unused_outputs,
+            'unconnected': unconnected,
+            'unreachable_consumers': unreachable_consumers,
+            'cycles': sorted(cycles)}
+
+    @staticmethod
+    def __find_cycles(succ):
+        """
+        Returns the strongly connected components of the graph that contain
+        a cycle (Tarjan's algorithm without recursion).
+        """
+        order = [-1] * len(succ)
+        lowlink = [0] * len(succ)
+        on_stack = [False] * len(succ)
+        stack = list()
+        cycles = list()
+        count = 0
+        for root in range(len(succ)):
+            if order[root] >= 0:
+                continue
+            order[root] = lowlink[root] = count
+            count += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, iter(succ[root]))]
+            while work:
+                (v, edges) = work[-1]
+                descended = False
+                for (w, port) in edges:
+                    if order[w] < 0:
+                        order[w] = lowlink[w] = count
+                        count += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, iter(succ[w])))
+                        descended = True
+                        break
+                    elif on_stack[w]:
+                        lowlink[v] = min(lowlink[v], order[w])
+                if descended:
+                    continue
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    lowlink[u] = min(lowlink[u], lowlink[v])
+                if lowlink[v] == order[v]:
+                    scc = list()
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        scc.append(w)
+                        if w == v:
+                            break
+                    if len(scc) > 1 or any(w == v for (w, port) in succ[v]):
+                        cycles.append(scc)
+        return cycles
+
+    def enable_telemetry(self, interval_ticks, depth=256, name_filt='.*'):
+        """
+        Sample the Producers, Channels, Consumers and Functions matching
+        name_filt every interval_ticks and keep the last depth samples.
+        Returns the Telemetry object. The buffers take 24 bytes per sample
+        per component, so narrow down name_filt for deep histories.
+        """
+        comps = list()
+        for ctype in [comptype.producer, comptype.channel, comptype.consumer, comptype.function]:
+            comps += [self.lookup(c) for c in self.list_components(ctype, name_filt)]
+        self.__telemetry = Telemetry(comps, interval_ticks, depth, self.__tick_rate)
+        self.__telemetry.next_ticks = self.__ticks + interval_ticks
+        return self.__telemetry
+
+    def get_telemetry(self):
+        return self.__telemetry
+
     def tick(self):
         self.__ticks += 1
+        self.__epoch += 1
+        self.__deliver_remote()
         for c in self.__tick_aware_comps:
             c.tick()
+        if self.__telemetry and self.__ticks >= self.__telemetry.next_ticks:
+            self.__telemetry.sample(self.__ticks)
 
     def run(self, time_s):
-        for i in range(int(time_s * self.__tick_rate)):
-            self.tick()
+        self.__advance(self.__ticks + int(time_s * self.__tick_rate))
+
+    def __advance(self, end_ticks):
+        # Components may have been reconfigured since the last run
+        self.__epoch += 1
+        if self.__event_driven:
+            while True:
+                next_ticks = end_ticks + 1
+                if self.__event_queue:
+                    next_ticks = min(next_ticks, self.__event_queue[0][0])
+                if self.__deliveries:
+                    next_ticks = min(next_ticks, self.__deliveries[0][0])
+                if self.__telemetry:
+                    next_ticks = min(next_ticks, self.__telemetry.next_ticks)
+                if next_ticks > end_ticks:
+                    break
+                self.__ticks = next_ticks
+                self.__epoch += 1
+                self.__deliver_remote()
+                while self.__event_queue and self.__event_queue[0][0] <= next_ticks:
+                    (ticks, seq, comp) = heapq.heappop(self.__event_queue)
+                    comp.tick()
+                if self.__telemetry and next_ticks >= self.__telemetry.next_ticks:
+                    self.__telemetry.sample(next_ticks)
+            self.__ticks = end_ticks
+        else:
+            while self.__ticks < end_ticks:
+                self.tick()
+
+    #------------------------------------------------------------
+    # Partitioned (multi-process) simulation
+    #------------------------------------------------------------
+    def run_partitioned(self, time_s, partition_fn, num_procs):
+        """
+        Run the simulation for time_s in num_procs processes. This is a conservative
+        parallel discrete event simulation:
+        - partition_fn(name) returns the partition index for a component or None.
+          Components without a partition join the partition of a neighbor.
+        - Partitions may only be connected through Channels. The smallest latency of
+          all Channels that cross partitions is the lookahead. Each process runs
+          independently for one lookahead window and then exchanges the data that
+          crossed partitions with all the other processes.
+        - A Channel that crosses partitions delivers its data after the lookahead
+          (in simulated time) instead of instantly. It is assumed to be elastically
+          buffered so it never backpressures, and Function inputs are buffered deep
+          enough to absorb the resulting skew between their inputs.
+        The results are independent of num_procs. Byte counters, consumed streams and
+        component states are merged back into this SimulatorCore. Data still in flight
+        between partitions at the end of the run is dropped.
+        Because every partition boundary on a path adds a lookahead of delay, results
+        only match a sequential run if time_s is long compared to the lookahead. Runs
+        shorter than MIN_PARTITIONED_WINDOWS lookahead windows are rejected.
+        """
+        end_ticks = self.__ticks + int(time_s * self.__tick_rate)
+        # Restored after the run (see __partition)
+        input_depths = dict((comp, comp.get_input_depth()) for comp in self.__all_comps.values()
+            if comp.type == comptype.function)
+        workers = []
+        try:
+            (comp_parts, lookahead) = self.__partition(partition_fn)
+            if lookahead is None:
+                # Partitions are independent. Run everything in one window.
+                lookahead = max(1, end_ticks - self.__ticks)
+            elif end_ticks - self.__ticks < self.MIN_PARTITIONED_WINDOWS * lookahead:
+                raise RuntimeError(('A partitioned run must be at least %d ticks long (%d lookahead ' +
+                    'windows of %d ticks). Data that crosses partitions is delayed by one window ' +
+                    'per boundary so shorter runs do not match a sequential run.') % (
+                    self.MIN_PARTITIONED_WINDOWS * lookahead, self.MIN_PARTITIONED_WINDOWS, lookahead))
+            num_parts = max(comp_parts.values()) + 1
+            num_procs = max(1, min(num_procs, num_parts))
+            init_counts = dict((t, db.get_byte_counts()) for (t, db) in self.__counter_dbs.items())
+            queues = [multiprocessing.Queue() for w in range(num_procs)]
+            results = multiprocessing.Queue()
+            for w in range(num_procs):
+                worker = multiprocessing.Process(target=self.__partition_worker,
+                    args=(w, num_procs, comp_parts, lookahead, end_ticks, queues, results))
+                worker.start()
+                workers.append(worker)
+            # Merge results from all the workers
+            if self.__event_driven:
+                self.__event_queue = list()
+            for w in range(num_procs):
+                (counts, states, events, telemetry) = self.__get_result(results, workers)
+                for (ctype, byte_counts) in counts.items():
+                    db = self.__counter_dbs[ctype]
+                    db.set_byte_counts(db.get_byte_counts() + (byte_counts - init_counts[ctype]))
+                for (name, state) in states.items():
+                    if state is not None:
+                        self.__all_comps[name].set_sim_state(state)
+                for (ticks, name) in events:
+                    self.schedule(self.__all_comps[name], ticks)
+                if telemetry:
+                    self.__telemetry.merge(telemetry)
+        except BaseException:
+            for worker in workers:
+                worker.terminate()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            # Later runs in this process are not partitioned
+            for comp in self.__all_comps.values():
+                if comp.type == comptype.channel:
+                    comp.set_remote_dests(dict(), 0)
+            for (comp, depth) in input_depths.items():
+                comp.set_input_depth(depth)
+        self.__deliveries = list()
+        self.__ticks = end_ticks
+
+    @staticmethod
+    def __get_result(results, workers):
+        # Don't wait forever if a worker died (e.g. it ran out of memory)
+        while True:
+            try:
+                return results.get(timeout=1.0)
+            except queue.Empty:
+                for worker in workers:
+                    if worker.exitcode not in (None, 0):
+                        raise RuntimeError('Partition worker exited with code ' + str(worker.exitcode))
+
+    def __partition(self, partition_fn):
+        """
+        Assign every component to a partition and mark all Channels that cross
+        partitions. Returns the partition map and the lookahead (in ticks) which
+        is None if no Channel crosses partitions.
+        """
+        # Undirected adjacency between components
+        neighbors = dict((name, list()) for name in self.__all_comps)
+        for (name, comp) in self.__all_comps.items():
+            for dest in comp.get_dests():
+                neighbors[name].append(dest.name)
+                neighbors[dest.name].append(name)
+        comp_parts = dict()
+        frontier = collections.deque()
+        for name in sorted(self.__all_comps):
+            part = partition_fn(name)
+            if part is not None:
+                comp_parts[name] = part
+                frontier.append(name)
+        if not frontier:
+            raise RuntimeError('partition_fn did not assign any component to a partition')
+        while frontier:
+            name = frontier.popleft()
+            for n in neighbors[name]:
+                if n not in comp_parts:
+                    comp_parts[n] = comp_parts[name]
+                    frontier.append(n)
+        # Isolated components (e.g. hardware containers) have no activity
+        for name in self.__all_comps:
+            comp_parts.setdefault(name, 0)
+        # Find partition boundaries
+        boundaries = list()
+        for (name, comp) in self.__all_comps.items():
+            dests = comp.get_dests()
+            remote = dict((i, comp_parts[dests[i].name]) for i in range(len(dests))
+                if comp_parts[dests[i].name] != comp_parts[name])
+            if remote:
+                if comp.type != comptype.channel:
+                    raise RuntimeError('Partitions can only be split along Channels. ' +
+                        name + ' drives a component in another partition.')
+                boundaries.append((comp, remote))
+        if not boundaries:
+            return (comp_parts, None)
+        lookahead = int(min([comp.get_latency() for (comp, remote) in boundaries]))
+        if lookahead < 1:
+            raise RuntimeError('Channels that cross partitions must have a latency of at least one tick')
+        for (comp, remote) in boundaries:
+            comp.set_remote_dests(remote, lookahead)
+        # Function inputs must be able to absorb the skew between local and remote data
+        for comp in self.__all_comps.values():
+            if comp.type == comptype.function:
+                comp.set_input_depth(lookahead + 1)
+        return (comp_parts, lookahead)
+
+    def __partition_worker(self, worker, num_workers, comp_parts, lookahead, end_ticks, queues, results):
+        """
+        Process entry point for run_partitioned. Simulates all the partitions
+        assigned to this worker.
+        """
+        def owner(part):
+            return part % num_workers
+        # Only tick components that belong to this worker
+        owned = lambda comp: owner(comp_parts[comp.name]) == worker
+        self.__tick_aware_comps = [c for c in self.__tick_aware_comps if owned(c)]
+        self.__event_queue = [e for e in self.__event_queue if owned(e[2])]
+        heapq.heapify(self.__event_queue)
+        self.__partition_ctx = (worker, owner, [list() for w in range(num_workers)])
+        if self.__telemetry:
+            self.__telemetry.restrict(set(name for name in comp_parts
+                if owner(comp_parts[name]) == worker))
+        window = 0
+        received = collections.Counter()
+        while self.__ticks < end_ticks:
+            self.__advance(min(self.__ticks + lookahead, end_ticks))
+            # Exchange data that crossed partitions in this window. Data from a
+            # window is never due before the start of the next window.
+            outbox = self.__partition_ctx[2]
+            for w in range(num_workers):
+                if w != worker:
+                    queues[w].put((window, outbox[w]))
+                    outbox[w] = list()
+            while received[window] < num_workers - 1:
+                (msg_window, msgs) = queues[worker].get()
+                received[msg_window] += 1
+                for (ticks, name, dest_idx, data) in msgs:
+                    self.__schedule_delivery(ticks, name, dest_idx, data)
+            del received[window]
+            window += 1
+        counts = dict((t, db.get_byte_counts()) for (t, db) in self.__counter_dbs.items())
+        states = dict((name, comp.get_sim_state()) for (name, comp) in self.__all_comps.items()
+            if owned(comp))
+        events = [(e[0], e[2].name) for e in self.__event_queue]
+        telemetry = self.__telemetry.get_samples() if self.__telemetry else None
+        results.put((counts, states, events, telemetry))
+
+    def send_remote(self, comp, dest_idx, dest_part, data, ticks):
+        """
+        Send data from comp to its destination dest_idx in another partition
+        to be delivered at the absolute tick count "ticks"
+        """
+        (worker, owner, outbox) = self.__partition_ctx
+        if owner(dest_part) == worker:
+            self.__schedule_delivery(ticks, comp.name, dest_idx, data)
+        else:
+            outbox[owner(dest_part)].append((ticks, comp.name, dest_idx, data))
+
+    def __schedule_delivery(self, ticks, name, dest_idx, data):
+        heapq.heappush(self.__deliveries, (ticks, self.__delivery_seq, name, dest_idx, data))
+        self.__delivery_seq += 1
+
+    def __deliver_remote(self):
+        while self.__deliveries and self.__deliveries[0][0] <= self.__ticks:
+            (ticks, seq, name, dest_idx, data) = heapq.heappop(self.__deliveries)
+            self.__all_comps[name].deliver(dest_idx, data)
 
     def get_ticks(self):
         return self.__ticks
 
+    def get_epoch(self):
+        return self.__epoch
+
     def get_tick_rate(self):
         return self.__tick_rate
 
+    def save_checkpoint(self, filename):
+        """
+        Snapshot the full simulation state (components, bindings, counters,
+        pending events and ticks) to a file. load_checkpoint() returns a
+        SimulatorCore that continues from this exact state.
+        """
+        # Only the resolved edges are saved (see __restore_upstream())
+        self.__get_edges()
+        with open(filename, 'wb') as ckpt_file:
+            pickle.dump(self, ckpt_file, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load_checkpoint(filename):
+        with open(filename, 'rb') as ckpt_file:
+            sim_core = pickle.load(ckpt_file)
+        if not isinstance(sim_core, SimulatorCore):
+            raise RuntimeError('Not a simulator checkpoint: ' + filename)
+        sim_core.__restore_upstream()
+        return sim_core
+
+    def __restore_upstream(self):
+        # Upstream links are not pickled (they make the object graph too
+        # deep to serialize) so rebuild them from the connection list
+        for (src, srcport, dst, dstport) in self.__edges:
+            src_comp = self.__all_comps[self.__location_names[src]]
+            dst_comp = self.__all_comps[self.__location_names[dst]]
+            if isinstance(dst_comp, Function):
+                dst_comp = dst_comp.inputs(dstport)
+            dst_comp.add_upstream(src_comp)
+
     def network_to_dot(self):
+        from graphviz import Digraph
         dot = Digraph(comment='RFNoC Network Topology')
         node_ids = dict()
         next_node_id = 1
@@ -157,19 +969,161 @@ class SimComp:
     Base simulation component:
     All components must inherit from SimComp.
     """
-
     def __init__(self, sim_core, name, ctype):
         self.__sim_core = sim_core
         self.name = name
         self.type = ctype
+        # Set by alloc_byte_counter()
+        self.__counters = None
+        self.__counter_slot = None
+        # Readiness cache and upstream components (see is_ready()). Most
+        # components have one upstream component so a list is only created
+        # for the others. All attributes are set here (even if only with a
+        # placeholder) because adding one to an instance later is slower.
+        self.__upstream = None
+        self.__more_upstream = None
+        self.__ready_epoch = None
+        self.__ready = False
         self.__sim_core.register(self, (ctype == comptype.producer))
 
+    def __getstate__(self):
+        # See SimulatorCore.load_checkpoint()
+        state = self.__dict__.copy()
+        state['_SimComp__upstream'] = None
+        state['_SimComp__more_upstream'] = None
+        state['_SimComp__ready_epoch'] = None
+        return state
+
     def get_ticks(self):
         return self.__sim_core.get_ticks()
 
     def get_tick_rate(self):
         return self.__sim_core.get_tick_rate()
 
+    def schedule(self, delay_ticks):
+        self.__sim_core.schedule(self, self.get_ticks() + delay_ticks)
+
+    def alloc_byte_counter(self, bw):
+        (self.__counters, self.__counter_slot) = self.__sim_core.alloc_byte_counter(self, bw)
+        return (self.__counters, self.__counter_slot)
+
+    def get_byte_counter(self):
+        """
+        Returns the (counter database, slot) of this component or None
+        if it does not count bytes
+        """
+        if self.__counters is None:
+            return None
+        return (self.__counters, self.__counter_slot)
+
+    def send_remote(self, dest_idx, dest_part, data, delay_ticks):
+        self.__sim_core.send_remote(self, dest_idx, dest_part, data, self.get_ticks() + delay_ticks)
+
+    def get_dests(self):
+        """
+        Returns all the components that this component pushes data to
+        """
+        return []
+
+    def add_upstream(self, comp):
+        """
+        Called by comp when it connects to this component. The readiness
+        of comp depends on the readiness of this component.
+        """
+        if self.__upstream is None:
+            self.__upstream = comp
+        elif self.__more_upstream is None:
+            self.__more_upstream = [comp]
+        else:
+            self.__more_upstream.append(comp)
+
+    def is_ready(self):
+        """
+        Can this component accept data right now? The result of check_ready()
+        is cached until the simulation time advances or invalidate_ready() is
+        called, so that components shared by many paths are only checked once.
+        """
+        epoch = self.__sim_core.get_epoch()
+        if self.__ready_epoch != epoch:
+            self.__ready = self.check_ready()
+            self.__ready_epoch = epoch
+        return self.__ready
+
+    def invalidate_ready(self):
+        """
+        Must be called when the state that check_ready() looks at changes
+        within a tick. Drops the cached readiness of this component and of
+        everything upstream of it. Components that are not cached were not
+        checked since they were last invalidated, so nothing upstream of
+        them depends on them.
+        """
+        stack = [self]
+        while stack:
+            comp = stack.pop()
+            if comp.__ready_epoch is not None:
+                comp.__ready_epoch = None
+                if comp.__upstream is not None:
+                    stack.append(comp.__upstream)
+                    if comp.__more_upstream is not None:
+                        stack.extend(comp.__more_upstream)
+
+    @staticmethod
+    def invalidate_ready_all(comps):
+        for comp in comps:
+            comp.invalidate_ready()
+
+    def get_ports(self):
+        """
+        Returns the number of (inputs, outputs) of this component.
+        None means that any number can be connected.
+        """
+        return (0, 0)
+
+    def outputs(self, i):
+        """
+        Returns the (component, port) that drives output i. Components that
+        are made up of other components return the one that drives the data.
+        """
+        return (self, i)
+
+    def solve_flow(self, in_data):
+        """
+        Static counterpart of push() used by the FlowSolver: Takes the steady
+        state stream at each input (DataStream.count is per second) and
+        returns the stream at each output (None if nothing comes out) and the
+        bytes per second that count against the bandwidth of this component.
+        """
+        return ([], 0.0)
+
+    def get_flow_utilization(self, what, byte_rate):
+        return 0.0
+
+    def get_sim_state(self):
+        """
+        Returns the (picklable) dynamic state of this component that is not
+        held by the SimulatorCore. Used to merge partitioned simulations.
+        """
+        return None
+
+    def set_sim_state(self, state):
+        pass
+
+    def get_telemetry(self):
+        """
+        Returns the counters sampled by Telemetry: (total bytes, total
+        backpressure ticks, current queue occupancy in bytes)
+        """
+        return (0.0, 0, 0.0)
+
+    def intern_location(self, name):
+        return self.__sim_core.intern_location(name)
+
+    def get_location_name(self, loc_id):
+        return self.__sim_core.get_location_name(loc_id)
+
+    def get_location_id(self, name):
+        return self.__sim_core.get_location_id(name)
+
     def SimCompError(self, msg):
         raise RuntimeError(msg + ' [' + self.name + ']')
 
@@ -216,6 +1170,105 @@ class HwRsrcs():
         else:
             self.__rsrcs = dict()
 
+class BwLimiter():
+    """
+    Bandwidth Limiter:
+    A token bucket that enforces the bandwidth of a component with a
+    finite FIFO in front of it. The FIFO drains at bw bytes/s. New data
+    is accepted as long as the FIFO is not full, and it waits behind the
+    data already in the FIFO. That wait is the queueing delay.
+    """
+    # There is one per connected channel
+    __slots__ = ('__bytes_per_tick', '__fifo_depth', '__fifo_bytes', '__last_ticks')
+
+    def __init__(self, bw, tick_rate, fifo_depth = float('inf')):
+        self.__bytes_per_tick = bw / tick_rate
+        self.__fifo_depth = fifo_depth
+        self.__fifo_bytes = 0.0
+        self.__last_ticks = 0
+
+    def __drain(self, ticks):
+        if ticks > self.__last_ticks:
+            self.__fifo_bytes = max(0.0,
+                self.__fifo_bytes - (ticks - self.__last_ticks) * self.__bytes_per_tick)
+            self.__last_ticks = ticks
+
+    def is_ready(self, ticks):
+        self.__drain(ticks)
+        return self.__fifo_bytes < self.__fifo_depth
+
+    def admit(self, ticks, num_bytes):
+        """
+        Put num_bytes into the FIFO and return the queueing delay in ticks
+        """
+        self.__drain(ticks)
+        delay = self.__fifo_bytes / self.__bytes_per_tick
+        self.__fifo_bytes += num_bytes
+        return delay
+
+    def get_fifo_bytes(self, ticks):
+        self.__drain(ticks)
+        return self.__fifo_bytes
+
+    def get_state(self):
+        return (self.__fifo_bytes, self.__last_ticks)
+
+    def set_state(self, state):
+        (self.__fifo_bytes, self.__last_ticks) = state
+
+class LatencyHistogram():
+    """
+    Latency Histogram:
+    A streaming latency distribution with bounded memory. Latencies are
+    counted in logarithmically spaced buckets, so any quantile is reported
+    with a relative error of at most "precision" regardless of how many
+    latencies were added. Only non-empty buckets are stored.
+    """
+    # Consumers keep one histogram per item and one per hop of each path
+    __slots__ = ('__log_base', '__buckets', '__zero_count', 'count', 'min', 'max', 'sum')
+
+    def __init__(self, precision = 0.01):
+        self.__log_base = math.log(1.0 + 2.0 * precision)
+        self.__buckets = dict()
+        self.__zero_count = 0
+        self.count = 0
+        self.min = float('inf')
+        self.max = 0.0
+        self.sum = 0.0
+
+    def add(self, latency, count = 1):
+        if latency > 0:
+            bucket = int(math.floor(math.log(latency) / self.__log_base))
+            self.__buckets[bucket] = self.__buckets.get(bucket, 0) + count
+        else:
+            self.__zero_count += count
+        self.count += count
+        self.min = min(self.min, latency)
+        self.max = max(self.max, latency)
+        self.sum += latency * count
+
+    def get_mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def get_quantile(self, q):
+        """
+        Returns the latency below which a fraction q of all latencies fall
+        """
+        if not self.count:
+            return 0.0
+        if q >= 1.0:
+            return self.max
+        rank = q * self.count
+        seen = self.__zero_count
+        if seen >= rank and seen > 0:
+            return 0.0
+        for bucket in sorted(self.__buckets):
+            seen += self.__buckets[bucket]
+            if seen >= rank:
+                # Geometric center of the bucket, bounded by the observed extremes
+                return min(self.max, max(self.min, math.exp((bucket + 0.5) * self.__log_base)))
+        return self.max
+
 class DataStream:
     """
     Data Stream Object:
@@ -223,53 +1276,154 @@ class DataStream:
     The simulator simulates event on the actual stream so each stream Object
     must have a unique payload (items) to disambiguate it from the rest.
     """
+    # A hop location is the integer ID of the location name interned by
+    # the SimulatorCore. Names are only resolved when they are displayed.
     HopInfo = collections.namedtuple('HopInfo', ['location', 'latency'])
+    HopInfo.__qualname__ = 'DataStream.HopInfo'    # Allows checkpoints to pickle it
+
+    class HopPath():
+        """
+        Hop locations of a path and the index of each location in it.
+        A HopPath is built once and shared by the HopDbs of all streams
+        that took the same path.
+        """
+        __slots__ = ('locations', '__index')
+
+        def __init__(self, locations):
+            self.locations = locations
+            self.__index = dict()
+            for (i, location) in enumerate(locations):
+                self.__index.setdefault(location, i)
+
+        def index(self, location):
+            """
+            Returns the index of the first hop at location (or of the last
+            hop if the path does not go through location)
+            """
+            return self.__index.get(location, len(self.locations) - 1)
 
     class HopDb():
-        def __init__(self, hops):
-            self.__hops = hops
+        """
+        Latency database for a completed path. The hop locations are kept
+        in a (shared) HopPath, so only the accumulated latency at each hop
+        when the stream arrived is kept per stream, in a flat array.
+        """
+        __slots__ = ('__path', '__latencies')
+
+        def __init__(self, path, hop_latencies, ticks):
+            self.__path = path
+            #Hop0 always has the init timestamp so it is subtracted
+            init_ticks = 2 * hop_latencies[0]
+            self.__latencies = array.array('d',
+                [ticks + (l - init_ticks) for l in itertools.accumulate(hop_latencies)])
+
+        def get_path(self):
+            return self.__path
 
         def get_src(self):
-            return self.__hops[0].location
+            return self.__path.locations[0]
 
         def get_dst(self):
-            return self.__hops[-1].location
+            return self.__path.locations[-1]
 
         def get_hops(self):
-            hoparr = []
-            for h in self.__hops:
-                hoparr.append(h.location)
-            return hoparr
-
-        def get_latency(self, ticks, location = ''):
-            latency = ticks - self.__hops[0].latency    #Hop0 always has the init timestamp
-            if (self.__hops[0].location != location):
-                for i in range(1,len(self.__hops)):
-                    latency += self.__hops[i].latency
-                    if (self.__hops[i].location == location):
-                        break
-            return latency
+            return list(self.__path.locations)
+
+        def get_latency(self, location = None):
+            return self.__latencies[self.__path.index(location)]
+
+        def get_latency_profile(self):
+            """
+            Returns an array with the accumulated latency at each hop
+            """
+            return np.array(self.__latencies, dtype=np.float64)
+
+    # Hops are stored as a chain of immutable nodes that point back to
+    # the previous hop. Streams that are forked (fanned out) or derived
+    # from a parent share the common prefix of the chain and only
+    # allocate a node for each new hop.
+    HopNode = collections.namedtuple('HopNode', ['location', 'latency', 'prev', 'depth'])
+    HopNode.__qualname__ = 'DataStream.HopNode'    # Allows checkpoints to pickle it
+
+    __slots__ = ('bpi', 'items', 'count', '__hop_tail')
 
     def __init__(self, bpi, items, count, producer=None, parent=None):
         self.bpi = bpi
-        self.items = []
-        self.items.extend(items)
+        self.items = list(items)
         self.count = count
-        self.__hops = list()
         if producer and parent:
             raise RuntimeError('Data stream cannot have both a producer and a parent stream')
         elif producer:
-            self.__hops.append(self.HopInfo(location='Gen@'+producer.name, latency=producer.get_ticks()))
+            self.__hop_tail = self.HopNode(
+                location=producer.get_gen_location(), latency=producer.get_ticks(), prev=None, depth=1)
         elif parent:
-            self.__hops.extend(parent.get_hops())
+            self.__hop_tail = parent.get_hop_tail()
         else:
             raise RuntimeError('Data stream must have a producer or a parent stream')
 
+    def fork(self):
+        """
+        Returns a copy of this stream that can be pushed to another destination.
+        The items and the hop history are shared with this stream, so forking
+        is constant time. Hops added to the fork are not seen by this stream.
+        """
+        # Slots are copied directly because copy.copy() is slow for them
+        fork = type(self).__new__(type(self))
+        fork.bpi = self.bpi
+        fork.items = self.items
+        fork.count = self.count
+        fork.__hop_tail = self.__hop_tail
+        return fork
+
     def add_hop(self, location, latency):
-        self.__hops.append(self.HopInfo(location=location, latency=latency))
+        tail = self.__hop_tail
+        self.__hop_tail = self.HopNode(
+            location=location, latency=latency, prev=tail, depth=tail.depth+1)
+
+    def get_hop_tail(self):
+        return self.__hop_tail
 
     def get_hops(self):
-        return self.__hops
+        hops = [None] * self.__hop_tail.depth
+        node = self.__hop_tail
+        while node is not None:
+            hops[node.depth-1] = self.HopInfo(location=node.location, latency=node.latency)
+            node = node.prev
+        return hops
+
+    def get_hop_db(self, ticks, paths=None):
+        """
+        Returns the HopDb of this stream if it arrives at its destination
+        at ticks. If a dict paths is given, the HopPath is looked up in it
+        (by hop locations) so that it is shared by all streams that took
+        the same path.
+        """
+        depth = self.__hop_tail.depth
+        locations = [None] * depth
+        latencies = [None] * depth
+        node = self.__hop_tail
+        while node is not None:
+            locations[node.depth-1] = node.location
+            latencies[node.depth-1] = node.latency
+            node = node.prev
+        locations = tuple(locations)
+        path = paths.get(locations) if paths is not None else None
+        if path is None:
+            path = self.HopPath(locations)
+            if paths is not None:
+                paths[locations] = path
+        return self.HopDb(path, latencies, ticks)
+
+    def get_latency(self, ticks):
+        """
+        Returns the latency of the full path taken by this stream
+        """
+        latency = ticks
+        node = self.__hop_tail
+        while node.prev is not None:
+            latency += node.latency
+            node = node.prev
+        return latency - node.latency   #Hop0 always has the init timestamp
 
     def get_bytes(self):
         return self.bpi * len(self.items) * self.count
@@ -279,22 +1433,59 @@ class DataStream:
     """
     @staticmethod
     def submatrix_gen(matrix_id, coordinates):
-        coord_arr = []
-        for c in coordinates:
-            if isinstance(c, collections.Iterable):
-                coord_arr.append('(' + (','.join(str(x) for x in c)) + ')')
-            else:
-                coord_arr.append('(' + str(c) + ')')
-        return matrix_id + '[' + ';'.join(coord_arr) + ']'
+        return str(StreamId(matrix_id, coordinates))
 
     @staticmethod
     def submatrix_parse(stream_id):
-        m = re.match('(.+)\[(.*)\]', stream_id)
-        matrix_id = m.group(1)
-        coords = []
-        for cstr in m.group(2).split(';'):
-            coords.append([int(x) for x in re.match('\((.+)\)', cstr).group(1).split(',')])
-        return (matrix_id, coords)
+        if not isinstance(stream_id, StreamId):
+            stream_id = StreamId.parse(stream_id)
+        return (stream_id.matrix, [list(c) for c in stream_id.coords])
+
+class StreamId():
+    """
+    Stream (Item) Identifier:
+    Identifies a submatrix, e.g. rx[(12)] or pp[(0,1,2);(5)], by its matrix
+    name and a tuple of integer coordinate tuples. IDs are interned when
+    they are created, so equal IDs are the same object and hashing and
+    comparing them is as cheap as for any object. The string form is only
+    built when an ID is displayed.
+    """
+    __slots__ = ('matrix', 'coords')
+    __interned = dict()
+
+    def __new__(cls, matrix, coordinates):
+        coords = tuple(tuple(c) if isinstance(c, collections.abc.Iterable) else (c,)
+            for c in coordinates)
+        key = (matrix, coords)
+        stream_id = cls.__interned.get(key)
+        if stream_id is None:
+            stream_id = object.__new__(cls)
+            stream_id.matrix = matrix
+            stream_id.coords = coords
+            cls.__interned[key] = stream_id
+        return stream_id
+
+    def __reduce__(self):
+        # Unpickled IDs are interned in the receiving process
+        return (StreamId, (self.matrix, self.coords))
+
+    def __lt__(self, other):
+        return (self.matrix, self.coords) < (other.matrix, other.coords)
+
+    def __str__(self):
+        return self.matrix + '[' + ';'.join(
+            '(' + ','.join(str(x) for x in c) + ')' for c in self.coords) + ']'
+
+    def __repr__(self):
+        return str(self)
+
+    @staticmethod
+    def parse(stream_id):
+        m = re.match(r'(.+)\[(.*)\]', stream_id)
+        if m is None:
+            raise RuntimeError('Invalid stream ID: ' + stream_id)
+        return StreamId(m.group(1), [[int(x) for x in re.match(r'\((.+)\)', cstr).group(1).split(',')]
+            for cstr in m.group(2).split(';')])
 
 #------------------------------------------------------------
 # Basic Network components
@@ -304,19 +1495,27 @@ class DataStream:
 class Producer(SimComp):
     """
     Producer Block:
-    Generates data at a constant rate
+    Generates data at a constant rate. By default, one data stream is
+    generated every tick. The push interval can be increased to generate
+    a larger stream less often, which is what makes long event driven
+    simulations cheap.
     """
 
     def __init__(self, sim_core, name, bpi, items, max_samp_rate = float('inf'), latency = 0):
         SimComp.__init__(self, sim_core, name, comptype.producer)
         self.__bpi = bpi
         self.__items = items
-        self.__bw = max_samp_rate * bpi
         self.__latency = latency
         self.__dests = list()
+        self.__samp_rate = 0
         self.__data_count = 0
-        self.__byte_count = 0
+        (self.__counters, self.__counter_slot) = self.alloc_byte_counter(max_samp_rate * bpi)
         self.__backpressure_ticks = 0
+        self.__total_backpressure_ticks = 0
+        self.__ticks_per_push = 1
+        self.__last_push_ticks = None
+        self.__gen_location = self.intern_location('Gen@' + self.name)
+        self.__bp_location = self.intern_location('BP@' + self.name)
         self.set_rate(self.get_tick_rate())
 
     def inputs(self, i, bind=False):
@@ -324,11 +1523,41 @@ class Producer(SimComp):
 
     def connect(self, i, dest):
         self.__dests.append(dest)
+        dest.add_upstream(self)
+
+    def get_gen_location(self):
+        return self.__gen_location
+
+    def get_ports(self):
+        return (0, None)
+
+    def get_dests(self):
+        return [d.get_func() if isinstance(d, Function.Arg) else d for d in self.__dests]
+
+    def get_sim_state(self):
+        return (self.__backpressure_ticks, self.__total_backpressure_ticks, self.__last_push_ticks)
+
+    def set_sim_state(self, state):
+        (self.__backpressure_ticks, self.__total_backpressure_ticks, self.__last_push_ticks) = state
+
+    def get_telemetry(self):
+        return (self.get_bytes(), self.__total_backpressure_ticks, 0.0)
 
     def set_rate(self, samp_rate):
-        self.__data_count = samp_rate / self.get_tick_rate()
+        self.__samp_rate = samp_rate
+        self.__data_count = samp_rate * self.__ticks_per_push / self.get_tick_rate()
+
+    def set_push_interval(self, ticks_per_push):
+        if ticks_per_push < 1:
+            raise self.SimCompError('Push interval must be at least one tick.')
+        self.__ticks_per_push = int(ticks_per_push)
+        self.set_rate(self.__samp_rate)
 
     def tick(self):
+        if (self.__last_push_ticks is not None and
+                (self.get_ticks() - self.__last_push_ticks) < self.__ticks_per_push):
+            self.schedule(self.__ticks_per_push - (self.get_ticks() - self.__last_push_ticks))
+            return
         if len(self.__dests) > 0:
             ready = True
             for dest in self.__dests:
@@ -337,25 +1566,45 @@ class Producer(SimComp):
                 data = DataStream(
                     bpi=self.__bpi, items=self.__items, count=self.__data_count, producer=self)
                 if self.__backpressure_ticks > 0:
-                    data.add_hop('BP@'+self.name, self.__backpressure_ticks)
-                data.add_hop(self.name, self.__latency)
+                    data.add_hop(self.__bp_location, self.__backpressure_ticks)
+                data.add_hop(self.id, self.__latency)
                 for dest in self.__dests:
-                    dest.push(copy.deepcopy(data))
-                self.__byte_count += data.get_bytes()
+                    dest.push(data.fork())
+                self.__counters.add(self.__counter_slot, data.get_bytes())
                 self.__backpressure_ticks = 0
+                self.__last_push_ticks = self.get_ticks()
+                self.schedule(self.__ticks_per_push)
             else:
+                # Retry on the next tick
                 self.__backpressure_ticks += 1
+                self.__total_backpressure_ticks += 1
+                self.schedule(1)
+        else:
+            self.schedule(self.__ticks_per_push)
+
+    def solve_flow(self, in_data):
+        if len(self.__dests) == 0:
+            return ([None], 0.0)
+        data = DataStream(bpi=self.__bpi, items=self.__items, count=self.__samp_rate, producer=self)
+        data.add_hop(self.id, self.__latency)
+        return ([data], data.get_bytes())
 
     def get_bytes(self):
-        return self.__byte_count
+        return self.__counters.get_bytes(self.__counter_slot)
 
     def get_util_attrs(self):
         return ['bandwidth']
 
     def get_utilization(self, what):
         if what in self.get_util_attrs():
-            return ((self.__byte_count / (self.get_ticks() / self.get_tick_rate())) /
-                    self.__bw)
+            return ((self.__counters.get_bytes(self.__counter_slot) /
+                    (self.get_ticks() / self.get_tick_rate())) / self.__counters.get_bw(self.__counter_slot))
+        else:
+            return 0.0
+
+    def get_flow_utilization(self, what, byte_rate):
+        if what in self.get_util_attrs():
+            return byte_rate / self.__counters.get_bw(self.__counter_slot)
         else:
             return 0.0
 
@@ -363,14 +1612,23 @@ class Producer(SimComp):
 class Consumer(SimComp):
     """
     Consumes Block:
-    Consumes data at a constant rate
+    Consumes data at a constant rate. Data that arrives faster than bw
+    queues up in a FIFO of fifo_depth bytes and backpressures the source
+    when the FIFO is full.
+    The path of the last stream received for each item is kept along with
+    a LatencyHistogram of its end-to-end latency, so that latency
+    distributions (not just the last value) can be reported. The latency
+    accumulated at every hop is histogrammed per path (not per item).
     """
 
-    def __init__(self, sim_core, name, bw = float("inf"), latency = 0):
+    def __init__(self, sim_core, name, bw = float("inf"), latency = 0, fifo_depth = float("inf")):
         SimComp.__init__(self, sim_core, name, comptype.consumer)
-        self.__byte_count = 0
+        (self.__counters, self.__counter_slot) = self.alloc_byte_counter(bw)
+        self.__limiter = BwLimiter(bw, self.get_tick_rate(), fifo_depth)
         self.__item_db = dict()
-        self.__bw = bw
+        self.__latency_stats = dict()
+        self.__paths = dict()
+        self.__path_stats = dict()
         self.__latency = latency
         self.__bound = False
 
@@ -383,36 +1641,101 @@ class Consumer(SimComp):
     def connect(self, i, dest):
         raise self.SimCompError('This is a consumer block. Cannot connect to another block.')
 
-    def is_ready(self):
-        return True #TODO: Readiness can depend on bw and byte_count
+    def get_ports(self):
+        return (1, 0)
+
+    def check_ready(self):
+        return self.__limiter.is_ready(self.get_ticks())
 
     def push(self, data):
-        data.add_hop(self.name, self.__latency)
+        queue_delay = self.__limiter.admit(self.get_ticks(), data.get_bytes())
+        if not self.__limiter.is_ready(self.get_ticks()):
+            self.invalidate_ready()
+        data.add_hop(self.id, self.__latency + queue_delay)
+        # All items in a stream took the same path so they share a HopDb
+        # and all HopDbs of a path share its hop locations
+        hop_db = data.get_hop_db(self.get_ticks(), self.__paths)
+        profile = hop_db.get_latency_profile().tolist()
+        locations = hop_db.get_path().locations
+        path_stats = self.__path_stats.get(locations)
+        if path_stats is None:
+            path_stats = self.__path_stats[locations] = [LatencyHistogram() for _ in locations]
+        for (hist, latency) in zip(path_stats, profile):
+            hist.add(latency, data.count * len(data.items))
         for item in data.items:
-            self.__item_db[item] = DataStream.HopDb(data.get_hops())
-        self.__byte_count += data.get_bytes()
+            self.__item_db[item] = hop_db
+            hist = self.__latency_stats.get(item)
+            if hist is None:
+                hist = self.__latency_stats[item] = LatencyHistogram()
+            hist.add(profile[-1], data.count)
+        self.__counters.add(self.__counter_slot, data.get_bytes())
+
+    def solve_flow(self, in_data):
+        # The consumed stream is returned so that the FlowSolver can see its path
+        data = in_data[0]
+        if data is None:
+            return ([], 0.0)
+        data.add_hop(self.id, self.__latency)
+        return ([data], data.get_bytes())
 
     def get_items(self):
         return list(self.__item_db.keys())
 
     def get_bytes(self):
-        return self.__byte_count
+        return self.__counters.get_bytes(self.__counter_slot)
 
     def get_hops(self, item):
-        return self.__item_db[item].get_hops()
+        return [self.get_location_name(h) for h in self.__item_db[item].get_hops()]
 
     def get_latency(self, item, hop=None):
+        hop_db = self.__item_db[item]
+        location = self.get_location_id(hop) if hop else hop_db.get_dst()
+        return hop_db.get_latency(location) / self.get_tick_rate()
+
+    def get_latency_profile(self, item):
+        return self.__item_db[item].get_latency_profile() / self.get_tick_rate()
+
+    def get_latency_stats(self, item, hop=None):
+        """
+        Returns the LatencyHistogram (in ticks) of the end-to-end latency of
+        item. If a hop is specified, the histogram of the latency accumulated
+        at that hop by all the items that took the same path as the last
+        stream of item is returned instead.
+        """
         if not hop:
-            hop = self.get_hops(item)[-1]
-        return self.__item_db[item].get_latency(self.get_ticks(), hop) / self.get_tick_rate()
+            return self.__latency_stats[item]
+        path = self.__item_db[item].get_path()
+        return self.__path_stats[path.locations][path.index(self.get_location_id(hop))]
+
+    def get_latency_quantiles(self, item, quantiles, hop=None):
+        hist = self.get_latency_stats(item, hop)
+        return [hist.get_quantile(q) / self.get_tick_rate() for q in quantiles]
+
+    def get_telemetry(self):
+        return (self.get_bytes(), 0, self.__limiter.get_fifo_bytes(self.get_ticks()))
+
+    def get_sim_state(self):
+        return (self.__item_db, self.__latency_stats, self.__paths, self.__path_stats,
+                self.__limiter.get_state())
+
+    def set_sim_state(self, state):
+        (self.__item_db, self.__latency_stats, self.__paths, self.__path_stats,
+         limiter_state) = state
+        self.__limiter.set_state(limiter_state)
 
     def get_util_attrs(self):
         return ['bandwidth']
 
     def get_utilization(self, what):
         if what in self.get_util_attrs():
-            return ((self.__byte_count / (self.get_ticks() / self.get_tick_rate())) /
-                    self.__bw)
+            return ((self.__counters.get_bytes(self.__counter_slot) /
+                    (self.get_ticks() / self.get_tick_rate())) / self.__counters.get_bw(self.__counter_slot))
+        else:
+            return 0.0
+
+    def get_flow_utilization(self, what, byte_rate):
+        if what in self.get_util_attrs():
+            return byte_rate / self.__counters.get_bw(self.__counter_slot)
         else:
             return 0.0
 
@@ -420,20 +1743,28 @@ class Consumer(SimComp):
 class Channel(SimComp):
     """
     A resource limited IO pipe:
-    From the data stream perspective, this is a passthrough
+    From the data stream perspective, this is a passthrough. The pipe
+    carries at most bw bytes/s. Data in excess of that queues up in a FIFO
+    of fifo_depth bytes and backpressures the source when the FIFO is full.
     """
 
-    def __init__(self, sim_core, name, bw = float("inf"), latency = 0, lossy = True):
+    def __init__(self, sim_core, name, bw = float("inf"), latency = 0, lossy = True, fifo_depth = float("inf")):
         SimComp.__init__(self, sim_core, name, comptype.channel)
-        self.__bw = bw
+        (self.__counters, self.__counter_slot) = self.alloc_byte_counter(bw)
+        self.__fifo_depth = fifo_depth
         self.__latency = latency
         self.__lossy = lossy
         self.__dests = list()
-        self.__byte_count = 0
         self.__bound = False
+        # Hardware models create many channels that never carry data so the
+        # BwLimiter is only created when it is first used (see __get_limiter())
+        self.__limiter = None
+        # Destinations in other partitions (index -> partition)
+        self.__remote_dests = dict()
+        self.__remote_delay = 0
 
     def get_bytes(self):
-        return self.__byte_count
+        return self.__counters.get_bytes(self.__counter_slot)
 
     def inputs(self, i, bind=False):
         if (i != 0):
@@ -445,6 +1776,44 @@ class Channel(SimComp):
 
     def connect(self, i, dest):
         self.__dests.append(dest)
+        dest.add_upstream(self)
+
+    def __get_limiter(self):
+        if self.__limiter is None:
+            self.__limiter = BwLimiter(self.__counters.get_bw(self.__counter_slot), self.get_tick_rate(),
+                self.__fifo_depth)
+        return self.__limiter
+
+    def get_dests(self):
+        return [d.get_func() if isinstance(d, Function.Arg) else d for d in self.__dests]
+
+    def get_latency(self):
+        return self.__latency
+
+    def get_ports(self):
+        return (1, None)
+
+    def set_remote_dests(self, remote_dests, delay_ticks):
+        """
+        Mark destinations (by index) as belonging to other partitions. Data to them
+        is sent through the SimulatorCore and arrives after delay_ticks, which is
+        deducted from the latency of this hop.
+        """
+        self.__remote_dests = remote_dests
+        self.__remote_delay = delay_ticks
+
+    def get_telemetry(self):
+        fifo_bytes = self.__limiter.get_fifo_bytes(self.get_ticks()) if self.__limiter else 0.0
+        return (self.get_bytes(), 0, fifo_bytes)
+
+    def get_sim_state(self):
+        return self.__limiter.get_state() if self.__limiter else None
+
+    def set_sim_state(self, state):
+        self.__get_limiter().set_state(state)
+
+    def deliver(self, dest_idx, data):
+        self.__dests[dest_idx].push(data)
 
     def is_connected(self):
         return len(self.__dests) > 0
@@ -452,31 +1821,57 @@ class Channel(SimComp):
     def is_bound(self):
         return self.__bound
 
-    def is_ready(self):
+    def check_ready(self):
         # If nothing is hooked up to a lossy lane, it will drop data
         if self.__lossy and not self.is_connected():
             return True
-        ready = self.is_connected()
-        for dest in self.__dests:
-            ready = ready and dest.is_ready()
+        ready = self.is_connected() and self.__get_limiter().is_ready(self.get_ticks())
+        for i in range(len(self.__dests)):
+            # Remote destinations are elastically buffered
+            if i not in self.__remote_dests:
+                ready = ready and self.__dests[i].is_ready()
         return ready
 
     def push(self, data):
         # If nothing is hooked up to a lossy lane, it will drop data
         if self.__lossy and not self.is_connected():
             return
-        data.add_hop(self.name, self.__latency)
-        for dest in self.__dests:
-            dest.push(copy.deepcopy(data))
-        self.__byte_count += data.get_bytes()
+        limiter = self.__get_limiter()
+        latency = self.__latency + limiter.admit(self.get_ticks(), data.get_bytes())
+        if not limiter.is_ready(self.get_ticks()):
+            self.invalidate_ready()
+        if self.__remote_dests:
+            remote_data = data.fork()
+            remote_data.add_hop(self.id, latency - self.__remote_delay)
+        data.add_hop(self.id, latency)
+        for i in range(len(self.__dests)):
+            if i in self.__remote_dests:
+                self.send_remote(i, self.__remote_dests[i], remote_data.fork(), self.__remote_delay)
+            else:
+                self.__dests[i].push(data.fork())
+        self.__counters.add(self.__counter_slot, data.get_bytes())
+
+    def solve_flow(self, in_data):
+        data = in_data[0]
+        if data is None or not self.is_connected():
+            return ([None], 0.0)
+        # No queueing delay in the steady state
+        data.add_hop(self.id, self.__latency)
+        return ([data], data.get_bytes())
 
     def get_util_attrs(self):
         return ['bandwidth']
 
     def get_utilization(self, what):
         if what in self.get_util_attrs():
-            return ((self.__byte_count / (self.get_ticks() / self.get_tick_rate())) /
-                    self.__bw)
+            return ((self.__counters.get_bytes(self.__counter_slot) /
+                    (self.get_ticks() / self.get_tick_rate())) / self.__counters.get_bw(self.__counter_slot))
+        else:
+            return 0.0
+
+    def get_flow_utilization(self, what, byte_rate):
+        if what in self.get_util_attrs():
+            return byte_rate / self.__counters.get_bw(self.__counter_slot)
         else:
             return 0.0
 
@@ -491,46 +1886,91 @@ class Function(SimComp):
     class Arg:
         def __init__(self, num, base_func):
             self.__num = num
-            self.__data = None
+            self.__data = collections.deque()
+            self.__depth = 1
             self.__base_func = base_func
             self.__bound = False
+            self.__upstream = list()
+
+        def __getstate__(self):
+            state = self.__dict__.copy()
+            state['_Arg__upstream'] = list()
+            return state
+
+        def add_upstream(self, comp):
+            self.__upstream.append(comp)
+            self.__base_func.add_upstream(comp)
 
         def get_num(self):
             return self.__num
 
+        def get_func(self):
+            return self.__base_func
+
+        def get_depth(self):
+            return self.__depth
+
+        def set_depth(self, depth):
+            self.__depth = depth
+            SimComp.invalidate_ready_all(self.__upstream)
+
         def is_ready(self):
-            return self.__base_func.is_ready() and not self.__data
+            if len(self.__data) >= self.__depth:
+                return False
+            # A buffered input absorbs data while the function is busy
+            return self.__depth > 1 or self.__base_func.is_ready()
+
+        def has_data(self):
+            return len(self.__data) > 0
+
+        def num_queued(self):
+            return len(self.__data)
+
+        def get_queued_bytes(self):
+            return sum(d.get_bytes() for d in self.__data)
 
         def push(self, data):
-            self.__data = data
+            self.__data.append(data)
             self.__base_func.notify(self.__num)
+            if len(self.__data) >= self.__depth:
+                # Not ready anymore
+                SimComp.invalidate_ready_all(self.__upstream)
 
         def pop(self):
             if self.__data:
-                data = self.__data
-                self.__data = None
-                return data
+                if len(self.__data) == self.__depth:
+                    # Ready again
+                    SimComp.invalidate_ready_all(self.__upstream)
+                return self.__data.popleft()
             else:
                 raise RuntimeError('Nothing to pop.')
 
+        def get_state(self):
+            return list(self.__data)
+
+        def set_state(self, state):
+            self.__data = collections.deque(state)
+
         def bind(self, bind):
             retval = self.__bound
             self.__bound = bind
             return retval
 
     Latencies = collections.namedtuple('Latencies', ['func','inarg','outarg'])
+    Latencies.__qualname__ = 'Function.Latencies'  # Allows checkpoints to pickle it
 
     def __init__(self, sim_core, name, num_in_args, num_out_args, ticks_per_exec = 1):
         SimComp.__init__(self, sim_core, name, comptype.function)
         self.__ticks_per_exec = ticks_per_exec
         self.__last_exec_ticks = 0
+        self.__bytes_out = 0.0
         self.__in_args = list()
         for i in range(num_in_args):
             self.__in_args.append(Function.Arg(i, self))
+        self.__num_args_with_data = 0
         self.__dests = list()
         for i in range(num_out_args):
             self.__dests.append(None)
-        self.__in_args_pushed = dict()
         # Resources required by this function to do its job in one tick
         self.__rsrcs = HwRsrcs()
         self.__latencies = self.Latencies(func=0, inarg=[0]*num_in_args, outarg=[0]*num_out_args)
@@ -554,8 +1994,35 @@ class Function(SimComp):
 
     def connect(self, i, dest):
         self.__dests[i] = dest
+        dest.add_upstream(self)
 
-    def is_ready(self):
+    def get_dests(self):
+        return [d.get_func() if isinstance(d, Function.Arg) else d for d in self.__dests if d]
+
+    def get_ports(self):
+        return (len(self.__in_args), len(self.__dests))
+
+    def set_input_depth(self, depth):
+        """
+        Set the number of data streams each input can buffer while waiting
+        for the other inputs
+        """
+        for arg in self.__in_args:
+            arg.set_depth(depth)
+
+    def get_input_depth(self):
+        return self.__in_args[0].get_depth() if self.__in_args else 1
+
+    def get_sim_state(self):
+        return (self.__last_exec_ticks, self.__bytes_out, [arg.get_state() for arg in self.__in_args])
+
+    def set_sim_state(self, state):
+        (self.__last_exec_ticks, self.__bytes_out, arg_states) = state
+        for i in range(len(self.__in_args)):
+            self.__in_args[i].set_state(arg_states[i])
+        self.__num_args_with_data = sum(1 for arg in self.__in_args if arg.has_data())
+
+    def check_ready(self):
         ready = len(self.__dests) > 0
         for dest in self.__dests:
             ready = ready and dest.is_ready()
@@ -566,33 +2033,52 @@ class Function(SimComp):
         return DataStream(
             bpi=bpi, items=items, count=count, parent=self.__max_latency_input)
 
+    def __exec(self, arg_data_in):
+        """
+        Call the function on one set of input streams and return the
+        output streams with the hop through this function added
+        """
+        max_in_latency = 0
+        self.__max_latency_input = None
+        for d in arg_data_in:
+            lat = d.get_latency(self.get_ticks())
+            if lat > max_in_latency:
+                max_in_latency = lat
+                self.__max_latency_input = d
+        arg_data_out = self.do_func(arg_data_in)
+        if not isinstance(arg_data_out, collections.abc.Iterable):
+            arg_data_out = [arg_data_out]
+        for i in range(len(arg_data_out)):
+            arg_data_out[i].add_hop(self.id,
+                max(self.__latencies.inarg) + self.__latencies.func + self.__latencies.outarg[i])
+        return arg_data_out
+
     def notify(self, arg_i):
-        self.__in_args_pushed[arg_i] = True
         # Wait for all input args to come in
-        if (sorted(self.__in_args_pushed.keys()) == list(range(len(self.__in_args)))):
-            # Pop data out of each input arg
-            max_in_latency = 0
-            self.__max_latency_input = None
-            arg_data_in = list()
-            for arg in self.__in_args:
-                d = arg.pop()
-                arg_data_in.append(d)
-                lat = DataStream.HopDb(d.get_hops()).get_latency(self.get_ticks())
-                if lat > max_in_latency:
-                    max_in_latency = lat
-                    self.__max_latency_input = d
-            # Call the function
-            arg_data_out = self.do_func(arg_data_in)
-            if not isinstance(arg_data_out, collections.Iterable):
-                arg_data_out = [arg_data_out]
+        if self.__in_args[arg_i].num_queued() == 1:
+            self.__num_args_with_data += 1
+        if self.__num_args_with_data == len(self.__in_args):
+            # Pop data out of each input arg and call the function
+            arg_data_in = [arg.pop() for arg in self.__in_args]
+            self.__num_args_with_data = sum(1 for arg in self.__in_args if arg.has_data())
+            arg_data_out = self.__exec(arg_data_in)
             # Update output args
             for i in range(len(arg_data_out)):
-                arg_data_out[i].add_hop(self.name,
-                    max(self.__latencies.inarg) + self.__latencies.func + self.__latencies.outarg[i])
                 self.__dests[i].push(arg_data_out[i])
+                self.__bytes_out += arg_data_out[i].get_bytes()
             # Cleanup
             self.__last_exec_ticks = self.get_ticks()
-            self.__in_args_pushed = dict()
+            self.invalidate_ready()
+
+    def solve_flow(self, in_data):
+        # The function only runs if all of its inputs get data
+        if any(d is None for d in in_data):
+            return ([None] * len(self.__dests), 0.0)
+        arg_data_out = self.__exec(in_data)
+        return (arg_data_out, sum(d.get_bytes() for d in arg_data_out))
+
+    def get_telemetry(self):
+        return (self.__bytes_out, 0, sum(arg.get_queued_bytes() for arg in self.__in_args))
 
     def get_util_attrs(self):
         return []
@@ -600,20 +2086,552 @@ class Function(SimComp):
     def get_utilization(self, what):
         return 0.0
 
+#------------------------------------------------------------
+# Topology Descriptions
+#------------------------------------------------------------
+class Topology():
+    """
+    Declarative Topology:
+    Describes the components of a simulation and how they are wired up
+    in a YAML or JSON file with the following sections (all optional):
+    - params: Named constants. Values may be expressions of earlier params.
+    - instances: A list of {name, model, count, args}. Creates "count"
+      instances of the model (a class looked up in "models") and calls it
+      as model(sim_core, **args). The index of the instance is available
+      to the args as "i". The instances are available to all following
+      expressions as a list called "name".
+    - portmaps: Named port mapping functions {name: {args, expr}} that can
+      be used in any following expression.
+    - configure: A list of {foreach, where, call, args}. Calls "call"
+      with the evaluated args for each iteration (e.g. to configure an
+      FPGA bitstream).
+    - connections: A list of bulk connection patterns {foreach, where,
+      lanes, src, src_index, src_port, dst, dst_index, dst_port, bidir,
+      label, color}. src and dst are instance names. Each iteration
+      connects src[src_index] to dst[dst_index]. Iterations over the
+      variables in "lanes" are grouped into one multi-port connection.
+    "foreach" and "lanes" map loop variables to their iteration counts and
+    "where" filters iterations. Strings are expressions of the params, models,
+    instances, portmaps, loop variables and the environment passed to build().
+    Expressions are a safe subset of Python: literals, arithmetic, comparisons,
+    conditionals, attributes, subscripts and calls to the builtins in BUILTINS,
+    the models and their methods and the portmaps. Loop variables are NumPy arrays in connection patterns, so
+    each pattern is expanded in one vectorized pass. All input port bindings
+    are validated before any connection is made.
+    """
+    SECTIONS = ['description', 'params', 'instances', 'portmaps', 'configure', 'connections']
+    BUILTINS = dict((f.__name__, f) for f in
+        [abs, bool, dict, float, int, len, list, max, min, pow, range, sum, tuple])
+
+    def __init__(self, desc, source='topology'):
+        self.source = source
+        if not isinstance(desc, dict):
+            raise RuntimeError('%s: A topology must be a map of sections' % (source))
+        for section in desc:
+            if section not in self.SECTIONS:
+                raise RuntimeError('%s: Unknown section %s' % (source, section))
+        self.__desc = desc
+        self.__code_cache = dict()
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as topo_file:
+            if os.path.splitext(filename)[1] in ['.yaml', '.yml']:
+                # PyYAML is only needed for YAML topologies
+                import yaml
+                desc = yaml.load(topo_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+            else:
+                import json
+                desc = json.load(topo_file)
+        return Topology(desc, filename)
+
+    def __compile(self, expr):
+        """
+        Parses an expression and compiles it into a function of (namespace,
+        local). Returns the function and the set of names in the expression.
+        """
+        entry = self.__code_cache.get(expr)
+        if entry is None:
+            try:
+                tree = ast.parse(expr, self.source, 'eval')
+                func = self.__compile_node(tree.body)
+            except SyntaxError as e:
+                raise RuntimeError('%s: Cannot parse "%s": %s' % (self.source, expr, str(e)))
+            names = set(n.id for n in ast.walk(tree) if isinstance(n, ast.Name))
+            entry = self.__code_cache[expr] = (func, names)
+        return entry
+
+    # Expressions are not evaluated with eval() (which cannot be sandboxed)
+    # but compiled into closures over this subset of the Python syntax
+    BIN_OPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+        ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+        ast.Pow: operator.pow, ast.BitAnd: operator.and_, ast.BitOr: operator.or_,
+        ast.BitXor: operator.xor, ast.LShift: operator.lshift, ast.RShift: operator.rshift}
+    UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Not: operator.not_,
+        ast.Invert: operator.invert}
+    CMP_OPS = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+        ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+        ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b}
+
+    def __compile_node(self, node):
+        compile_node = self.__compile_node
+        if isinstance(node, ast.Constant):
+            value = node.value
+            return lambda ns, local: value
+        elif isinstance(node, ast.Name):
+            name = node.id
+            if name.startswith('_'):
+                raise SyntaxError('Names cannot start with an underscore: ' + name)
+            builtins = self.BUILTINS
+            def load_name(ns, local):
+                if name in local:
+                    return local[name]
+                elif name in ns:
+                    return ns[name]
+                elif name in builtins:
+                    return builtins[name]
+                raise NameError('name \'%s\' is not defined' % (name))
+            return load_name
+        elif isinstance(node, ast.BinOp) and type(node.op) in self.BIN_OPS:
+            (op, left, right) = (self.BIN_OPS[type(node.op)], compile_node(node.left), compile_node(node.right))
+            return lambda ns, local: op(left(ns, local), right(ns, local))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY_OPS:
+            (op, operand) = (self.UNARY_OPS[type(node.op)], compile_node(node.operand))
+            return lambda ns, local: op(operand(ns, local))
+        elif isinstance(node, ast.Compare) and all(type(op) in self.CMP_OPS for op in node.ops):
+            ops = [self.CMP_OPS[type(op)] for op in node.ops]
+            operands = [compile_node(n) for n in [node.left] + node.comparators]
+            if len(ops) == 1:
+                (op, left, right) = (ops[0], operands[0], operands[1])
+                return lambda ns, local: op(left(ns, local), right(ns, local))
+            def compare(ns, local):
+                left = operands[0](ns, local)
+                for k in range(len(ops)):
+                    right = operands[k+1](ns, local)
+                    result = ops[k](left, right)
+                    if not result:
+                        return result
+                    left = right
+                return result
+            return compare
+        elif isinstance(node, ast.BoolOp):
+            values = [compile_node(n) for n in node.values]
+            is_and = isinstance(node.op, ast.And)
+            def bool_op(ns, local):
+                for value in values:
+                    result = value(ns, local)
+                    if bool(result) != is_and:
+                        return result
+                return result
+            return bool_op
+        elif isinstance(node, ast.IfExp):
+            (test, body, orelse) = (compile_node(node.test), compile_node(node.body), compile_node(node.orelse))
+            return lambda ns, local: body(ns, local) if test(ns, local) else orelse(ns, local)
+        elif isinstance(node, ast.Attribute):
+            if node.attr.startswith('_'):
+                raise SyntaxError('Attributes cannot start with an underscore: ' + node.attr)
+            (value, attr) = (compile_node(node.value), node.attr)
+            def load_attr(ns, local):
+                result = getattr(value(ns, local), attr)
+                if isinstance(result, types.ModuleType):
+                    raise AttributeError('Modules cannot be accessed: ' + attr)
+                return result
+            return load_attr
+        elif isinstance(node, ast.Subscript):
+            (value, index) = (compile_node(node.value), compile_node(node.slice))
+            return lambda ns, local: value(ns, local)[index(ns, local)]
+        elif isinstance(node, getattr(ast, 'Index', ())):
+            # Python < 3.9 wraps subscripts
+            return compile_node(node.value)
+        elif isinstance(node, ast.Slice):
+            none = lambda ns, local: None
+            bounds = [compile_node(n) if n is not None else none for n in [node.lower, node.upper, node.step]]
+            return lambda ns, local: slice(*[b(ns, local) for b in bounds])
+        elif isinstance(node, ast.Call):
+            if any(isinstance(n, ast.Starred) for n in node.args) or any(k.arg is None for k in node.keywords):
+                raise SyntaxError('Calls cannot unpack arguments')
+            func = compile_node(node.func)
+            args = [compile_node(n) for n in node.args]
+            kwargs = [(k.arg, compile_node(k.value)) for k in node.keywords]
+            check_callable = self.__check_callable
+            if not kwargs:
+                def call(ns, local):
+                    f = func(ns, local)
+                    check_callable(f, ns)
+                    return f(*[a(ns, local) for a in args])
+                return call
+            def call_kw(ns, local):
+                f = func(ns, local)
+                check_callable(f, ns)
+                return f(*[a(ns, local) for a in args], **dict((k, v(ns, local)) for (k, v) in kwargs))
+            return call_kw
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            elts = [compile_node(n) for n in node.elts]
+            if any(isinstance(n, ast.Starred) for n in node.elts):
+                raise SyntaxError('Sequences cannot unpack values')
+            make = list if isinstance(node, ast.List) else tuple
+            return lambda ns, local: make([e(ns, local) for e in elts])
+        elif isinstance(node, ast.Dict):
+            if any(k is None for k in node.keys):
+                raise SyntaxError('Maps cannot unpack values')
+            items = [(compile_node(k), compile_node(v)) for (k, v) in zip(node.keys, node.values)]
+            return lambda ns, local: dict((k(ns, local), v(ns, local)) for (k, v) in items)
+        raise SyntaxError('%s is not supported in topology expressions' % (type(node).__name__))
+
+    def __check_callable(self, func, namespace):
+        """
+        Only the builtins, the models and functions or methods defined in
+        Python (e.g. portmaps and model methods) can be called
+        """
+        if isinstance(func, (types.FunctionType, types.MethodType)):
+            return
+        name = getattr(func, '__name__', None)
+        if self.BUILTINS.get(name) is func or namespace.get(name) is func:
+            return
+        raise TypeError('%r cannot be called in a topology' % (func,))
+
+    def __eval(self, expr, namespace, local=None):
+        if not isinstance(expr, str):
+            return expr
+        (func, _) = self.__compile(expr)
+        try:
+            return func(namespace, local or {})
+        except RuntimeError:
+            raise
+        except Exception as e:
+            raise RuntimeError('%s: Cannot evaluate "%s": %s' % (self.source, expr, str(e)))
+
+    def __split_args(self, args, namespace, loop_names):
+        """
+        Evaluate the args that don't depend on loop variables once. Returns
+        the constant args and the expressions of all the others.
+        """
+        const_args = dict()
+        var_args = dict()
+        for (k, v) in (args or {}).items():
+            if isinstance(v, str):
+                (_, names) = self.__compile(v)
+                if names & set(loop_names):
+                    var_args[k] = v
+                    continue
+            const_args[k] = self.__eval(v, namespace)
+        return (const_args, var_args)
+
+    def __iterate(self, loops, namespace, where=None):
+        """
+        Returns a map of loop variable to a flat array of values for all
+        iterations (in nested loop order) that satisfy the "where" expression
+        """
+        names = list((loops or {}).keys())
+        shape = tuple(int(self.__eval(loops[n], namespace)) for n in names)
+        grid = np.indices(shape).reshape(len(shape), -1) if shape else np.zeros((0, 1), dtype=int)
+        loop_vars = dict((names[k], grid[k]) for k in range(len(names)))
+        if where is not None:
+            mask = np.broadcast_to(self.__eval(where, namespace, loop_vars), grid.shape[1:])
+            loop_vars = dict((n, v[mask]) for (n, v) in loop_vars.items())
+            return (loop_vars, int(np.count_nonzero(mask)))
+        return (loop_vars, grid.shape[1])
+
+    def __make_portmap(self, name, spec, namespace):
+        args = spec.get('args', [])
+        (expr, _) = self.__compile(spec['expr'])
+        def portmap(*values):
+            if len(values) != len(args):
+                raise RuntimeError('%s: Portmap %s takes %d arguments' % (self.source, name, len(args)))
+            return expr(namespace, dict(zip(args, values)))
+        return portmap
+
+    def build(self, sim_core, models, env=None):
+        """
+        Instantiate and connect everything in this topology in sim_core.
+        models maps model names to classes (or any callables). env holds
+        extra names for expressions (e.g. app_settings). Returns the namespace
+        with all the params and instance lists.
+        """
+        namespace = dict(models)
+        namespace.update(env or {})
+        for (name, value) in (self.__desc.get('params') or {}).items():
+            namespace[name] = self.__eval(value, namespace)
+        for inst in (self.__desc.get('instances') or []):
+            model = self.__eval(inst['model'], namespace)
+            (const_args, var_args) = self.__split_args(inst.get('args'), namespace, ['i'])
+            insts = list()
+            for i in range(int(self.__eval(inst.get('count', 1), namespace))):
+                kwargs = dict(const_args)
+                for (k, v) in var_args.items():
+                    kwargs[k] = self.__eval(v, namespace, {'i': i})
+                insts.append(model(sim_core, **kwargs))
+            namespace[inst['name']] = insts
+        for (name, spec) in (self.__desc.get('portmaps') or {}).items():
+            namespace[name] = self.__make_portmap(name, spec, namespace)
+        for conf in (self.__desc.get('configure') or []):
+            (loop_vars, num_iters) = self.__iterate(conf.get('foreach'), namespace, conf.get('where'))
+            func = self.__eval(conf['call'], namespace)
+            (const_args, var_args) = self.__split_args(conf.get('args'), namespace, list(loop_vars))
+            loop_values = dict((k, v.tolist()) for (k, v) in loop_vars.items())
+            for n in range(num_iters):
+                local = dict((k, v[n]) for (k, v) in loop_values.items())
+                kwargs = dict(const_args)
+                for (k, v) in var_args.items():
+                    kwargs[k] = self.__eval(v, namespace, local)
+                func(**kwargs)
+        patterns = [self.__expand_connections(conn, namespace)
+            for conn in (self.__desc.get('connections') or [])]
+        self.__validate_bindings(patterns, namespace)
+        for pattern in patterns:
+            self.__connect(sim_core, pattern, namespace)
+        return namespace
+
+    def __expand_connections(self, conn, namespace):
+        """
+        Evaluate all the indices and ports of a connection pattern as arrays.
+        Ports have one column per lane.
+        """
+        for key in ['src', 'dst']:
+            if conn.get(key) not in namespace or not isinstance(namespace[conn[key]], list):
+                raise RuntimeError('%s: Connection %s must be an instance name. Got %s' %
+                    (self.source, key, conn.get(key)))
+        (loop_vars, num_iters) = self.__iterate(conn.get('foreach'), namespace, conn.get('where'))
+        lane_names = list((conn.get('lanes') or {}).keys())
+        lane_shape = tuple(int(self.__eval(conn['lanes'][n], namespace)) for n in lane_names)
+        lane_grid = np.indices(lane_shape).reshape(len(lane_shape), -1) if lane_shape else np.zeros((0, 1), dtype=int)
+        num_lanes = lane_grid.shape[1]
+        port_vars = dict((n, v[:, np.newaxis]) for (n, v) in loop_vars.items())
+        port_vars.update(dict((lane_names[k], lane_grid[k][np.newaxis, :]) for k in range(len(lane_names))))
+        pattern = dict(conn)
+        for key in ['src', 'dst']:
+            pattern[key + '_index'] = np.broadcast_to(
+                self.__eval(conn.get(key + '_index', 0), namespace, loop_vars), (num_iters,)).astype(int)
+            pattern[key + '_port'] = np.broadcast_to(
+                self.__eval(conn.get(key + '_port', 0), namespace, port_vars), (num_iters, num_lanes)).astype(int)
+            num_insts = len(namespace[conn[key]])
+            bad = (pattern[key + '_index'] < 0) | (pattern[key + '_index'] >= num_insts)
+            if bad.any():
+                raise RuntimeError('%s: Connection %s index %d is out of range for %s (%d instances)' %
+                    (self.source, key, pattern[key + '_index'][bad][0], conn[key], num_insts))
+        return pattern
+
+    def __validate_bindings(self, patterns, namespace):
+        """
+        Every input port can only be driven once. Check all the bindings made
+        by all connection patterns at once before connecting anything.
+        """
+        inst_ids = dict()
+        bindings = list()
+        for pattern in patterns:
+            sides = [('dst', 'src')] + ([('src', 'dst')] if pattern.get('bidir') else [])
+            for (sink, source) in sides:
+                inst_id = inst_ids.setdefault(pattern[sink], len(inst_ids))
+                ports = pattern[sink + '_port']
+                # Pack (instance, index, port) into one integer key
+                bindings.append((np.int64(inst_id) << 40) +
+                    (pattern[sink + '_index'][:, np.newaxis].astype(np.int64) << 20) + ports)
+        if not bindings:
+            return
+        keys = np.sort(np.concatenate([b.ravel() for b in bindings]))
+        dups = keys[1:][keys[1:] == keys[:-1]]
+        if dups.size:
+            inst_names = dict((v, k) for (k, v) in inst_ids.items())
+            key = int(dups[0])
+            raise RuntimeError('%s: Input port %d of %s[%d] is driven more than once' %
+                (self.source, key & 0xFFFFF, inst_names[key >> 40], (key >> 20) & 0xFFFFF))
+
+    def __connect(self, sim_core, pattern, namespace):
+        srcs = namespace[pattern['src']]
+        dsts = namespace[pattern['dst']]
+        # Flatten the pattern into one (src, srcport, dst, dstport) entry per lane
+        num_lanes = pattern['src_port'].shape[1]
+        src_comps = [srcs[i] for i in pattern['src_index'].tolist() for l in range(num_lanes)]
+        dst_comps = [dsts[i] for i in pattern['dst_index'].tolist() for l in range(num_lanes)]
+        src_ports = pattern['src_port'].ravel().tolist()
+        dst_ports = pattern['dst_port'].ravel().tolist()
+        if pattern.get('bidir'):
+            sim_core.connect_bulk_bidir(src_comps, src_ports, dst_comps, dst_ports,
+                pattern.get('label'), pattern.get('color'))
+        else:
+            sim_core.connect_bulk(src_comps, src_ports, dst_comps, dst_ports,
+                pattern.get('label'), pattern.get('color'))
+
+#------------------------------------------------------------
+# Static Flow Analysis
+#------------------------------------------------------------
+class FlowSolver():
+    """
+    Static Flow Solver:
+    Computes the steady state bandwidth utilization of every component
+    and the latency of every stream without running any ticks. Each
+    connection carries one representative DataStream whose count is the
+    number of items per second, and each component maps its input streams
+    to its output streams with solve_flow() in topological order.
+    The results match the simulation when nothing is overutilized (no
+    backpressure or queueing) and all producers push at the same interval.
+    Components that are in a cycle, or only fed by one, are not solved.
+    """
+
+    def __init__(self, sim_core):
+        self.__sim_core = sim_core
+        self.__byte_rates = dict()
+        self.__latencies = dict()
+        self.__unsolved = list()
+
+    def solve(self):
+        core = self.__sim_core
+        comps = dict()
+        fanout = dict()
+        in_data = dict()
+        for name in core.list_components():
+            comp = core.lookup(name)
+            (num_in, num_out) = comp.get_ports()
+            if (num_in, num_out) != (0, 0):
+                comps[name] = comp
+                # Components with any number of outputs send the same stream to all
+                fanout[name] = num_out is None
+                in_data[name] = [None] * num_in
+        succ = dict()
+        pending = dict.fromkeys(comps, 0)
+        for (src, srcport, dst, dstport) in core.get_connections():
+            succ.setdefault(src, list()).append((srcport, dst, dstport))
+            pending[dst] += 1
+
+        self.__byte_rates = dict.fromkeys(comps, 0.0)
+        self.__latencies = dict()
+        # Undriven components are solved right away so that their outputs are known
+        ready = [name for name in comps if pending[name] == 0]
+        while ready:
+            name = ready.pop()
+            comp = comps[name]
+            (out_data, self.__byte_rates[name]) = comp.solve_flow(in_data.pop(name))
+            if comp.type == comptype.consumer:
+                latencies = self.__latencies.setdefault(name, dict())
+                for data in out_data:
+                    latency = data.get_latency(core.get_ticks())
+                    for item in data.items:
+                        latencies[item] = max(latency, latencies.get(item, latency))
+            edges = succ.get(name, [])
+            for i in range(len(edges)):
+                (srcport, dst, dstport) = edges[i]
+                data = out_data[0 if fanout[name] else srcport]
+                # Every destination adds its own hops, except for the last one
+                if data is not None and i < len(edges) - 1:
+                    data = data.fork()
+                in_data[dst][dstport] = data
+                pending[dst] -= 1
+                if pending[dst] == 0:
+                    ready.append(dst)
+        self.__unsolved = sorted(name for name in comps if pending[name] > 0)
+        return self
+
+    def get_unsolved(self):
+        return list(self.__unsolved)
+
+    def get_byte_rate(self, comp_name):
+        return self.__byte_rates[comp_name]
+
+    def get_comp_utilization(self, comp_name, what):
+        comp = self.__sim_core.lookup(comp_name)
+        if comp_name in self.__byte_rates:
+            return comp.get_flow_utilization(what, self.__byte_rates[comp_name])
+        else:
+            # Hardware resources don't depend on the traffic
+            return comp.get_utilization(what)
+
+    def get_utilization(self, ctype, name_filt, what):
+        """
+        Same as SimulatorCore.get_utilization but for the steady state
+        """
+        return np.array([self.get_comp_utilization(c, what)
+            for c in self.__sim_core.list_components(ctype, name_filt)])
+
+    def get_items(self, consumer_name):
+        return list(self.__latencies.get(consumer_name, dict()).keys())
+
+    def get_latency(self, consumer_name, item):
+        """
+        Returns the worst case latency (in seconds) of item at a consumer
+        """
+        return self.__latencies[consumer_name][item] / self.__sim_core.get_tick_rate()
+
+    def cross_check(self, rel_tol=0.01):
+        """
+        Compare the solution against the state of the simulation after it
+        was run. Returns the mismatches as (component, what, static value,
+        simulated value) tuples where "what" is a utilization attribute
+        or a consumed item (compared by latency).
+        """
+        mismatches = list()
+        def compare(name, what, static, simulated):
+            if (static is None or simulated is None or
+                    not math.isclose(static, simulated, rel_tol=rel_tol, abs_tol=1e-12)):
+                mismatches.append((name, what, static, simulated))
+        for name in self.__sim_core.list_components():
+            comp = self.__sim_core.lookup(name)
+            for what in comp.get_util_attrs():
+                compare(name, what, self.get_comp_utilization(name, what), comp.get_utilization(what))
+            if comp.type == comptype.consumer:
+                static_items = set(self.get_items(name))
+                sim_items = set(comp.get_items())
+                for item in sorted(static_items | sim_items):
+                    compare(name, item,
+                        self.get_latency(name, item) if item in static_items else None,
+                        comp.get_latency(item) if item in sim_items else None)
+        return mismatches
+
 #------------------------------------------------------------
 # Plotting Functions
 #------------------------------------------------------------
 class Visualizer():
-    def __init__(self, sim_core):
+    """
+    Plots simulation results. By default, all figures are shown interactively.
+    If an output directory is specified, the Visualizer runs in batch mode:
+    every figure is written to a file of the specified format (png, svg, etc)
+    and the raw series behind each plot are written to a CSV file next to it.
+    """
+    def __init__(self, sim_core, output_dir=None, fmt='png'):
         self.__sim_core = sim_core
+        self.__output_dir = output_dir
+        self.__fmt = fmt
+        self.__plt = None
         self.__figure = None
         self.__fig_dims = None
+        self.__fig_count = 0
+        if self.__output_dir and not os.path.isdir(self.__output_dir):
+            os.makedirs(self.__output_dir)
+
+    def __pyplot(self):
+        if self.__plt is None:
+            import matplotlib
+            if self.__output_dir:
+                # Render without a display
+                matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+            self.__plt = plt
+        return self.__plt
+
+    def __export_series(self, grid_pos, header, rows):
+        if self.__output_dir:
+            fname = os.path.join(self.__output_dir,
+                'figure_%02d_plot_%d.csv' % (self.__fig_count, grid_pos))
+            with open(fname, 'w') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(header)
+                writer.writerows(rows)
 
     def show_network(self, engine='fdp'):
         dot = self.__sim_core.network_to_dot()
-        dot.format = 'png'
+        dot.format = self.__fmt if self.__output_dir else 'png'
         dot.engine = engine
-        dot.render('/tmp/rfnoc_sim.dot', view=True, cleanup=True)
+        if self.__output_dir:
+            # Keep the graph source around as the raw data for the image. The
+            # source is saved first so that a batch run can go on without the
+            # Graphviz executables.
+            import graphviz
+            filepath = dot.save(os.path.join(self.__output_dir, 'network.dot'))
+            try:
+                dot.render(filepath, view=False, cleanup=False)
+            except (graphviz.ExecutableNotFound, graphviz.CalledProcessError) as e:
+                print('[WARN] Could not render %s (%s)' % (filepath, e))
+        else:
+            dot.render('/tmp/rfnoc_sim.dot', view=True, cleanup=True)
 
     def dump_consumed_streams(self, consumer_filt='.*'):
         comps = self.__sim_core.list_components(comptype.consumer, consumer_filt)
@@ -627,33 +2645,53 @@ class Visualizer():
         print('=================================================================')
 
     def dump_debug_audit_log(self, ctype, name_filt='.*'):
-        if ctype != comptype.channel:
-            raise NotImplementedError('Component type not yet supported: ' + ctype)
+        audit = self.__sim_core.audit()
+        undriven = set(c for (c, port) in audit['undriven_inputs'])
+        unused = set(c for (c, port) in audit['unused_outputs'])
+        unconnected = set(audit['unconnected'])
+        unreachable = set(audit['unreachable_consumers'])
+        in_cycle = set(c for cycle in audit['cycles'] for c in cycle)
 
         comps = self.__sim_core.list_components(ctype, name_filt)
         print('=================================================================')
         print('Debug Audit for all %s Components matching (%s)'%(ctype,name_filt))
         print('=================================================================')
-        for c in sorted(comps):
-            comp = self.__sim_core.lookup(c)
-            status = 'Unknown'
-            if comp.is_bound() and comp.is_connected():
-                status = 'Good'
-            elif comp.is_bound() and not comp.is_connected():
-                status = 'WARNING (Driven but Unused)'
-            elif not comp.is_bound() and comp.is_connected():
+        for c in comps:
+            if self.__sim_core.lookup(c).get_ports() == (0, 0):
+                continue
+            if c in unconnected:
+                status = 'Unused'
+            elif c in undriven and c in unused:
+                status = 'WARNING (Partially Connected)'
+            elif c in undriven:
                 status = 'WARNING (Used but Undriven)'
+            elif c in unused:
+                status = 'WARNING (Driven but Unused)'
             else:
-                status = 'Unused'
+                status = 'Good'
+            if c in unreachable:
+                status += ' (Unreachable)'
+            if c in in_cycle:
+                status += ' (In Cycle)'
             print(' - %s: Status = %s'%(c,status))
         print('=================================================================')
+        print('%d undriven inputs, %d unused outputs, %d unreachable consumers, %d cycles' % (
+            len(audit['undriven_inputs']), len(audit['unused_outputs']),
+            len(audit['unreachable_consumers']), len(audit['cycles'])))
+        print('=================================================================')
 
     def new_figure(self, grid_dims=[1,1], fignum=1, figsize=(16, 9), dpi=72):
-        self.__figure = plt.figure(num=fignum, figsize=figsize, dpi=dpi)
+        self.__figure = self.__pyplot().figure(num=fignum, figsize=figsize, dpi=dpi)
         self.__fig_dims = grid_dims
+        self.__fig_count += 1
 
     def show_figure(self):
-        plt.show()
+        if self.__output_dir:
+            self.__figure.savefig(os.path.join(self.__output_dir,
+                'figure_%02d.%s' % (self.__fig_count, self.__fmt)))
+            self.__pyplot().close(self.__figure)
+        else:
+            self.__pyplot().show()
         self.__figure = None
 
     def plot_utilization(self, ctype, name_filt='.*', grid_pos=1):
@@ -680,16 +2718,20 @@ class Visualizer():
             width = 0.95/len(attrs)
             rects = []
             ymax = 100
+            series = []
             for i in range(len(attrs)):
-                utilz = [self.__sim_core.lookup(c).get_utilization(attrs[i]) * 100 for c in comps]
+                utilz = self.__sim_core.get_utilization(ctype, name_filt, attrs[i]) * 100
                 rects.append(ax.bar(ind + width*i, utilz, width, color=colors[i%len(colors)]))
                 ymax = max(ymax, int(math.ceil(max(utilz) / 100.0)) * 100)
+                series.append(utilz)
+            self.__export_series(grid_pos, ['component'] + attrs,
+                [[comps[c]] + [u[c] for u in series] for c in range(len(comps))])
             ax.set_ylim([0,ymax])
             ax.set_yticks(list(range(0,ymax,10)))
             ax.set_xticks(ind + 0.5)
             ax.set_xticklabels(comps, rotation=90)
             ax.legend(rects, attrs)
-            ax.grid(b=True, which='both', color='0.65',linestyle='--')
+            ax.grid(True, which='both', color='0.65',linestyle='--')
         ax.plot([0, len(comps)], [100, 100], "k--", linewidth=3.0)
         if show:
             self.show_figure()
@@ -698,8 +2740,8 @@ class Visualizer():
         streams = list()
         for c in sorted(self.__sim_core.list_components(comptype.consumer, consumer_filt)):
             for s in sorted(self.__sim_core.lookup(c).get_items()):
-                if (re.match(stream_filt, s)):
-                    streams.append((c, s, c + '/' + s))
+                if (re.match(stream_filt, str(s))):
+                    streams.append((c, s, c + '/' + str(s)))
 
         if not self.__figure:
             self.new_figure()
@@ -715,13 +2757,54 @@ class Visualizer():
         if streams:
             ind = np.arange(len(streams))
             latency = [self.__sim_core.lookup(c_s_d1[0]).get_latency(c_s_d1[1]) for c_s_d1 in streams]
+            self.__export_series(grid_pos, ['consumer', 'stream', 'latency'],
+                [[streams[i][0], streams[i][1], latency[i]] for i in range(len(streams))])
             rects = [ax.bar(ind, latency, 1.0, color='b')]
             ax.set_xticks(ind + 0.5)
             ax.set_xticklabels([c_s_d[2] for c_s_d in streams], rotation=90)
             attrs = ['latency']
             ax.legend(rects, attrs)
-            ax.yaxis.set_major_formatter(mticker.FormatStrFormatter('%.2e'))
-            ax.grid(b=True, which='both', color='0.65',linestyle='--')
+            ax.yaxis.set_major_formatter(self.__pyplot().FormatStrFormatter('%.2e'))
+            ax.grid(True, which='both', color='0.65',linestyle='--')
+        if show:
+            self.show_figure()
+
+    def plot_latency_quantiles(self, stream_filt='.*', consumer_filt='.*',
+            quantiles=[0.5, 0.99, 0.999], grid_pos=1):
+        colors = ['b','r','g','y']
+        streams = list()
+        for c in sorted(self.__sim_core.list_components(comptype.consumer, consumer_filt)):
+            for s in sorted(self.__sim_core.lookup(c).get_items()):
+                if (re.match(stream_filt, str(s))):
+                    streams.append((c, s, c + '/' + str(s)))
+
+        if not self.__figure:
+            self.new_figure()
+            show = True
+        else:
+            show = False
+        self.__figure.subplots_adjust(bottom=0.25)
+        ax = self.__figure.add_subplot(*(self.__fig_dims + [grid_pos]))
+        title = 'Source-to-Sink Latency Distribution of\nStream(s) matching \"%s\"\n(Consumer Filter = \"%s\")' % \
+            (stream_filt, consumer_filt)
+        ax.set_title(title)
+        ax.set_ylabel('Source-to-Sink Latency (s)')
+        if streams:
+            ind = np.arange(len(streams))
+            width = 0.95/len(quantiles)
+            latency = [self.__sim_core.lookup(c).get_latency_quantiles(s, quantiles)
+                for (c, s, d) in streams]
+            self.__export_series(grid_pos, ['consumer', 'stream'] + ['p%g' % (q*100) for q in quantiles],
+                [[streams[i][0], streams[i][1]] + latency[i] for i in range(len(streams))])
+            rects = []
+            for j in range(len(quantiles)):
+                rects.append(ax.bar(ind + width*j, [l[j] for l in latency], width,
+                    color=colors[j%len(colors)]))
+            ax.set_xticks(ind + 0.5)
+            ax.set_xticklabels([d for (c, s, d) in streams], rotation=90)
+            ax.legend(rects, ['p%g' % (q*100) for q in quantiles])
+            ax.yaxis.set_major_formatter(self.__pyplot().FormatStrFormatter('%.2e'))
+            ax.grid(True, which='both', color='0.65',linestyle='--')
         if show:
             self.show_figure()
 
@@ -729,12 +2812,12 @@ class Visualizer():
         path = []
         latencies = []
         for c in self.__sim_core.list_components(comptype.consumer, consumer_filt):
-            for s in self.__sim_core.lookup(c).get_items():
-                if (stream_id == s):
-                    for h in self.__sim_core.lookup(c).get_hops(s):
-                        path.append(h)
-                        latencies.append(self.__sim_core.lookup(c).get_latency(s, h))
-                    break
+            consumer = self.__sim_core.lookup(c)
+            # The stream can be given as an ID or by its name
+            for s in consumer.get_items():
+                if s == stream_id or str(s) == stream_id:
+                    path.extend(consumer.get_hops(s))
+                    latencies.extend(consumer.get_latency_profile(s))
         if not self.__figure:
             self.new_figure()
             show = True
@@ -749,9 +2832,11 @@ class Visualizer():
         if path:
             ind = np.arange(len(path))
             rects = [ax.plot(ind, latencies, '--rs')]
+            self.__export_series(grid_pos, ['hop', 'latency'],
+                [[path[i], latencies[i]] for i in range(len(path))])
             ax.set_xticks(ind)
             ax.set_xticklabels(path, rotation=90)
-            ax.yaxis.set_major_formatter(mticker.FormatStrFormatter('%.2e'))
-            ax.grid(b=True, which='both', color='0.65',linestyle='--')
+            ax.yaxis.set_major_formatter(self.__pyplot().FormatStrFormatter('%.2e'))
+            ax.grid(True, which='both', color='0.65',linestyle='--')
         if show:
             self.show_figure()
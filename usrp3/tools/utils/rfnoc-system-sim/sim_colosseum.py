@@ -20,28 +20,16 @@ import rfnocsim
 import ni_hw_models as hw
 import colosseum_models
 import argparse
+import json
+import os
 import re
 
-def main():
-    # Arguments
-    parser = argparse.ArgumentParser(description='Simulate the Colosseum network')
-    parser.add_argument('--topology', type=str, default='flb', choices=['torus','flb'], help='Topology')
-    parser.add_argument('--domain', type=str, default='time', choices=['time','frequency'], help='Domain')
-    parser.add_argument('--fir_taps', type=int, default=4, help='FIR Filter Taps (Time domain only)')
-    parser.add_argument('--fir_dly_line', type=int, default=512, help='FIR Delay Line (Time domain only)')
-    parser.add_argument('--fft_size', type=int, default=512, help='FFT Size (Frequency domain only)')
-    parser.add_argument('--fft_overlap', type=int, default=256, help='FFT Overlap (Frequency domain only)')
-    parser.add_argument('--samp_rate', type=float, default=100e6, help='Radio Channel Sample Rate')
-    parser.add_argument('--coherence_rate', type=float, default=1000, help='Channel coefficient update rate')
-    args = parser.parse_args()
+TOPOLOGIES = {'torus': colosseum_models.Topology_2D_4x4_Torus, 'flb': colosseum_models.Topology_3D_4x4_FLB}
 
-    sim_core = rfnocsim.SimulatorCore(tick_rate=100e6)
-    NUM_USRPS   = 128
-    NUM_HOSTS   = 4
-    NUM_BLADES  = 16
-    NUM_CHANS   = NUM_USRPS * 2
-
-    # Build an application settings structure
+def get_app_settings(args):
+    """
+    Build an application settings structure from the command line arguments
+    """
     app_settings = dict()
     app_settings['domain'] = args.domain
     app_settings['samp_rate'] = args.samp_rate
@@ -52,33 +40,214 @@ def main():
     else:
         app_settings['fir_taps'] = args.fir_taps
         app_settings['fir_dly_line'] = args.fir_dly_line
+    return app_settings
+
+def get_models():
+    """
+    Models that can be instantiated by a topology description file
+    """
+    return {
+        'StreamId': rfnocsim.StreamId,
+        'Producer': rfnocsim.Producer,
+        'Consumer': rfnocsim.Consumer,
+        'Channel': rfnocsim.Channel,
+        'UsrpX310': hw.UsrpX310,
+        'Bee7Fpga': hw.Bee7Fpga,
+        'Bee7Blade': hw.Bee7Blade,
+        'ManagementHostandSwitch': hw.ManagementHostandSwitch,
+        'Topology_2D_4x4_Torus': colosseum_models.Topology_2D_4x4_Torus,
+        'Topology_3D_4x4_FLB': colosseum_models.Topology_3D_4x4_FLB,
+    }
+
+def get_topology(topology, dim=None, usrps_per_fpga=None):
+    """
+    Returns the class of a built-in topology. If specified, it is scaled
+    to dim blades across each dimension and (flb only) usrps_per_fpga
+    USRPs on each FPGA.
+    """
+    if topology not in TOPOLOGIES:
+        raise RuntimeError('Invalid topology: ' + topology)
+    topo = TOPOLOGIES[topology]
+    if usrps_per_fpga is not None:
+        if topology != 'flb':
+            raise RuntimeError('USRPs per FPGA can only be changed for the flb topology')
+        return topo.scaled(dim or topo.DIM_WIDTH, usrps_per_fpga)
+    return topo.scaled(dim) if dim else topo
 
-    print('[INFO] Instantiating hardware resources...')
+def build_topology(sim_core, topology, app_settings, verbose=True, dim=None, usrps_per_fpga=None):
+    """
+    Instantiate all the Colosseum hardware in sim_core and wire it up
+    using the specified topology. The topology is either the name of a
+    built-in topology (torus, flb) or a topology description file.
+    dim and usrps_per_fpga scale the built-in topologies (see get_topology).
+    """
+    if topology not in TOPOLOGIES:
+        if dim or usrps_per_fpga:
+            raise RuntimeError('Only the built-in topologies can be scaled')
+        if verbose:
+            print('[INFO] Loading topology ' + topology + '...')
+        rfnocsim.Topology.load(topology).build(sim_core, get_models(), {'app_settings': app_settings})
+        return
+    topo = get_topology(topology, dim, usrps_per_fpga)
+    (num_usrps, num_blades, num_hosts, host_ports) = topo.get_num_nodes()
+    num_chans = num_usrps * 2
+    if verbose:
+        print('[INFO] Instantiating hardware resources (%d USRPs, %d BEE7s)...' % (num_usrps, num_blades))
     # Create USRPs
     usrps = []
-    for i in range(NUM_USRPS):
+    for i in range(num_usrps):
         usrps.append(hw.UsrpX310(sim_core, index=i, app_settings=app_settings))
     # Create BEE7s
     bee7blades = []
-    for i in range(NUM_BLADES):
+    for i in range(num_blades):
         bee7blades.append(hw.Bee7Blade(sim_core, index=i))
     # Create Management Hosts
     hosts = []
-    for i in range(NUM_HOSTS):
+    for i in range(num_hosts):
         hosts.append(hw.ManagementHostandSwitch(sim_core, index=i,
-            num_coeffs=pow(NUM_CHANS,2)/NUM_HOSTS, switch_ports=16, app_settings=app_settings))
+            num_coeffs=pow(num_chans,2)/num_hosts, switch_ports=host_ports, app_settings=app_settings))
 
     # Build topology
-    print('[INFO] Building topology...')
-    if args.topology == 'torus':
-        colosseum_models.Topology_2D_4x4_Torus.connect(sim_core, usrps, bee7blades, hosts, app_settings)
-    elif args.topology == 'flb':
-        colosseum_models.Topology_3D_4x4_FLB.connect(sim_core, usrps, bee7blades, hosts, app_settings)
+    if verbose:
+        print('[INFO] Building topology...')
+    topo.connect(sim_core, usrps, bee7blades, hosts, app_settings)
+
+def get_blade_partition(name):
+    """
+    Partition function for run_partitioned: One partition per BEE7 blade.
+    USRPs and hosts join the partition of the blade they are connected to.
+    """
+    m = re.match(r'BEE7_(\d+)', name)
+    return int(m.group(1)) if m else None
+
+def get_summary(sim_core, solver=None):
+    """
+    Summarize the utilization and latency metrics of a simulation run
+    into a flat dictionary. Also validates correctness.
+    If a solved FlowSolver is passed in, the steady state metrics are
+    summarized instead (without validation).
+    """
+    if solver is None:
+        for u in sim_core.list_components(rfnocsim.comptype.hardware, 'USRP.*'):
+            sim_core.lookup(u).validate(0)
+    results = solver if solver else sim_core
+    summary = dict()
+    summary['num_overutilized'] = 0
+    for u in sim_core.list_components('', '.*'):
+        c = sim_core.lookup(u)
+        for a in c.get_util_attrs():
+            util = solver.get_comp_utilization(u, a) if solver else c.get_utilization(a)
+            if util > 1.0:
+                summary['num_overutilized'] += 1
+    def max_util(ctype, name_filt, attr):
+        utilz = results.get_utilization(ctype, name_filt, attr)
+        return float(utilz.max()) if len(utilz) > 0 else 0.0
+    summary['max_fpga_dsp_util'] = max_util(rfnocsim.comptype.hardware, 'BEE7.*', 'DSP')
+    summary['max_fpga_bram_util'] = max_util(rfnocsim.comptype.hardware, 'BEE7.*', 'BRAM_18kb')
+    summary['max_serdes_util'] = max_util(rfnocsim.comptype.channel, 'BEE7.*SER_.*', 'bandwidth')
+    summary['max_usrp_util'] = max_util(rfnocsim.comptype.producer, 'USRP.*', 'bandwidth')
+    latencies = []
+    for u in sim_core.list_components(rfnocsim.comptype.consumer, 'USRP.*'):
+        if solver:
+            latencies.extend([solver.get_latency(u, s) for s in solver.get_items(u)])
+        else:
+            c = sim_core.lookup(u)
+            latencies.extend([c.get_latency(s) for s in c.get_items()])
+    summary['max_latency_s'] = max(latencies) if latencies else float('nan')
+    summary['mean_latency_s'] = (sum(latencies) / len(latencies)) if latencies else float('nan')
+    return summary
+
+# Arguments that only apply when the topology is built (not when a checkpoint is loaded)
+BUILD_ARGS = ['topology', 'dim', 'usrps_per_fpga', 'domain', 'fir_taps', 'fir_dly_line', 'fft_size',
+              'fft_overlap', 'samp_rate', 'coherence_rate', 'event_driven']
+
+def get_parser(description='Simulate the Colosseum network'):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--topology', type=str, default='flb', help='Topology (torus, flb or a topology description file)')
+    parser.add_argument('--dim', type=int, default=None, help='Number of BEE7s across each dimension of the built-in topology (default: 4)')
+    parser.add_argument('--usrps_per_fpga', type=int, default=None, help='Number of USRPs connected to each FPGA (flb only, default: 2)')
+    parser.add_argument('--domain', type=str, default='time', choices=['time','frequency'], help='Domain')
+    parser.add_argument('--fir_taps', type=int, default=4, help='FIR Filter Taps (Time domain only)')
+    parser.add_argument('--fir_dly_line', type=int, default=512, help='FIR Delay Line (Time domain only)')
+    parser.add_argument('--fft_size', type=int, default=512, help='FFT Size (Frequency domain only)')
+    parser.add_argument('--fft_overlap', type=int, default=256, help='FFT Overlap (Frequency domain only)')
+    parser.add_argument('--samp_rate', type=float, default=100e6, help='Radio Channel Sample Rate')
+    parser.add_argument('--coherence_rate', type=float, default=1000, help='Channel coefficient update rate')
+    parser.add_argument('--sim_time', type=float, default=16e-9, help='Simulated time in seconds')
+    parser.add_argument('--event_driven', action='store_true', help='Use the event driven scheduler instead of polling every tick')
+    parser.add_argument('--push_interval', type=int, default=1, help='Number of ticks between data streams generated by each producer')
+    parser.add_argument('--partitions', type=int, default=0, help='Partition the simulation by BEE7 blade and run it in this many processes. The results only match a sequential run for long runs, so --sim_time must be at least a few partition lookahead windows (3e-6 for flb)')
+    parser.add_argument('--load_checkpoint', type=str, default=None, help='Start from a saved simulator state instead of building the topology. The topology and application settings are taken from the checkpoint')
+    parser.add_argument('--save_checkpoint', type=str, default=None, help='Save the simulator state to this file after running')
+    parser.add_argument('--telemetry', type=str, default=None, help='Sample per-component telemetry and save it to this (.npz) file')
+    parser.add_argument('--telemetry_interval', type=int, default=100, help='Number of ticks between telemetry samples')
+    parser.add_argument('--telemetry_depth', type=int, default=256, help='Number of telemetry samples to keep')
+    parser.add_argument('--telemetry_filt', type=str, default='.*', help='Regex for the names of the components to sample')
+    parser.add_argument('--audit', action='store_true', help='Check the connectivity of the topology and exit without simulating')
+    parser.add_argument('--static', action='store_true', help='Solve for the steady state utilization and latency instead of simulating')
+    parser.add_argument('--static_check', action='store_true', help='Cross-check the steady state solution against the simulation')
+    parser.add_argument('--output_dir', type=str, default=None, help='Write plots and raw data to this directory instead of showing them')
+    parser.add_argument('--output_fmt', type=str, default='png', help='Image format for plots written to the output directory')
+    return parser
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.load_checkpoint:
+        # The topology and application settings come from the checkpoint
+        conflicts = ['--' + a for a in BUILD_ARGS if getattr(args, a) != parser.get_default(a)]
+        if conflicts:
+            parser.error('%s cannot be changed when loading a checkpoint' % (', '.join(conflicts)))
+        print('[INFO] Loading checkpoint ' + args.load_checkpoint + '...')
+        sim_core = rfnocsim.SimulatorCore.load_checkpoint(args.load_checkpoint)
     else:
-        raise RuntimeError('Invalid topology: ' + args.topology)
+        sim_core = rfnocsim.SimulatorCore(tick_rate=100e6, event_driven=args.event_driven)
+        build_topology(sim_core, args.topology, get_app_settings(args), dim=args.dim, usrps_per_fpga=args.usrps_per_fpga)
+
+    if args.audit:
+        print('[INFO] Auditing connectivity...')
+        audit = sim_core.audit()
+        for key in sorted(audit):
+            print('[INFO] %s: %d' % (key, len(audit[key])))
+        for cycle in audit['cycles']:
+            print('[WARN] Cycle: ' + ' -> '.join(cycle))
+        if args.output_dir:
+            if not os.path.isdir(args.output_dir):
+                os.makedirs(args.output_dir)
+            with open(os.path.join(args.output_dir, 'audit.json'), 'w') as jsonfile:
+                json.dump(audit, jsonfile, indent=2)
+        return
+
+    if args.static:
+        print('[INFO] Solving steady state flows...')
+        solver = rfnocsim.FlowSolver(sim_core).solve()
+        for u in solver.get_unsolved():
+            print('[WARN] %s: Not solved (part of or fed by a cycle)' % (u))
+        summary = get_summary(sim_core, solver)
+        for key in sorted(summary):
+            print('[INFO] %s: %g' % (key, summary[key]))
+        if args.output_dir:
+            if not os.path.isdir(args.output_dir):
+                os.makedirs(args.output_dir)
+            with open(os.path.join(args.output_dir, 'static_summary.json'), 'w') as jsonfile:
+                json.dump(summary, jsonfile, indent=2)
+        return
 
     print('[INFO] Running simulation...')
-    sim_core.run(16e-9)
+    for p in sim_core.list_components(rfnocsim.comptype.producer):
+        sim_core.lookup(p).set_push_interval(args.push_interval)
+    if args.telemetry:
+        sim_core.enable_telemetry(args.telemetry_interval, args.telemetry_depth, args.telemetry_filt)
+    if args.partitions > 0:
+        sim_core.run_partitioned(args.sim_time, get_blade_partition, args.partitions)
+    else:
+        sim_core.run(args.sim_time)
+    if args.save_checkpoint:
+        print('[INFO] Saving checkpoint ' + args.save_checkpoint + '...')
+        sim_core.save_checkpoint(args.save_checkpoint)
+    if args.telemetry:
+        print('[INFO] Saving telemetry ' + args.telemetry + '...')
+        sim_core.get_telemetry().save(args.telemetry)
 
     # Sanity checks
     print('[INFO] Validating correctness...')
@@ -104,8 +273,15 @@ def main():
             if (c.get_utilization('bandwidth') != master_stats[ln]):
                 print('[WARN] Data flowing over ' + ln + ' is probably different between ' + master_fpga + ' and ' + m.group(1))
 
+    if args.static_check:
+        print('[INFO] Cross-checking against the steady state solution...')
+        mismatches = rfnocsim.FlowSolver(sim_core).solve().cross_check()
+        for (u, what, static, simulated) in mismatches:
+            print('[WARN] %s: %s is %s in the steady state but %s in the simulation' % (u, what, static, simulated))
+        print('[INFO] %d mismatches' % (len(mismatches)))
+
     # Visualize various metrics
-    vis = rfnocsim.Visualizer(sim_core)
+    vis = rfnocsim.Visualizer(sim_core, args.output_dir, args.output_fmt)
     vis.show_network()
     vis.new_figure([1,2])
     vis.plot_utilization(rfnocsim.comptype.hardware, 'BEE7.*', 1)
@@ -132,9 +308,10 @@ def main():
     vis.plot_utilization(rfnocsim.comptype.channel, 'BEE7_010.*FPGA_SW.*EXT.*', 3)
     vis.plot_utilization(rfnocsim.comptype.channel, 'BEE7_010.*FPGA_SE.*EXT.*', 4)
     vis.show_figure()
-    vis.new_figure([1,2])
+    vis.new_figure([1,3])
     vis.plot_consumption_latency('.*','.*USRP_.*', 1)
-    vis.plot_path_latency('tx[(0)]', '.*', 2)
+    vis.plot_latency_quantiles('.*','.*USRP_.*', grid_pos=2)
+    vis.plot_path_latency('tx[(0)]', '.*', 3)
     vis.show_figure()
     vis.plot_utilization(rfnocsim.comptype.producer, '.*MGMT_HOST.*')
 
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Ettus Research
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Description
+#   Sweep the Colosseum simulation over a grid of configurations. Each
+#   configuration (point) runs headless in a process pool and its summary
+#   is appended to a CSV results file. Points that already finished
+#   successfully with the same settings are skipped, so an interrupted
+#   sweep can be resumed.
+#   With --resources_only, the FPGA resource usage of all points is
+#   estimated in one pass instead and nothing is simulated.
+
+import rfnocsim
+import sim_colosseum
+import colosseum_models
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+
+PARAM_KEYS = ['topology', 'domain', 'fir_taps', 'fft_size', 'samp_rate', 'coherence_rate']
+# Settings that are not swept but change the results of a point
+RUN_KEYS = ['fir_dly_line', 'fft_overlap', 'sim_time', 'event_driven', 'push_interval']
+SUMMARY_KEYS = ['status', 'num_overutilized', 'max_fpga_dsp_util', 'max_fpga_bram_util',
+                'max_serdes_util', 'max_usrp_util', 'max_latency_s', 'mean_latency_s']
+RESOURCE_KEYS = ['status', 'max_unroll', 'fpga_dsp', 'fpga_bram', 'max_fpga_dsp_util', 'max_fpga_bram_util']
+TOPOLOGIES = {'torus': colosseum_models.Topology_2D_4x4_Torus, 'flb': colosseum_models.Topology_3D_4x4_FLB}
+
+def get_options():
+    parser = argparse.ArgumentParser(description='Sweep the Colosseum network simulation')
+    parser.add_argument('--topology', type=str, default='flb', help='Topologies (CSV) [torus,flb]')
+    parser.add_argument('--domain', type=str, default='time,frequency', help='Domains (CSV) [time,frequency]')
+    parser.add_argument('--fir_taps', type=str, default='4', help='FIR Filter Taps (CSV, Time domain only)')
+    parser.add_argument('--fir_dly_line', type=int, default=512, help='FIR Delay Line (Time domain only)')
+    parser.add_argument('--fft_size', type=str, default='512', help='FFT Sizes (CSV, Frequency domain only)')
+    parser.add_argument('--fft_overlap', type=int, default=256, help='FFT Overlap (Frequency domain only)')
+    parser.add_argument('--samp_rate', type=str, default='100e6', help='Radio Channel Sample Rates (CSV)')
+    parser.add_argument('--coherence_rate', type=str, default='1000', help='Channel coefficient update rates (CSV)')
+    parser.add_argument('--sim_time', type=float, default=16e-9, help='Simulated time in seconds')
+    parser.add_argument('--event_driven', action='store_true', help='Use the event driven scheduler instead of polling every tick')
+    parser.add_argument('--push_interval', type=int, default=1, help='Number of ticks between data streams generated by each producer')
+    parser.add_argument('--resources_only', action='store_true', help='Only estimate the FPGA resources of each point (no simulation)')
+    parser.add_argument('--max_unroll', type=int, default=colosseum_models.PartialContribComputer.MAX_UNROLL_DEPTH, help='Max loop unroll depth for partial products (--resources_only)')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), help='Number of parallel simulations')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Results file (CSV) [colosseum_sweep.csv or colosseum_resources.csv]')
+    args = parser.parse_args()
+    if args.output is None:
+        args.output = 'colosseum_resources.csv' if args.resources_only else 'colosseum_sweep.csv'
+    return args
+
+def get_points(args):
+    """
+    Expand the swept arguments into a list of points. FIR taps only
+    apply to the time domain and FFT sizes to the frequency domain.
+    """
+    points = []
+    for domain in args.domain.split(','):
+        if domain == 'time':
+            fir_taps = [int(x) for x in args.fir_taps.split(',')]
+            fft_size = ['']
+        else:
+            fir_taps = ['']
+            fft_size = [int(x) for x in args.fft_size.split(',')]
+        for (topology, taps, size, samp_rate, coherence_rate) in itertools.product(
+                args.topology.split(','), fir_taps, fft_size,
+                [float(x) for x in args.samp_rate.split(',')],
+                [float(x) for x in args.coherence_rate.split(',')]):
+            points.append({'topology':topology, 'domain':domain, 'fir_taps':taps, 'fft_size':size,
+                           'samp_rate':samp_rate, 'coherence_rate':coherence_rate,
+                           'fir_dly_line':(args.fir_dly_line if domain == 'time' else ''),
+                           'fft_overlap':(args.fft_overlap if domain != 'time' else ''),
+                           'sim_time':args.sim_time, 'event_driven':args.event_driven,
+                           'push_interval':args.push_interval})
+    return points
+
+def point_key(point):
+    # Values are keyed by their string representation to match what is read back from the CSV
+    return tuple(str(point.get(k)) for k in PARAM_KEYS+RUN_KEYS)
+
+def run_point(job):
+    """
+    Process pool worker: Simulate one point and return its summary
+    """
+    (point, args) = job
+    app_settings = dict()
+    app_settings['domain'] = point['domain']
+    app_settings['samp_rate'] = point['samp_rate']
+    app_settings['coherence_rate'] = point['coherence_rate']
+    if point['domain'] == 'frequency':
+        app_settings['fft_size'] = point['fft_size']
+        app_settings['fft_overlap'] = point['fft_overlap']
+    else:
+        app_settings['fir_taps'] = point['fir_taps']
+        app_settings['fir_dly_line'] = point['fir_dly_line']
+    try:
+        sim_core = rfnocsim.SimulatorCore(tick_rate=100e6, event_driven=point['event_driven'])
+        sim_colosseum.build_topology(sim_core, point['topology'], app_settings, verbose=False)
+        for p in sim_core.list_components(rfnocsim.comptype.producer):
+            sim_core.lookup(p).set_push_interval(point['push_interval'])
+        sim_core.run(point['sim_time'])
+        summary = sim_colosseum.get_summary(sim_core)
+        summary['status'] = 'OK'
+    except Exception as e:
+        summary = {'status': 'ERROR: ' + str(e)}
+    return (point, summary)
+
+def estimate_resources(args, points):
+    """
+    Estimate the resource usage of each FPGA for all points (one
+    vectorized pass per topology) and write them to the results file
+    """
+    with open(args.output, 'w') as resfile:
+        writer = csv.DictWriter(resfile, fieldnames=PARAM_KEYS+RESOURCE_KEYS, restval='')
+        writer.writeheader()
+        for topology in args.topology.split(','):
+            topo_points = [p for p in points if p['topology'] == topology]
+            if topology not in TOPOLOGIES:
+                print('[WARN] Resources can only be estimated for ' + ', '.join(sorted(TOPOLOGIES)))
+                continue
+            results = colosseum_models.explore_design_space(TOPOLOGIES[topology], {
+                'domain': [p['domain'] for p in topo_points],
+                'samp_rate': [p['samp_rate'] for p in topo_points],
+                'fir_taps': [p['fir_taps'] or 0 for p in topo_points],
+                'fir_dly_line': args.fir_dly_line,
+                'fft_size': [p['fft_size'] or 0 for p in topo_points],
+                'max_unroll': args.max_unroll})
+            for i in range(len(topo_points)):
+                row = dict((k, topo_points[i][k]) for k in PARAM_KEYS)
+                row['status'] = 'OK' if results['feasible'][i] else 'ERROR: Too many FIR coefficients'
+                row['max_unroll'] = args.max_unroll
+                row['fpga_dsp'] = results['DSP'][i]
+                row['fpga_bram'] = results['BRAM_18kb'][i]
+                row['max_fpga_dsp_util'] = results['DSP_util'][i]
+                row['max_fpga_bram_util'] = results['BRAM_18kb_util'][i]
+                writer.writerow(row)
+    print('[INFO] Resource estimates for %d points written to %s' % (len(points), args.output))
+    return 0
+
+def main():
+    args = get_options()
+    points = get_points(args)
+    if args.resources_only:
+        return estimate_resources(args, points)
+    # Skip all points that finished successfully (with the same settings)
+    # in a previous run. Failed points are dropped from the results file
+    # and run again.
+    fieldnames = PARAM_KEYS+RUN_KEYS+SUMMARY_KEYS
+    done_rows = []
+    if os.path.isfile(args.output):
+        with open(args.output, 'r') as resfile:
+            done_rows = [row for row in csv.DictReader(resfile) if row.get('status') == 'OK']
+    done = set(point_key(row) for row in done_rows)
+    pending = [p for p in points if point_key(p) not in done]
+    print('[INFO] %d points in sweep. %d already done, %d to run...' % (
+        len(points), len(points) - len(pending), len(pending)))
+    if not pending:
+        return 0
+
+    with open(args.output + '.tmp', 'w') as resfile:
+        writer = csv.DictWriter(resfile, fieldnames=fieldnames, restval='', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(done_rows)
+    os.replace(args.output + '.tmp', args.output)
+    with open(args.output, 'a') as resfile:
+        writer = csv.DictWriter(resfile, fieldnames=fieldnames, restval='')
+        pool = multiprocessing.Pool(processes=min(args.jobs, len(pending)))
+        try:
+            jobs = [(p, args) for p in pending]
+            for (i, (point, summary)) in enumerate(pool.imap_unordered(run_point, jobs)):
+                row = dict(point)
+                row.update(summary)
+                writer.writerow(row)
+                # Flush every point so that an interrupted sweep can resume
+                resfile.flush()
+                print('[INFO] (%d/%d) %s: %s' % (
+                    i + 1, len(pending), ', '.join(str(point[k]) for k in PARAM_KEYS), summary['status']))
+            pool.close()
+        except KeyboardInterrupt:
+            print('[WARN] Received SIGINT. Aborting... (finished points were saved)')
+            pool.terminate()
+            return 1
+        finally:
+            pool.join()
+    print('[INFO] Sweep results written to ' + args.output)
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
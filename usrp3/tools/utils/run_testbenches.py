@@ -13,9 +13,13 @@ import logging
 import re
 import io
 import time
+import shutil
+import signal
 import datetime
-from queue import Queue
-from threading import Thread
+import heapq
+import hashlib
+import json
+from threading import Thread, Event
 
 #-------------------------------------------------------
 # Utilities
@@ -70,28 +74,150 @@ def read_excludes_file(excludes_fname):
     else:
         return []
 
-def find_sims_on_fs(basedir, excludes):
+def hash_file(path):
+    """ Return the SHA1 digest of the contents of a file
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load_json(fname, default):
+    """ Load a JSON state file. Returns default if the file does
+        not exist or cannot be parsed
+    """
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json(fname, data):
+    """ Atomically write a JSON state file
+    """
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmpname, fname)
+    except OSError as e:
+        _LOG.warning('Could not write ' + fname + ': ' + str(e))
+
+DEFAULT_CACHEDIR = '.run_testbenches'
+
+def get_cache_path(args, fname):
+    """ Path of a state file that is kept between runs
+    """
+    cachedir = args.cachedir
+    if cachedir is None:
+        cachedir = os.path.join(args.basedir, DEFAULT_CACHEDIR)
+    return os.path.join(cachedir, fname)
+
+DISCOVERY_INDEX = 'discovery.json'
+DISCOVERY_INDEX_VERSION = 1
+SIM_MAKEFILE_RE = re.compile(rb'^.*include.*viv_sim_preamble.mak', re.MULTILINE)
+
+def scan_dir(root):
+    """ List a directory for the discovery index: Returns the names of
+        the subdirectories to descend into and whether it has a Makefile
+    """
+    subdirs = []
+    has_makefile = False
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir and not entry.is_symlink():
+                        subdirs.append(entry.name)
+                    elif not is_dir and entry.name == 'Makefile':
+                        has_makefile = True
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return (sorted(subdirs), has_makefile)
+
+def find_sims_on_fs(basedir, excludes, index_fname=None, rescan=False):
     """ Find all testbenches in the specific basedir
         Testbenches are defined as directories with a
         Makefile that includes viv_sim_preamble.mak
+
+        If index_fname is specified, the result of the scan is kept
+        in a discovery index. A directory is only listed again if its
+        mtime changed and a Makefile is only read again if its mtime
+        or size changed (and only re-parsed if its hash changed).
+        The directory that holds the index (and the default cache
+        directory) is not scanned since it changes on every run.
     """
+    skip_names = {DEFAULT_CACHEDIR}
+    if index_fname:
+        skip_names.add(os.path.relpath(os.path.realpath(os.path.dirname(index_fname)),
+            os.path.realpath(basedir)))
+    old_dirs = {}
+    if index_fname and not rescan:
+        index = load_json(index_fname, {})
+        if index.get('version') == DISCOVERY_INDEX_VERSION and \
+                index.get('basedir') == os.path.realpath(basedir):
+            old_dirs = index['dirs']
+    new_dirs = {}
+    modified = False
     sims = {}
-    for root, _, files in os.walk(basedir):
-        name = os.path.relpath(root, basedir)
-        if 'Makefile' in files:
-            with open(os.path.join(root, 'Makefile'), 'r') as mfile:
-                for l in mfile.readlines():
-                    if re.match('.*include.*viv_sim_preamble.mak.*', l) is not None:
-                        if name not in excludes:
-                            sims.update({name: root})
-                            break
+    stack = ['.']
+    while stack:
+        name = stack.pop()
+        root = basedir if name == '.' else os.path.join(basedir, name)
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            continue
+        # Only list the directory again if entries were added or removed
+        old = old_dirs.get(name, {})
+        if old.get('mtime') == mtime:
+            entry = dict(old)
+            has_makefile = (entry['makefile'] is not None)
+        else:
+            (subdirs, has_makefile) = scan_dir(root)
+            entry = {'mtime': mtime, 'subdirs': subdirs, 'makefile': None, 'sim': False}
+            if has_makefile:
+                entry.update({'makefile': old.get('makefile'), 'sim': old.get('sim', False)})
+            modified = True
+        # Makefiles are edited in place, which does not touch the
+        # directory mtime, so they are checked separately
+        if has_makefile:
+            mfname = os.path.join(root, 'Makefile')
+            try:
+                st = os.stat(mfname)
+                stamp = [st.st_mtime_ns, st.st_size]
+                if entry['makefile'] is None or entry['makefile'][0:2] != stamp:
+                    digest = hash_file(mfname)
+                    if entry['makefile'] is None or entry['makefile'][2] != digest:
+                        with open(mfname, 'rb') as mfile:
+                            entry['sim'] = SIM_MAKEFILE_RE.search(mfile.read()) is not None
+                    entry['makefile'] = stamp + [digest]
+                    modified = True
+            except OSError:
+                entry.update({'makefile': None, 'sim': False})
+                modified = True
+        new_dirs[name] = entry
+        if entry['sim'] and name not in excludes:
+            sims.update({name: root})
+        for sub in reversed(entry['subdirs']):
+            sub = sub if name == '.' else os.path.join(name, sub)
+            if sub not in skip_names:
+                stack.append(sub)
+    if index_fname and (modified or len(new_dirs) != len(old_dirs)):
+        save_json(index_fname, {'version': DISCOVERY_INDEX_VERSION,
+            'basedir': os.path.realpath(basedir), 'dirs': new_dirs})
     return sims
 
-def gather_target_sims(basedir, targets, excludes):
+def gather_target_sims(basedir, targets, excludes, index_fname=None, rescan=False):
     """ Parse the specified targets and gather simulations to run
         Remove duplicates and sort alphabetically
     """
-    fs_sims = find_sims_on_fs(basedir, excludes)
+    fs_sims = find_sims_on_fs(basedir, excludes, index_fname, rescan)
     if not isinstance(targets, list):
         targets = [targets]
     sim_names = set()
@@ -104,107 +230,376 @@ def gather_target_sims(basedir, targets, excludes):
         target_sims.append((name, fs_sims[name]))
     return target_sims
 
-def parse_output(simout):
-    # Gather results (basic metrics)
-    results = {'retcode':RETCODE_SUCCESS, 'stdout':simout, 'passed':False}
-    # Look for the following in the log:
-    # - A start timestamp (indicates that Vivado started)
-    # - The testbench infrastructure start header (indicates that the TB started)
-    # - A stop timestamp (indicates that the TB stopped)
-    tb_started = False
-    compile_started = False
-    results['start_time'] = '<unknown>'
-    results['wall_time'] = '<unknown>'
-    for line in simout.split(b'\n'):
-        tsm = re.match(rb'TESTBENCH STARTED: (.+)', line)
-        if tsm is not None:
-            tb_started = True
-        csm = re.match(rb'source .*viv_sim_project.tcl', line)
-        if csm is not None:
-            compile_started = True
-        vsm = re.match(rb'# Start of session at: (.+)', line)
+class SimOutputParser:
+    """ Incremental parser for the output of a simulation
+        Lines are fed one at a time (without the line ending) so the
+        output never has to be held in memory
+    """
+    # Lines of the report printed when the testbench finishes
+    # (see sim_exec_report.vh). The first line starts a report.
+    TB_REPORT_RE = [
+        re.compile(rb'.*TESTBENCH FINISHED: (.+)'),
+        re.compile(rb' - Time elapsed:   (.+) ns'),
+        re.compile(rb' - Tests Expected: (.+)'),
+        re.compile(rb' - Tests Run:      (.+)'),
+        re.compile(rb' - Tests Passed:   (.+)'),
+        re.compile(rb'Result: (PASSED|FAILED)'),
+    ]
+    TB_STARTED_RE = re.compile(rb'TESTBENCH STARTED: (.+)')
+    COMPILE_STARTED_RE = re.compile(rb'source .*viv_sim_project.tcl')
+    START_TIME_RE = re.compile(rb'# Start of session at: (.+)')
+    WALL_TIME_RE = re.compile(rb'launch_simulation:.*; elapsed = (.+) \..*')
+    # Lines that start with none of these (and are not part of the
+    # report) cannot match any of the expressions above
+    LINE_PREFIXES = (b'TESTBENCH STARTED: ', b'source ', b'# Start of session at: ', b'launch_simulation:')
+
+    def __init__(self):
+        self.tb_started = False
+        self.compile_started = False
+        self.start_time = '<unknown>'
+        self.wall_time = '<unknown>'
+        # Groups of the report that is being parsed and of the last
+        # complete report in the output
+        self.report = None
+        self.last_report = None
+
+    def parse_line(self, line):
+        # Look for the following in the log:
+        # - A start timestamp (indicates that Vivado started)
+        # - The testbench infrastructure start header (indicates that the TB started)
+        # - A stop timestamp (indicates that the TB stopped)
+        if self.report is None and not line.startswith(self.LINE_PREFIXES) and \
+                b'TESTBENCH FINISHED: ' not in line:
+            return
+        if self.TB_STARTED_RE.match(line) is not None:
+            self.tb_started = True
+        if self.COMPILE_STARTED_RE.match(line) is not None:
+            self.compile_started = True
+        vsm = self.START_TIME_RE.match(line)
         if vsm is not None:
-            results['start_time'] = str(vsm.group(1), 'ascii')
-        tfm = re.match(rb'launch_simulation:.*; elapsed = (.+) \..*', line)
+            self.start_time = str(vsm.group(1), 'ascii')
+        tfm = self.WALL_TIME_RE.match(line)
         if tfm is not None:
-            results['wall_time'] = str(tfm.group(1), 'ascii')
-    # Parse testbench results
-    tb_match_arr = ([
-        b'.*TESTBENCH FINISHED: (.+)\n',
-        b' - Time elapsed:   (.+) ns.*\n',
-        b' - Tests Expected: (.+)\n',
-        b' - Tests Run:      (.+)\n',
-        b' - Tests Passed:   (.+)\n',
-        b'Result: (PASSED|FAILED).*',
-    ])
-    m = re.match(b''.join(tb_match_arr), simout, re.DOTALL)
-    # Figure out the returncode 
-    retcode = RETCODE_UNKNOWN_ERR
-    if m is not None:
-        retcode = RETCODE_SUCCESS
-        results['passed'] = (m.group(6) == b'PASSED')
-        results['module'] = m.group(1)
-        results['sim_time_ns'] = int(m.group(2))
-        results['tc_expected'] = int(m.group(3))
-        results['tc_run'] = int(m.group(4))
-        results['tc_passed'] = int(m.group(5))
-    elif tb_started:
-        retcode = RETCODE_PARSE_ERR
-    elif compile_started:
-        retcode = RETCODE_COMPILE_ERR
+            self.wall_time = str(tfm.group(1), 'ascii')
+        # Testbench results
+        if self.report is not None:
+            m = self.TB_REPORT_RE[len(self.report)].match(line)
+            if m is not None:
+                self.report.append(m.group(1))
+                if len(self.report) == len(self.TB_REPORT_RE):
+                    self.last_report = self.report
+                    self.report = None
+                return
+        m = self.TB_REPORT_RE[0].match(line)
+        self.report = [m.group(1)] if m is not None else None
+
+    def get_results(self):
+        results = {'retcode':RETCODE_SUCCESS, 'passed':False,
+                   'start_time':self.start_time, 'wall_time':self.wall_time}
+        # Figure out the returncode
+        if self.last_report is not None:
+            retcode = RETCODE_SUCCESS
+            (module, sim_time, tc_expected, tc_run, tc_passed, result) = self.last_report
+            results['passed'] = (result == b'PASSED')
+            results['module'] = module
+            results['sim_time_ns'] = int(sim_time)
+            results['tc_expected'] = int(tc_expected)
+            results['tc_run'] = int(tc_run)
+            results['tc_passed'] = int(tc_passed)
+        elif self.tb_started:
+            retcode = RETCODE_PARSE_ERR
+        elif self.compile_started:
+            retcode = RETCODE_COMPILE_ERR
+        else:
+            retcode = RETCODE_EXEC_ERR
+        results['retcode'] = retcode
+        return results
+
+# Lines longer than this are only parsed up to this length
+MAX_PARSE_LINE_LEN = 64 * 1024
+
+def parse_stream(instream, parser, logfile=None):
+    """ Feed every line of a binary stream to parser and optionally
+        copy the stream to logfile
+    """
+    partial = False
+    for line in iter(lambda: instream.readline(MAX_PARSE_LINE_LEN), b''):
+        if logfile is not None:
+            logfile.write(line)
+        # Only the first chunk of a line that is too long is parsed
+        if not partial:
+            parser.parse_line(line.rstrip(b'\r\n'))
+        partial = not line.endswith(b'\n')
+
+def parse_log_file(logpath):
+    parser = SimOutputParser()
+    with open(logpath, 'rb') as logfile:
+        parse_stream(logfile, parser)
+    return parser.get_results()
+
+def write_sim_output(result, outstream):
+    """ Copy the output of a simulation (see SimJob) to outstream
+    """
+    if 'logfile' in result:
+        with open(result['logfile'], 'rb') as logfile:
+            shutil.copyfileobj(logfile, outstream)
     else:
-        retcode = RETCODE_EXEC_ERR
-    results['retcode'] = retcode
-    return results
-
-def run_sim(path, simulator, basedir, setupenv):
-    """ Run the simulation at the specified path
-        The simulator can be specified as the target
-        A environment script can be run optionally
+        outstream.write(result['stdout'])
+
+def get_sim_log_path(logdir, name, simulator):
+    """ Path of the file that the output of a simulation is written to
     """
-    try:
-        # Optionally run an environment setup script
-        if setupenv is None:
-            setupenv = ''
-            # Check if environment was setup
-            if 'VIVADO_PATH' not in os.environ:
-                return {'retcode': RETCODE_EXEC_ERR, 'passed':False, 'stdout':bytes('Simulation environment was not initialized\n', 'utf-8')}
-        else:
-            setupenv = '. ' + os.path.realpath(setupenv) + ';'
-        # Run the simulation
-        return parse_output(
-            subprocess.check_output(
-                'cd {workingdir}; /bin/bash -c "{setupenv} make {simulator} 2>&1"'.format(
-                    workingdir=os.path.join(basedir, path), setupenv=setupenv, simulator=simulator), shell=True))
-    except subprocess.CalledProcessError as e:
-        return {'retcode': int(abs(e.returncode)), 'passed':False, 'stdout':e.output}
-    except Exception as e:
-        _LOG.error('Target ' + path + ' failed to run:\n' + str(e))
-        return {'retcode': RETCODE_EXEC_ERR, 'passed':False, 'stdout':bytes(str(e), 'utf-8')}
-    except:
-        _LOG.error('Target ' + path + ' failed to run')
-        return {'retcode': RETCODE_UNKNOWN_ERR, 'passed':False, 'stdout':bytes('Unknown Exception', 'utf-8')}
-
-def run_sim_queue(run_queue, out_queue, simulator, basedir, setupenv):
-    """ Thread worker for a simulation runner
-        Pull a job from the run queue, run the sim, then place
-        output in out_queue
+    return os.path.join(logdir, name, simulator + '.log')
+
+class SimJob:
+    """ A simulation that runs in the background
+        The simulation runs in its own session so that it can be killed
+        together with all the processes it started. Its output is parsed
+        by a reader thread while it runs and written to logpath.
     """
-    while not run_queue.empty():
-        (name, path) = run_queue.get()
+    def __init__(self, name, path, simulator, basedir, setupenv, logpath, done_event):
+        self.name = name
+        self.path = path
+        self.simulator = simulator
+        self.basedir = basedir
+        self.setupenv = setupenv
+        self.logpath = logpath
+        self.done_event = done_event
+        self.proc = None
+        self.start_time = None
+        # Peak RSS in bytes of the largest process (from wait4) and of
+        # the sum of all processes (sampled) of the simulation
+        self.max_rss = 0
+        self.sampled_rss = 0
+        self.result = None
+
+    def start(self):
+        """ Start the simulation at the specified path
+            The simulator can be specified as the target
+            A environment script can be run optionally
+        """
+        self.start_time = time.monotonic()
+        try:
+            # Optionally run an environment setup script
+            if self.setupenv is None:
+                setupenv = ''
+                # Check if environment was setup
+                if 'VIVADO_PATH' not in os.environ:
+                    self.finish({'retcode': RETCODE_EXEC_ERR, 'passed':False, 'stdout':bytes('Simulation environment was not initialized\n', 'utf-8')})
+                    return
+            else:
+                setupenv = '. ' + os.path.realpath(self.setupenv) + ';'
+            # Run the simulation
+            os.makedirs(os.path.dirname(self.logpath), exist_ok=True)
+            logfile = open(self.logpath, 'wb')
+            try:
+                self.proc = subprocess.Popen(
+                    'cd {workingdir}; /bin/bash -c "{setupenv} make {simulator} 2>&1"'.format(
+                        workingdir=os.path.join(self.basedir, self.path), setupenv=setupenv, simulator=self.simulator),
+                    shell=True, stdout=subprocess.PIPE, start_new_session=True)
+            except:
+                logfile.close()
+                raise
+            Thread(target=self.read_output, args=(logfile,), daemon=True).start()
+        except Exception as e:
+            _LOG.error('Target ' + self.path + ' failed to run:\n' + str(e))
+            self.finish({'retcode': RETCODE_EXEC_ERR, 'passed':False, 'stdout':bytes(str(e), 'utf-8')})
+
+    def read_output(self, logfile):
+        """ Reader thread: Parse the output until the simulation exits
+        """
         try:
-            _LOG.info('Starting: %s', name)
-            result = run_sim(path, simulator, basedir, setupenv)
-            out_queue.put((name, result))
-            _LOG.info('FINISHED: %s (%s, %s)', name, retcode_to_str(result['retcode']), 'PASS' if result['passed'] else 'FAIL!')
-        except KeyboardInterrupt:
-            _LOG.warning('Target ' + name + ' received SIGINT. Aborting...')
-            out_queue.put((name, {'retcode': RETCODE_EXEC_ERR, 'passed':False, 'stdout':bytes('Aborted by user', 'utf-8')}))
+            parser = SimOutputParser()
+            with logfile, self.proc.stdout:
+                parse_stream(self.proc.stdout, parser, logfile)
+            # Reap the process here (instead of proc.wait()) to get the
+            # peak RSS of the simulation and all of its subprocesses
+            (_, status, rusage) = os.wait4(self.proc.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.proc.returncode = -os.WTERMSIG(status)
+            else:
+                self.proc.returncode = os.WEXITSTATUS(status)
+            self.max_rss = rusage.ru_maxrss * 1024
+            if self.proc.returncode != 0:
+                result = {'retcode': int(abs(self.proc.returncode)), 'passed':False, 'logfile':self.logpath}
+            else:
+                result = parser.get_results()
+                result['logfile'] = self.logpath
         except Exception as e:
-            _LOG.error('Target ' + name + ' failed to run:\n' + str(e))
-            out_queue.put((name, {'retcode': RETCODE_UNKNOWN_ERR, 'passed':False, 'stdout':bytes(str(e), 'utf-8')}))
-        finally:
-            run_queue.task_done()
+            _LOG.error('Target ' + self.name + ' failed to run:\n' + str(e))
+            result = {'retcode': RETCODE_UNKNOWN_ERR, 'passed':False, 'stdout':bytes(str(e), 'utf-8')}
+        self.finish(result)
+
+    def finish(self, result):
+        result['run_time_s'] = time.monotonic() - self.start_time
+        self.result = result
+        self.done_event.set()
+
+    def poll(self):
+        """ Returns the result of the simulation or None while it is running
+        """
+        return self.result
+
+    def get_peak_rss(self):
+        return max(self.max_rss, self.sampled_rss)
+
+    def kill(self, sig=signal.SIGKILL):
+        """ Send a signal to all processes of the simulation
+        """
+        if self.proc is not None and self.result is None:
+            try:
+                os.killpg(self.proc.pid, sig)
+            except OSError:
+                pass
+
+def kill_jobs(jobs, timeout=10.0):
+    """ Terminate the jobs and kill the ones that did not exit after timeout
+    """
+    for job in jobs:
+        job.kill(signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    for job in jobs:
+        while job.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.1)
+        job.kill(signal.SIGKILL)
+
+def get_num_cpus():
+    """ Number of CPUs that this process (and the simulations) may run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_available_memory():
+    """ Memory in bytes that is available for new processes or None
+        if it cannot be determined (Linux only)
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def get_process_tree_rss(pids):
+    """ Sum of the RSS in bytes of each process in pids and all of its
+        descendants. Returns an empty dict if /proc is not available.
+    """
+    children = {}
+    rss = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat', 'rb') as statfile:
+                stat = statfile.read()
+            # The fields after the command name, starting with the state
+            fields = stat[stat.rindex(b')') + 2:].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+            rss[int(entry)] = int(fields[21]) * page_size
+        except (OSError, ValueError, IndexError):
+            continue
+    tree_rss = {}
+    for pid in pids:
+        total = 0
+        stack = [pid]
+        while stack:
+            p = stack.pop()
+            total += rss.get(p, 0)
+            stack.extend(children.get(p, []))
+        tree_rss[pid] = total
+    return tree_rss
+
+HISTORY = 'history.json'
+
+def get_expected(history, names, key):
+    """ Expected value of key (e.g. the run time) of each simulation from
+        the history of previous runs. Simulations that were never run are
+        assumed to be as large as the largest known one, so that they
+        start early and are not started next to too many others.
+    """
+    known = [history[name][key] for name in names if key in history.get(name, {})]
+    default = max(known) if known else 0
+    return {name: history.get(name, {}).get(key, default) for name in names}
+
+def estimate_makespan(run_times, num_jobs, busy=None):
+    """ Estimate how long it takes num_jobs workers to process a list of
+        run times in order. busy are the remaining run times of the jobs
+        that are already running.
+    """
+    workers = sorted(busy)[-num_jobs:] if busy else []
+    workers += [0.0] * (num_jobs - len(workers))
+    heapq.heapify(workers)
+    for run_time in run_times:
+        heapq.heappush(workers, heapq.heappop(workers) + run_time)
+    return max(workers) if workers else 0.0
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+INCREMENTAL_STATE = 'incremental.json'
+DEPS_TARGET = '__run_testbenches_deps'
+DEPS_MARKER = b'RUN_TESTBENCHES_DEPS:'
+# Fields of a result that are kept to reuse it in a later run
+CACHED_RESULT_KEYS = ['retcode', 'passed', 'module', 'start_time', 'wall_time',
+                      'sim_time_ns', 'tc_expected', 'tc_run', 'tc_passed', 'logfile']
+
+def get_sim_deps(workingdir):
+    """ List the files that a simulation depends on: All the sources
+        that are passed to the simulator and all the makefiles that are
+        included (Makefile.srcs, viv_sim_preamble.mak, ...). Make is
+        asked to expand the source lists without building anything.
+        Returns None if the Makefile could not be evaluated.
+    """
+    rule = '{target}: ; @: $(info {marker} $(abspath $(DESIGN_SRCS) $(SIM_SRCS) $(INC_SRCS) ' \
+           '$(MAKEFILE_LIST) $(TOOLS_DIR)/scripts/viv_sim_project.tcl))'.format(
+           target=DEPS_TARGET, marker=str(DEPS_MARKER, 'ascii'))
+    try:
+        output = subprocess.run(['make', '-s', '--no-print-directory', '--eval=' + rule, DEPS_TARGET],
+            cwd=workingdir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in output.split(b'\n'):
+        if line.startswith(DEPS_MARKER):
+            return sorted(set(str(line[len(DEPS_MARKER):], 'utf-8').split()))
+    return None
+
+def hash_file_cached(fname, old_hashes, new_hashes):
+    """ Return the SHA1 digest of a file. Files are only hashed again if
+        their mtime or size changed since the digest in old_hashes was
+        computed. All digests that are used end up in new_hashes.
+    """
+    entry = new_hashes.get(fname)
+    if entry is None:
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return 'missing'
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = old_hashes.get(fname)
+        if entry is None or entry[0:2] != stamp:
+            entry = stamp + [hash_file(fname)]
+        new_hashes[fname] = entry
+    return entry[2]
+
+def get_sim_inputs_digest(workingdir, simulator, old_hashes, new_hashes):
+    """ A digest of the contents of all the inputs of a simulation
+        Returns None if the inputs could not be determined
+    """
+    deps = get_sim_deps(workingdir)
+    if deps is None:
+        return None
+    sha = hashlib.sha1(bytes(simulator, 'utf-8'))
+    for dep in deps:
+        sha.update(bytes(dep + '\0' + hash_file_cached(dep, old_hashes, new_hashes) + '\0', 'utf-8'))
+    return sha.hexdigest()
 
 #-------------------------------------------------------
 # Script Actions
@@ -214,7 +609,8 @@ def do_list(args):
     """ List all simulations that can be run
     """
     excludes = read_excludes_file(args.excludes)
-    for (name, path) in gather_target_sims(args.basedir, args.target, excludes):
+    for (name, path) in gather_target_sims(args.basedir, args.target, excludes,
+        get_cache_path(args, DISCOVERY_INDEX), args.rescan):
         print(name)
     return 0
 
@@ -222,48 +618,137 @@ def do_run(args):
     """ Build a simulation queue based on the specified
         args and process it
     """
-    run_queue = Queue(maxsize=0)
-    out_queue = Queue(maxsize=0)
-    _LOG.info('Queueing the following targets to simulate:')
     excludes = read_excludes_file(args.excludes)
-    name_maxlen = 0
-    for (name, path) in gather_target_sims(args.basedir, args.target, excludes):
-        run_queue.put((name, path))
-        name_maxlen = max(name_maxlen, len(name))
-        _LOG.info('* ' + name)
-    # Spawn tasks to run builds
-    num_sims = run_queue.qsize()
-    num_jobs = min(num_sims, int(args.jobs))
-    _LOG.info('Started ' + str(num_jobs) + ' job(s) to process queue...')
+    target_sims = gather_target_sims(args.basedir, args.target, excludes,
+        get_cache_path(args, DISCOVERY_INDEX), args.rescan)
+    name_maxlen = max([len(name) for (name, _) in target_sims] + [0])
+    # Record what each simulation depends on so that an incremental run
+    # can skip the ones that passed before and have not changed since
+    incr_fname = get_cache_path(args, INCREMENTAL_STATE)
+    incr_state = load_json(incr_fname, {})
+    file_hashes = {}
+    passed_before = incr_state.setdefault('results', {}).setdefault(args.simulator, {})
+    inputs = {}
+    for (name, path) in target_sims:
+        inputs[name] = get_sim_inputs_digest(os.path.join(args.basedir, path), args.simulator,
+            incr_state.get('files', {}), file_hashes)
+    incr_state['files'] = file_hashes
     results = {}
-    for i in range(num_jobs):
-        worker = Thread(target=run_sim_queue, args=(run_queue, out_queue, args.simulator, args.basedir, args.setupenv))
-        worker.setDaemon(False)
-        worker.start()
-    # Wait for build queue to become empty
+    if args.incremental:
+        for (name, path) in target_sims:
+            if inputs[name] is not None and inputs[name] == passed_before.get(name, {}).get('inputs'):
+                results[name] = dict(passed_before[name]['result'], cached=True)
+        if results:
+            _LOG.info('Reusing the results of the following unchanged targets:')
+            for name in sorted(results):
+                _LOG.info('* ' + name)
+        target_sims = [(name, path) for (name, path) in target_sims if name not in results]
+    # Start the longest simulations first (based on previous runs) so
+    # that no long simulation is left running on its own at the end
+    history_fname = get_cache_path(args, HISTORY)
+    history = load_json(history_fname, {})
+    sim_history = history.setdefault(args.simulator, {})
+    expected = get_expected(sim_history, [name for (name, _) in target_sims], 'wall_time_s')
+    expected_mem = {name: mem * 2**20 for (name, mem) in
+        get_expected(sim_history, [name for (name, _) in target_sims], 'peak_rss_mb').items()}
+    target_sims.sort(key=lambda sim: -expected[sim[0]])
+    _LOG.info('Queueing the following targets to simulate:')
+    for (name, path) in target_sims:
+        if name in sim_history:
+            _LOG.info('* %s (~%s)', name, format_duration(expected[name]))
+        else:
+            _LOG.info('* ' + name)
+    # Limit the number of simulations that run at the same time to the
+    # number of CPUs and to what fits in memory (based on previous runs)
+    num_sims = len(target_sims)
+    num_cpus = get_num_cpus()
+    num_jobs = num_cpus if args.jobs == 'auto' else int(args.jobs)
+    if num_jobs > num_cpus:
+        _LOG.warning('Running %d parallel jobs on %d available CPU(s)', num_jobs, num_cpus)
+    num_jobs = min(num_sims, num_jobs)
+    mem_budget = args.max_mem * 2**30 if args.max_mem else get_available_memory()
+    if num_sims and sim_history:
+        longest = target_sims[0][0]
+        _LOG.info('Expected time to complete: %s (critical path: %s, %s)',
+            format_duration(estimate_makespan([expected[name] for (name, _) in target_sims], num_jobs)),
+            longest, format_duration(expected[longest]))
+    _LOG.info('Running up to ' + str(num_jobs) + ' job(s) at a time' +
+        ('' if mem_budget is None else ' within %.1f GB of memory' % (mem_budget / 2**30)) + '...')
+    pending = list(target_sims)
+    running = []
+    finished = []
+    done_event = Event()
     start = datetime.datetime.now()
     try:
-        while out_queue.qsize() < num_sims:
+        while pending or running:
+            done_event.clear()
+            for job in [job for job in running if job.poll() is not None]:
+                running.remove(job)
+                finished.append(job)
+                _LOG.info('FINISHED: %s (%s, %s)', job.name, retcode_to_str(job.result['retcode']), 'PASS' if job.result['passed'] else 'FAIL!')
+            # Start the longest pending simulations that fit into the memory
+            # that is left. One simulation always runs, even if it does not fit.
+            reserved = sum([expected_mem[job.name] for job in running])
+            for (name, path) in list(pending):
+                if len(running) >= num_jobs:
+                    break
+                if running and mem_budget is not None and reserved + expected_mem[name] > mem_budget:
+                    continue
+                if mem_budget is not None and expected_mem[name] > mem_budget:
+                    _LOG.warning('%s used %.1f GB of memory before, more than the %.1f GB available',
+                        name, expected_mem[name] / 2**30, mem_budget / 2**30)
+                pending.remove((name, path))
+                _LOG.info('Starting: %s', name)
+                job = SimJob(name, path, args.simulator, args.basedir, args.setupenv,
+                    get_sim_log_path(get_cache_path(args, 'logs'), name, args.simulator), done_event)
+                job.start()
+                running.append(job)
+                reserved += expected_mem[name]
+            # Track the memory of each running simulation
+            tree_rss = get_process_tree_rss([job.proc.pid for job in running if job.proc is not None])
+            for job in running:
+                if job.proc is not None:
+                    job.sampled_rss = max(job.sampled_rss, tree_rss.get(job.proc.pid, 0))
             tdiff = str(datetime.datetime.now() - start).split('.', 2)[0]
-            print("\r>>> [%s] (%d/%d simulations completed) <<<" % (tdiff, out_queue.qsize(), num_sims), end='\r', flush=True)
-            time.sleep(1.0)
+            eta = ''
+            if sim_history:
+                now = time.monotonic()
+                busy = [max(expected[job.name] - (now - job.start_time), 0.0) for job in running]
+                eta = ', ETA ' + format_duration(estimate_makespan(
+                    [expected[name] for (name, _) in pending], num_jobs, busy))
+            print("\r>>> [%s] (%d/%d simulations completed%s) <<<" % (tdiff, len(finished), num_sims, eta), end='\r', flush=True)
+            done_event.wait(1.0)
         sys.stdout.write("\n")
     except (KeyboardInterrupt):
-        _LOG.warning('Received SIGINT. Aborting... (waiting for pending jobs to finish)')
-        # Flush run queue
-        while not run_queue.empty():
-            (name, path) = run_queue.get()
+        sys.stdout.write("\n")
+        _LOG.warning('Received SIGINT. Aborting... (killing %d running job(s))', len(running))
+        kill_jobs(running)
         raise SystemExit(1)
 
-    results = {}
     result_all = 0
-    while not out_queue.empty():
-        (name, result) = out_queue.get()
+    for job in finished:
+        (name, result) = (job.name, job.result)
         results[name] = result
         log_with_header(name)
-        sys.stdout.buffer.write(result['stdout'])
+        sys.stdout.flush()
+        write_sim_output(result, sys.stdout.buffer)
         if not result['passed']:
             result_all += 1
+        # The memory use is also learned from failed (e.g. OOM-killed)
+        # simulations, but their run times are not representative
+        if job.get_peak_rss() > 0:
+            sim_history.setdefault(name, {})['peak_rss_mb'] = int(round(job.get_peak_rss() / 2**20))
+        if result['retcode'] == RETCODE_SUCCESS:
+            sim_history.setdefault(name, {}).update({'wall_time_s': round(result['run_time_s'], 1),
+                                                   'sim_time_ns': result['sim_time_ns']})
+        if result['passed'] and inputs[name] is not None:
+            cached = {key: result[key] for key in CACHED_RESULT_KEYS if key in result}
+            cached['module'] = str(cached['module'], 'utf-8', 'replace')
+            passed_before[name] = {'inputs': inputs[name], 'result': cached}
+        else:
+            passed_before.pop(name, None)
+    save_json(history_fname, history)
+    save_json(incr_fname, incr_state)
     sys.stdout.write('\n\n\n')
     sys.stdout.flush()
     time.sleep(1.0)
@@ -273,13 +758,14 @@ def do_run(args):
     for name in sorted(results):
         r = results[name]
         if 'module' in r:
-            _LOG.info('* %s : %s (Expected=%02d, Run=%02d, Passed=%02d, Elapsed=%s)',
-                name.ljust(name_maxlen), ('Passed' if r['passed'] else 'FAILED'), r['tc_expected'], r['tc_run'], r['tc_passed'], r['wall_time'])
+            _LOG.info('* %s : %s (Expected=%02d, Run=%02d, Passed=%02d, Elapsed=%s)%s',
+                name.ljust(name_maxlen), ('Passed' if r['passed'] else 'FAILED'), r['tc_expected'], r['tc_run'], r['tc_passed'], r['wall_time'],
+                (' [unchanged]' if r.get('cached') else ''))
         else:
             _LOG.info('* %s : %s (Status = %s)', name.ljust(name_maxlen), ('Passed' if r['passed'] else 'FAILED'), 
                 retcode_to_str(r['retcode']))
     _LOG.info('='*hdr_len)
-    _LOG.info('SUMMARY: %d out of %d tests passed. Time elapsed was %s'%(num_sims - result_all, num_sims, str(datetime.datetime.now() - start).split('.', 2)[0]))   
+    _LOG.info('SUMMARY: %d out of %d tests passed. Time elapsed was %s'%(len(results) - result_all, len(results), str(datetime.datetime.now() - start).split('.', 2)[0]))   
     _LOG.info('#'*hdr_len)
     return result_all
 
@@ -296,7 +782,8 @@ def do_cleanup(args):
     else:
         setupenv = '. ' + os.path.realpath(setupenv) + ';'
     excludes = read_excludes_file(args.excludes)
-    for (name, path) in gather_target_sims(args.basedir, args.target, excludes):
+    for (name, path) in gather_target_sims(args.basedir, args.target, excludes,
+        get_cache_path(args, DISCOVERY_INDEX), args.rescan):
         _LOG.info('Cleaning up %s', name)
         os.chdir(os.path.join(args.basedir, path))
         subprocess.Popen('{setupenv} make cleanall'.format(setupenv=setupenv), shell=True).wait()
@@ -310,23 +797,23 @@ def do_report(args):
     with open(args.report, 'w') as repfile:
         repfile.write((','.join([x.upper() for x in keys])) + '\n')
         excludes = read_excludes_file(args.excludes)
-        for (name, path) in gather_target_sims(args.basedir, args.target, excludes):
+        for (name, path) in gather_target_sims(args.basedir, args.target, excludes,
+            get_cache_path(args, DISCOVERY_INDEX), args.rescan):
             results = {'module': str(name), 'status':'NOT_RUN', 'retcode':'<unknown>', 
                        'start_time':'<unknown>', 'wall_time':'<unknown>', 'sim_time_ns':0,
                        'tc_expected':0, 'tc_run':0, 'tc_passed':0}
             logpath = os.path.join(path, args.simulator + '.log')
             if os.path.isfile(logpath):
-                with open(logpath, 'rb') as logfile:
-                    r = parse_output(logfile.read())
-                    if r['retcode'] != RETCODE_SUCCESS:
-                        results['retcode'] = retcode_to_str(r['retcode'])
-                        results['status'] = 'ERROR'
-                        results['start_time'] = r['start_time']
-                    else:
-                        results = r
-                        results['module'] = name
-                        results['status'] = 'PASSED' if r['passed'] else 'FAILED'
-                        results['retcode'] = retcode_to_str(r['retcode'])
+                r = parse_log_file(logpath)
+                if r['retcode'] != RETCODE_SUCCESS:
+                    results['retcode'] = retcode_to_str(r['retcode'])
+                    results['status'] = 'ERROR'
+                    results['start_time'] = r['start_time']
+                else:
+                    results = r
+                    results['module'] = name
+                    results['status'] = 'PASSED' if r['passed'] else 'FAILED'
+                    results['retcode'] = retcode_to_str(r['retcode'])
             repfile.write((','.join([str(results[x]) for x in keys])) + '\n')
     _LOG.info('Testbench report written to ' + args.report)
     return 0
@@ -339,7 +826,11 @@ def get_options():
     parser.add_argument('-e', '--setupenv', default=None, help='Optional environment setup script to run for each TB')
     parser.add_argument('-r', '--report', default='testbench_report.csv', help='Name of the output report file')
     parser.add_argument('-x', '--excludes', default=None, help='Name of the excludes file. It contains all targets to exlude.')
-    parser.add_argument('-j', '--jobs', default=1, help='Number of parallel simulation jobs to run')
+    parser.add_argument('-j', '--jobs', default=1, help='Maximum number of parallel simulation jobs to run ("auto" for one per CPU)')
+    parser.add_argument('-m', '--max-mem', type=float, default=None, help='Memory in GB that parallel simulation jobs may use (default: memory available at start)')
+    parser.add_argument('-c', '--cachedir', default=None, help='Directory for state and simulation logs kept between runs (default: <basedir>/.run_testbenches)')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Only run simulations whose sources changed since they last passed')
+    parser.add_argument('--rescan', action='store_true', help='Ignore the testbench discovery index and scan the full base directory')
     parser.add_argument('action', choices=['run', 'cleanup', 'list', 'report'], default='list', help='What to do?')
     parser.add_argument('target', nargs='*', default='.*', help='Space separated simulation target regexes')
     return parser.parse_args()
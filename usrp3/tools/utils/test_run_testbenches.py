@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+#
+# Copyright 2018 Ettus Research, a National Instruments Company
+#
+# SPDX-License-Identifier: LGPL-3.0-or-later
+#
+""" Unit tests for the log parser of run_testbenches.py
+    Run with: python3 -m unittest test_run_testbenches
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import run_testbenches
+from run_testbenches import parse_log_file, RETCODE_SUCCESS, RETCODE_PARSE_ERR, \
+    RETCODE_COMPILE_ERR, RETCODE_EXEC_ERR
+
+def make_report(module, sim_time, expected, run, passed, result):
+    return [
+        '========================================================',
+        'TESTBENCH FINISHED: %s' % (module),
+        ' - Time elapsed:   %d ns' % (sim_time),
+        ' - Tests Expected: %d' % (expected),
+        ' - Tests Run:      %d' % (run),
+        ' - Tests Passed:   %d' % (passed),
+        'Result: %s' % ('PASSED   ' if result else 'FAILED!!!'),
+        '========================================================',
+    ]
+
+HEADER = [
+    '# Start of session at: Mon Jan  1 10:00:00 2018',
+    'source noc_block_foo_tb/viv_sim_project.tcl',
+    'launch_simulation: Time (s): cpu = 00:00:10 ; elapsed = 00:01:02 . Memory (MB): peak = 1000',
+    '========================================================',
+    'TESTBENCH STARTED: noc_block_foo_tb',
+    '========================================================',
+    '[TEST CASE   1] (t=000001000) BEGIN: Reset...',
+    '[TEST CASE   1] (t=000002000) DONE... Passed',
+]
+
+class ParseLogFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def parse(self, lines, eol='\n', final_eol=True):
+        logpath = os.path.join(self.tmpdir, 'xsim.log')
+        with open(logpath, 'wb') as logfile:
+            logfile.write((eol.join(lines) + (eol if final_eol else '')).encode('ascii'))
+        return parse_log_file(logpath)
+
+    def test_pass(self):
+        results = self.parse(HEADER + make_report('noc_block_foo_tb', 123456, 4, 4, 4, True))
+        self.assertEqual(results['retcode'], RETCODE_SUCCESS)
+        self.assertTrue(results['passed'])
+        self.assertEqual(results['module'], b'noc_block_foo_tb')
+        self.assertEqual(results['sim_time_ns'], 123456)
+        self.assertEqual((results['tc_expected'], results['tc_run'], results['tc_passed']), (4, 4, 4))
+        self.assertEqual(results['start_time'], 'Mon Jan  1 10:00:00 2018')
+        self.assertEqual(results['wall_time'], '00:01:02')
+
+    def test_fail(self):
+        results = self.parse(HEADER + make_report('noc_block_foo_tb', 2000, 4, 3, 2, False))
+        self.assertEqual(results['retcode'], RETCODE_SUCCESS)
+        self.assertFalse(results['passed'])
+        self.assertEqual((results['tc_expected'], results['tc_run'], results['tc_passed']), (4, 3, 2))
+
+    def test_crlf(self):
+        results = self.parse(HEADER + make_report('noc_block_foo_tb', 123456, 4, 4, 4, True), eol='\r\n')
+        self.assertEqual(results['retcode'], RETCODE_SUCCESS)
+        self.assertTrue(results['passed'])
+        self.assertEqual(results['module'], b'noc_block_foo_tb')
+        self.assertEqual(results['sim_time_ns'], 123456)
+        self.assertEqual(results['start_time'], 'Mon Jan  1 10:00:00 2018')
+        self.assertEqual(results['wall_time'], '00:01:02')
+
+    def test_no_final_eol(self):
+        lines = HEADER + make_report('noc_block_foo_tb', 123456, 4, 4, 4, True)
+        # The result line is the last line of the log
+        results = self.parse(lines[:-1], final_eol=False)
+        self.assertEqual(results['retcode'], RETCODE_SUCCESS)
+        self.assertTrue(results['passed'])
+        self.assertEqual(results['tc_passed'], 4)
+
+    def test_multiple_reports(self):
+        # The last complete report wins
+        results = self.parse(HEADER + make_report('noc_block_foo_tb', 1000, 4, 4, 4, True) +
+                             make_report('noc_block_bar_tb', 5000, 2, 2, 1, False))
+        self.assertFalse(results['passed'])
+        self.assertEqual(results['module'], b'noc_block_bar_tb')
+        self.assertEqual(results['sim_time_ns'], 5000)
+        # An incomplete report does not replace a complete one
+        results = self.parse(HEADER + make_report('noc_block_foo_tb', 1000, 4, 4, 4, True) +
+                             make_report('noc_block_bar_tb', 5000, 2, 2, 1, False)[:4])
+        self.assertTrue(results['passed'])
+        self.assertEqual(results['module'], b'noc_block_foo_tb')
+
+    def test_errors(self):
+        self.assertEqual(self.parse(HEADER)['retcode'], RETCODE_PARSE_ERR)
+        self.assertEqual(self.parse(HEADER[:3])['retcode'], RETCODE_COMPILE_ERR)
+        self.assertEqual(self.parse(HEADER[:1])['retcode'], RETCODE_EXEC_ERR)
+        self.assertEqual(self.parse([])['retcode'], RETCODE_EXEC_ERR)
+
+    def test_long_line(self):
+        # Only the start of a line that is too long is parsed
+        long_line = 'x' * (run_testbenches.MAX_PARSE_LINE_LEN + 10) + 'TESTBENCH FINISHED: noc_block_foo_tb'
+        results = self.parse(HEADER + [long_line] + make_report('noc_block_foo_tb', 1000, 1, 1, 1, True)[2:])
+        self.assertEqual(results['retcode'], RETCODE_PARSE_ERR)
+
+if __name__ == '__main__':
+    unittest.main()